@@ -0,0 +1,49 @@
+# -*- test-case-name: xmantissa.test.test_sharing -*-
+"""
+Axiomatic commands for maintaining the Mantissa sharing system.
+"""
+
+from axiom.scripts import axiomatic
+from axiom.userbase import LoginAccount
+
+from xmantissa import sharing
+
+
+
+class RebuildRoles(axiomatic.AxiomaticSubCommand):
+    """
+    Command for recomputing the transitive role membership table of a store,
+    and optionally of every user store beneath it.
+    """
+    optFlags = [
+        ('users', 'u', 'Also rebuild the role memberships of every user '
+         'store in this site store.'),
+        ]
+
+    def postOptions(self):
+        """
+        Rebuild the L{sharing.RoleMembership}s of the store and, if requested,
+        of each user store.
+        """
+        store = self.store
+        count = sharing.rebuildRoleMemberships(store)
+        if self['users']:
+            for account in store.query(LoginAccount):
+                if account.avatars is None:
+                    continue
+                count += sharing.rebuildRoleMemberships(account.avatars.open())
+        print 'Rebuilt memberships for %d roles.' % (count,)
+
+
+
+class SharingCommand(axiomatic.AxiomaticCommand):
+    name = 'sharing'
+    description = 'Maintain the data used by the sharing system.'
+
+    subCommands = [
+        ('rebuild-roles', None, RebuildRoles,
+         'Recompute transitive role memberships.'),
+        ]
+
+    def getStore(self):
+        return self.parent.getStore()
@@ -0,0 +1,146 @@
+# -*- test-case-name: xmantissa.test.test_domainindex -*-
+
+"""
+Looking up the domains a hostname belongs to.
+
+L{xmantissa._webutil.VirtualHostWrapper.subdomain},
+L{xmantissa.web.SiteConfiguration.rootURL},
+L{xmantissa.websession.PersistentSessionWrapper.cookieDomainForRequest} and
+L{xmantissa.signup.UserInfoSignup.getAvailableDomains} all need the domains
+served by the site, and most of them need to know which of those a hostname
+is in.  A L{DomainIndex} arranges a list of domains in a trie keyed on their
+labels, last label first, so that the domains a hostname is in are found by
+walking the labels of the hostname once, however many domains there are.
+
+L{domainIndex} keeps the L{DomainIndex} of the domains in the
+L{axiom.userbase.LoginMethod}s of a site store.  They are queried again only
+when the store may have changed, and the index is built again only when the
+domains have changed.
+"""
+
+from axiom.userbase import getDomainNames
+
+from xmantissa._storechange import storeChangeToken
+
+
+
+class _DomainTrie(object):
+    """
+    A node in a trie of domain labels.
+
+    @ivar order: the position of the domain which ends at this node in the
+    list of domains, or C{None} if no domain ends here.
+
+    @ivar children: a C{dict} mapping labels to L{_DomainTrie}s.
+    """
+    def __init__(self):
+        self.order = None
+        self.children = {}
+
+
+
+class DomainIndex(object):
+    """
+    A list of domains, arranged for finding the ones a hostname is in.
+
+    @ivar domains: the C{list} of domains.
+    """
+    def __init__(self, domains):
+        self.domains = list(domains)
+        self._root = _DomainTrie()
+        for (order, domain) in enumerate(self.domains):
+            node = self._root
+            for label in reversed(domain.split('.')):
+                child = node.children.get(label)
+                if child is None:
+                    child = node.children[label] = _DomainTrie()
+                node = child
+            if node.order is None:
+                node.order = order
+
+
+    def matches(self, hostname):
+        """
+        Find the domains which C{hostname} is, or is a subdomain of.
+
+        @param hostname: a C{str} or C{unicode} hostname, without a port.
+
+        @return: a C{list} of two-tuples of the subdomain part of C{hostname},
+            or C{None} if it is the domain itself, and the domain, in the order
+            the domains were given.
+        """
+        labels = hostname.split('.')
+        matches = []
+        node = self._root
+        for depth in xrange(1, len(labels) + 1):
+            node = node.children.get(labels[-depth])
+            if node is None:
+                break
+            if node.order is not None:
+                if depth == len(labels):
+                    subdomain = None
+                else:
+                    subdomain = '.'.join(labels[:-depth])
+                matches.append((node.order, subdomain))
+        matches.sort()
+        return [(subdomain, self.domains[order])
+                for (order, subdomain) in matches]
+
+
+
+class _StoreDomainIndex(object):
+    """
+    The L{DomainIndex} of the domains of a store, kept for as long as they
+    have not changed.
+
+    @ivar store: the site L{axiom.store.Store}.
+
+    @ivar rebuilds: the number of times the index has been built.
+    """
+    def __init__(self, store):
+        self.store = store
+        self.rebuilds = 0
+        self._storeToken = None
+        self._index = None
+
+
+    def index(self):
+        """
+        Get the L{DomainIndex} of the domains of the store, finding them again
+        if they may have changed.
+        """
+        storeToken = storeChangeToken(self.store)
+        if storeToken != self._storeToken:
+            domains = getDomainNames(self.store)
+            if self._index is None or domains != self._index.domains:
+                self._index = DomainIndex(domains)
+                self.rebuilds += 1
+            self._storeToken = storeToken
+        return self._index
+
+
+    def invalidate(self):
+        """
+        Find the domains again the next time they are needed.
+        """
+        self._storeToken = None
+
+
+
+def storeDomainIndex(store):
+    """
+    Get the L{_StoreDomainIndex} of a store, creating it if necessary.
+    """
+    cache = getattr(store, '_domainIndex', None)
+    if cache is None:
+        cache = store._domainIndex = _StoreDomainIndex(store)
+    return cache
+
+
+
+def domainIndex(store):
+    """
+    Get the L{DomainIndex} of the domains of the internal
+    L{axiom.userbase.LoginMethod}s in a store.
+    """
+    return storeDomainIndex(store).index()
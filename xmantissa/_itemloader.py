@@ -0,0 +1,108 @@
+# -*- test-case-name: xmantissa.test.test_itemloader -*-
+
+"""
+Loading many items by storeID at once.
+
+L{axiom.store.Store.getItemByID} takes two queries to load an item which is
+not already in memory: one to find its type, and one to load it from the
+table for that type.  L{loadItems} finds the types of many items in one
+query, and loads all of the items of each type in one more.
+"""
+
+from axiom import errors
+from axiom.item import _typeNameToMostRecentClass
+from axiom.store import STORE_SELF_ID
+
+# SQLite limits the number of parameters a statement may have; this is
+# comfortably below the default limit.
+_CHUNK_SIZE = 500
+
+_TYPEOF_MANY_QUERY = """
+SELECT "*DATABASE*"."axiom_objects"."oid",
+       "*DATABASE*"."axiom_types"."typename",
+       "*DATABASE*"."axiom_types"."version"
+    FROM "*DATABASE*"."axiom_types", "*DATABASE*"."axiom_objects"
+    WHERE "*DATABASE*"."axiom_objects"."oid" IN (%s)
+        AND "*DATABASE*"."axiom_types"."oid" =
+            "*DATABASE*"."axiom_objects"."type_id"
+"""
+
+_noItem = object()
+
+
+
+def _chunks(sequence):
+    """
+    Split a sequence into lists of at most L{_CHUNK_SIZE} elements.
+    """
+    for i in xrange(0, len(sequence), _CHUNK_SIZE):
+        yield sequence[i:i + _CHUNK_SIZE]
+
+
+
+def loadItems(store, storeIDs, default=_noItem):
+    """
+    Load the items with the given storeIDs.
+
+    Items which are already in memory are not loaded again.  The types of the
+    rest are found with one query per few hundred items, and then the items
+    of each type are loaded with one query per few hundred items.  Items
+    whose stored schema version is not the current one are loaded by
+    L{axiom.store.Store.getItemByID}, which upgrades them.
+
+    @param store: the L{axiom.store.Store} to load the items from.
+
+    @param storeIDs: an iterable of C{int}s.
+
+    @param default: if passed, this is used in place of the items which do
+    not exist, rather than raising an exception.
+
+    @raise errors.ItemNotFound: if any of the items does not exist and no
+    C{default} was passed.
+
+    @return: a C{list} of the items, in the order of C{storeIDs}.
+    """
+    storeIDs = list(storeIDs)
+    found = {}
+    missing = []
+    for storeID in storeIDs:
+        if not isinstance(storeID, (int, long)):
+            raise TypeError("storeID *must* be an int or long, not %r" % (
+                    type(storeID).__name__,))
+        if storeID == STORE_SELF_ID:
+            found[storeID] = store
+            continue
+        try:
+            found[storeID] = store.objectCache.get(storeID)
+        except KeyError:
+            missing.append(storeID)
+    missing = list(set(missing))
+
+    byType = {}
+    slow = []
+    for chunk in _chunks(missing):
+        for (storeID, typeName, version) in store.querySchemaSQL(
+            _TYPEOF_MANY_QUERY % (', '.join(['?'] * len(chunk)),), chunk):
+            T = _typeNameToMostRecentClass.get(typeName)
+            if T is None or T.schemaVersion != version:
+                slow.append(storeID)
+            else:
+                byType.setdefault(T, []).append(storeID)
+
+    for (T, typeStoreIDs) in byType.iteritems():
+        for chunk in _chunks(typeStoreIDs):
+            for item in store.query(T, T.storeID.oneOf(chunk)):
+                found[item.storeID] = item
+
+    for storeID in slow:
+        found[storeID] = store.getItemByID(storeID, None)
+
+    items = []
+    for storeID in storeIDs:
+        item = found.get(storeID)
+        if item is None:
+            if default is _noItem:
+                raise errors.ItemNotFound(storeID)
+            item = default
+        items.append(item)
+    return items
@@ -0,0 +1,174 @@
+# -*- test-case-name: xmantissa.test.test_sitedispatch -*-
+
+"""
+Dispatching requests to the site root plugins of a store.
+
+L{xmantissa._webutil.SiteRootMixin.siteProduceResource} and
+L{xmantissa.web.UnguardedWrapper.locateChild} offer each request to the
+L{ISiteRootPlugin} or L{ISessionlessSiteRootPlugin} powerups of a store, in
+order of priority, until one of them produces a resource.  Most of these
+plugins only respond to URLs beneath a fixed prefix, which they declare with
+a C{prefixSegmentsFor} method (see
+L{xmantissa.website.PrefixURLMixin.prefixSegmentsFor}).  A L{SiteRootPlugins}
+keeps the powerups of one store for one interface, with the declared
+prefixes arranged in a trie, so that a request is only offered to the
+plugins whose prefixes it matches, and to those which declare no prefix.
+
+The powerups are found again only when the store may have changed, and the
+trie is built again only when the powerups installed for the interface, or
+their prefixes, have changed.
+"""
+
+from xmantissa._storechange import (
+    storeChangeToken, powerupsToken, inMemoryPowerup)
+
+
+
+class _PrefixTrie(object):
+    """
+    A node in a trie of URL segments.
+
+    @ivar entries: a C{list} of C{(order, plugin)} tuples for the plugins
+    whose prefix leads to this node.
+
+    @ivar children: a C{dict} mapping URL segments to L{_PrefixTrie}s.
+    """
+    def __init__(self):
+        self.entries = []
+        self.children = {}
+
+
+    def add(self, segments, entry):
+        """
+        Add C{entry} at the node which C{segments} lead to.
+        """
+        node = self
+        for segment in segments:
+            child = node.children.get(segment)
+            if child is None:
+                child = node.children[segment] = _PrefixTrie()
+            node = child
+        node.entries.append(entry)
+
+
+    def matching(self, segments):
+        """
+        Get the entries whose prefixes are prefixes of C{segments}.
+        """
+        entries = list(self.entries)
+        node = self
+        for segment in segments:
+            node = node.children.get(segment)
+            if node is None:
+                break
+            entries.extend(node.entries)
+        return entries
+
+
+
+class SiteRootPlugins(object):
+    """
+    The powerups of a store for L{ISiteRootPlugin} or
+    L{ISessionlessSiteRootPlugin}, arranged for quick dispatch.
+
+    @ivar store: the L{axiom.store.Store} the powerups are installed on.
+
+    @ivar interface: the interface they are installed for.
+
+    @ivar rebuilds: the number of times the powerups have been found and
+    arranged.
+    """
+    def __init__(self, store, interface):
+        self.store = store
+        self.interface = interface
+        self.rebuilds = 0
+        self._storeToken = None
+        self._powerupsToken = None
+        self._plugins = None
+        self._prefixes = None
+        self._dynamic = None
+        self._trie = None
+
+
+    def _prefixesOf(self, plugins):
+        """
+        Get the prefixes declared by C{plugins}, or C{None} for those which do
+        not declare one.
+        """
+        prefixes = []
+        for plugin in plugins:
+            prefixSegmentsFor = getattr(plugin, 'prefixSegmentsFor', None)
+            if prefixSegmentsFor is None:
+                prefixes.append(None)
+            else:
+                prefixes.append(prefixSegmentsFor(self.interface))
+        return prefixes
+
+
+    def _refresh(self):
+        """
+        Find and arrange the powerups again if they may have changed.
+        """
+        inMemory = inMemoryPowerup(self.store, self.interface)
+        storeToken = (storeChangeToken(self.store), inMemory)
+        if storeToken == self._storeToken:
+            return
+        token = powerupsToken(self.store, self.interface)
+        if (token == self._powerupsToken and
+            self._prefixesOf(self._plugins) == self._prefixes):
+            self._storeToken = storeToken
+            return
+
+        plugins = list(self.store.powerupsFor(self.interface))
+        prefixes = self._prefixesOf(plugins)
+        dynamic = []
+        trie = _PrefixTrie()
+        for (order, (plugin, prefix)) in enumerate(zip(plugins, prefixes)):
+            if prefix is None:
+                dynamic.append((order, plugin))
+            else:
+                trie.add(prefix, (order, plugin))
+        self._plugins = plugins
+        self._prefixes = prefixes
+        self._dynamic = dynamic
+        self._trie = trie
+        self._storeToken = storeToken
+        self._powerupsToken = token
+        self.rebuilds += 1
+
+
+    def pluginsFor(self, segments):
+        """
+        Get the plugins which may produce a resource for a request for
+        C{segments}, in the order they should be asked to.
+
+        @param segments: a C{tuple} of C{str}s, the segments of the request.
+
+        @return: a C{list} of the powerups.
+        """
+        self._refresh()
+        entries = self._dynamic + self._trie.matching(segments)
+        entries.sort()
+        return [plugin for (order, plugin) in entries]
+
+
+    def invalidate(self):
+        """
+        Find and arrange the powerups again the next time they are needed.
+        """
+        self._storeToken = self._powerupsToken = None
+
+
+
+def siteRootPlugins(store, interface):
+    """
+    Get the L{SiteRootPlugins} of a store for an interface, creating it if
+    necessary.
+    """
+    tables = getattr(store, '_siteRootPlugins', None)
+    if tables is None:
+        tables = store._siteRootPlugins = {}
+    plugins = tables.get(interface)
+    if plugins is None:
+        plugins = tables[interface] = SiteRootPlugins(store, interface)
+    return plugins
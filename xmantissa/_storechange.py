@@ -0,0 +1,69 @@
+# -*- test-case-name: xmantissa.test.test_storechange -*-
+
+"""
+Noticing when a store may have changed.
+
+Several of Mantissa's caches (scrolltable row counts and windows, the rows of
+a L{xmantissa.tdb.TabularDataModel}, site root plugin dispatch and the domain
+index) keep a result for as long as nothing in its store has been written.
+Axiom offers no notification of writes, so they compare L{storeChangeToken}
+instead.  L{powerupsToken} narrows this down to the powerups of a store for
+one interface, for caches of powerups (site root plugin dispatch and the
+merged navigation of L{xmantissa.webnav}).
+"""
+
+from twisted.python.reflect import qual
+
+from axiom.item import _PowerupConnector
+
+
+
+def storeChangeToken(store):
+    """
+    Get a value which is different whenever anything in a store may have
+    changed.
+
+    This is SQLite's count of the rows written by the store's own connection,
+    along with its data version, which changes whenever another connection
+    commits.  Both are cheap to ask for, so results which are expensive to
+    compute can be kept for as long as it stays the same.
+    """
+    [(changes,)] = store.querySQL('SELECT total_changes()')
+    [(version,)] = store.querySQL('PRAGMA data_version')
+    return (changes, version)
+
+
+
+def powerupsToken(store, interface):
+    """
+    Get a value which is different whenever the powerups of a store for an
+    interface, or their order, may have changed.
+
+    This is the powerup connectors for the interface, found with a single
+    query, along with the powerup installed in memory for it, if any.  Axiom
+    offers no public way to ask for either, so this reads its private
+    connector table and, through L{inMemoryPowerup}, its in-memory powerups.
+    """
+    pc = _PowerupConnector
+    connectors = tuple(store.querySQL(
+        'SELECT %s, %s FROM %s WHERE %s = ? AND %s = ? '
+        'ORDER BY %s DESC, %s' % (
+            pc.storeID.getColumnName(store),
+            pc.powerup.getColumnName(store),
+            store.getTableName(pc),
+            pc.interface.getColumnName(store),
+            pc.item.getColumnName(store),
+            pc.priority.getColumnName(store),
+            pc.storeID.getColumnName(store)),
+        [unicode(qual(interface)), store.storeID]))
+    return (connectors, inMemoryPowerup(store, interface))
+
+
+
+def inMemoryPowerup(store, interface):
+    """
+    Get the powerup installed on a store for an interface with
+    C{inMemoryPowerUp}, or C{None}.  Such powerups are not in the database,
+    so L{storeChangeToken} does not change when one is installed.
+    """
+    return store._inMemoryPowerups.get(interface)
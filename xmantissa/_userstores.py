@@ -0,0 +1,187 @@
+# -*- test-case-name: xmantissa.test.test_userstores -*-
+
+"""
+A cache of open user stores, keyed by the username used to find them.
+
+Locating a user's store by username means querying the site store for a
+L{LoginMethod} and then opening the store of its account.  Axiom only keeps a
+user store open for as long as something refers to it, so code which looks up
+a user store for every message or request will usually open it from scratch
+each time.  L{UserStoreCache} keeps the most recently used user stores of a
+site store open, and remembers which L{LoginMethod} each username resolved to.
+
+An entry is discarded as soon as the L{LoginMethod} it was found through no
+longer matches its username, or has been deleted, or its account has been
+deleted or given a different store, or disabled if the username has a
+domain.  Changes which bypass the
+in-memory items (for example, bulk deletes with
+L{axiom.store.ItemQuery.deleteFromStore}) should be followed by a call to
+L{UserStoreCache.invalidate}.
+"""
+
+import time
+
+from collections import OrderedDict
+
+from twisted.python import log
+
+from axiom.iaxiom import IStatEvent
+from axiom.attributes import AND
+from axiom.userbase import LoginAccount, LoginMethod
+
+
+
+class UserStoreCache(object):
+    """
+    A least-recently-used cache of the open user stores of one site store.
+
+    @ivar maximumSize: the number of user stores to keep open.  When another
+    one is opened, the one which was used the longest time ago is dropped.
+
+    @ivar idleTimeout: the number of seconds after which a user store which
+    has not been used is dropped.
+
+    @ivar hits: the number of lookups which were answered from this cache.
+
+    @ivar misses: the number of lookups which had to query the site store.
+    """
+    maximumSize = 100
+    idleTimeout = 5 * 60
+
+    def __init__(self, siteStore, maximumSize=None, idleTimeout=None,
+                 now=time.time):
+        """
+        @param siteStore: the L{axiom.store.Store} whose user stores to cache.
+
+        @param now: a zero-argument callable returning the current time in
+        seconds.
+        """
+        self.siteStore = siteStore
+        if maximumSize is not None:
+            self.maximumSize = maximumSize
+        if idleTimeout is not None:
+            self.idleTimeout = idleTimeout
+        self.now = now
+        self.hits = self.misses = 0
+        # Maps (localpart, domain) to (loginMethod, avatars, store, lastUsed),
+        # least recently used first.
+        self._entries = OrderedDict()
+
+
+    def _matches(self, entry, localpart, domain):
+        """
+        Determine whether a cached entry is still the result of looking up
+        C{localpart} and C{domain}.
+        """
+        loginMethod, avatars, store, lastUsed = entry
+        if loginMethod.store is None or loginMethod.localpart != localpart:
+            return False
+        if domain is None:
+            if not loginMethod.internal:
+                return False
+        elif loginMethod.domain != domain:
+            return False
+        account = loginMethod.account
+        if account is None or account.store is None:
+            return False
+        if domain is not None and account.disabled:
+            return False
+        return account.avatars is avatars
+
+
+    def _findLoginMethod(self, localpart, domain):
+        """
+        Query the site store for the L{LoginMethod} of the account with the
+        given username, as described by L{open}.
+        """
+        if domain is None:
+            return self.siteStore.findUnique(
+                LoginMethod,
+                AND(LoginMethod.localpart == localpart,
+                    LoginMethod.internal == True),
+                default=None)
+        return self.siteStore.findFirst(
+            LoginMethod,
+            AND(LoginMethod.localpart == localpart,
+                LoginMethod.domain == domain,
+                LoginMethod.account == LoginAccount.storeID,
+                LoginAccount.disabled == 0),
+            default=None)
+
+
+    def open(self, localpart, domain=None):
+        """
+        Find and open the store of the account with the given username.
+
+        @type localpart: C{unicode}
+
+        @param domain: the domain of the username, or C{None} to look only at
+        internal L{LoginMethod}s, whatever their domain.
+        @type domain: C{unicode} or C{None}
+
+        @return: an L{axiom.store.Store}, or C{None} if there is no such
+        account.  With a domain, this is the store of the first enabled
+        account with the username, like
+        L{axiom.userbase.LoginSystem.accountByAddress}.  Without one, it is
+        the store of the only internal L{LoginMethod} with the localpart,
+        whether or not its account is disabled.
+
+        @raise axiom.errors.DuplicateUniqueItem: if C{domain} is C{None} and
+        several internal L{LoginMethod}s have the localpart.
+        """
+        now = self.now()
+        self._evictIdle(now)
+        key = (localpart, domain)
+        entry = self._entries.pop(key, None)
+        if entry is not None and self._matches(entry, localpart, domain):
+            loginMethod, avatars, store, lastUsed = entry
+            self._entries[key] = (loginMethod, avatars, store, now)
+            self.hits += 1
+            log.msg(interface=IStatEvent, stat_user_store_cache_hits=1)
+            return store
+        self.misses += 1
+        log.msg(interface=IStatEvent, stat_user_store_cache_misses=1)
+        loginMethod = self._findLoginMethod(localpart, domain)
+        if loginMethod is None:
+            return None
+        avatars = loginMethod.account.avatars
+        store = avatars.open()
+        if len(self._entries) >= self.maximumSize:
+            self._entries.popitem(last=False)
+        self._entries[key] = (loginMethod, avatars, store, now)
+        return store
+
+
+    def _evictIdle(self, now):
+        """
+        Drop the user stores which have not been used for C{idleTimeout}
+        seconds.
+        """
+        while self._entries:
+            key, (loginMethod, avatars, store, lastUsed) = (
+                self._entries.iteritems().next())
+            if now - lastUsed < self.idleTimeout:
+                break
+            del self._entries[key]
+
+
+    def invalidate(self):
+        """
+        Drop every user store in this cache.
+        """
+        self._entries.clear()
+
+
+
+def userStoreCache(siteStore):
+    """
+    Get the L{UserStoreCache} of a site store, creating it if necessary.
+
+    The cache is kept on the site store itself, rather than in a weak mapping,
+    because the user stores in it refer to the site store as their parent and
+    would otherwise keep it alive forever.
+    """
+    cache = getattr(siteStore, '_userStoreCache', None)
+    if cache is None:
+        cache = siteStore._userStoreCache = UserStoreCache(siteStore)
+    return cache
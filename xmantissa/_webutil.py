@@ -11,8 +11,6 @@ from twisted.cred.portal import IRealm
 
 from epsilon.structlike import record
 
-from axiom.userbase import getDomainNames
-
 from nevow import athena
 from nevow.rend import NotFound
 from nevow.inevow import IResource, IRequest
@@ -23,6 +21,8 @@ from xmantissa.ixmantissa import (IWebViewer, INavigableFragment,
 from xmantissa.websharing import UserIndexPage
 
 from xmantissa.error import CouldNotLoadFromThemes
+from xmantissa._sitedispatch import siteRootPlugins
+from xmantissa._domainindex import domainIndex
 
 
 class WebViewerHelper(object):
@@ -162,7 +162,8 @@ class SiteRootMixin(object):
             if res is not None:
                 return res, segments[1:]
 
-        for plg in self.store.powerupsFor(ISiteRootPlugin):
+        for plg in siteRootPlugins(
+            self.store, ISiteRootPlugin).pluginsFor(segments):
             produceResource = getattr(plg, 'produceResource', None)
             if produceResource is not None:
                 childAndSegments = produceResource(req, segments, webViewer)
@@ -219,11 +220,10 @@ class VirtualHostWrapper(record('siteStore webViewer wrapped')):
             C{None} if the domain is not a subdomain of any known domain.
         """
         hostname = hostname.split(":")[0]
-        for domain in getDomainNames(self.siteStore):
-            if hostname.endswith("." + domain):
-                username = hostname[:-len(domain) - 1]
-                if username != "www":
-                    return username, domain
+        domains = domainIndex(self.siteStore)
+        for (username, domain) in domains.matches(hostname):
+            if username is not None and username != "www":
+                return username, domain
         return None
 
 
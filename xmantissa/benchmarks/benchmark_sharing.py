@@ -0,0 +1,88 @@
+"""
+Access attributes of an item through a L{SharedProxy} a fixed number of times.
+
+Run this against two revisions to compare the attribute-access throughput of
+shared proxies.
+"""
+
+from zope.interface import Interface, Attribute, implements
+
+from epsilon.scripts import benchmark
+
+from axiom import store, item, attributes
+
+from xmantissa import sharing
+
+
+class IFirst(Interface):
+    def first():
+        pass
+
+    def second():
+        pass
+
+    def third():
+        pass
+
+
+
+class ISecond(Interface):
+    def fourth():
+        pass
+
+    def fifth():
+        pass
+
+    def sixth():
+        pass
+
+
+
+class IThird(Interface):
+    value = Attribute("A value.")
+
+
+
+class Thing(item.Item):
+    implements(IFirst, ISecond, IThird)
+
+    value = attributes.integer(default=0)
+
+    def first(self):
+        pass
+
+    def second(self):
+        pass
+
+    def third(self):
+        pass
+
+    def fourth(self):
+        pass
+
+    def fifth(self):
+        pass
+
+    def sixth(self):
+        pass
+
+
+
+def main():
+    s = store.Store()
+    role = sharing.getEveryoneRole(s)
+    role.shareItem(Thing(store=s), shareID=u'thing',
+                   interfaces=[IFirst, ISecond, IThird])
+    proxy = role.getShare(u'thing')
+
+    benchmark.start()
+    for i in xrange(100000):
+        proxy.first
+        proxy.fourth
+        proxy.value
+    benchmark.stop()
+
+
+
+if __name__ == '__main__':
+    main()
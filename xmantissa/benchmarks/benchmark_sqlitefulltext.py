@@ -0,0 +1,56 @@
+"""
+Fulltext index a message a fixed number of times with SQLite FTS via the
+Mantissa fulltext indexing API.
+"""
+
+import sys
+
+from zope.interface import implements
+
+from epsilon.scripts import benchmark
+
+from axiom import store
+
+from xmantissa import ixmantissa, fulltext
+
+
+class Message(object):
+    implements(ixmantissa.IFulltextIndexable)
+
+    def uniqueIdentifier(self):
+        return str(id(self))
+
+
+    def textParts(self):
+        return [
+            u"Hello, how are you.  Please to be "
+            u"seeing this message as an indexer test." * 100]
+
+
+    def keywordParts(self):
+            return {u'foo': u"A Keyword"}
+
+
+    def documentType(self):
+        return u'message'
+
+
+    def sortKey(self):
+        return u''
+
+def main(batchSize=100):
+    s = store.Store("sqlite.axiom")
+    indexer = fulltext.SQLiteIndexer(store=s, batchSize=batchSize)
+
+    benchmark.start()
+    writer = indexer.openWriteIndex()
+    messages = [Message() for i in xrange(10000)]
+    for message in messages:
+        writer.add(message)
+    writer.close()
+    benchmark.stop()
+
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
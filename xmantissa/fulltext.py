@@ -4,7 +4,7 @@
 General functionality re-usable by various concrete fulltext indexing systems.
 """
 
-import atexit, os, weakref, warnings
+import atexit, os, re, weakref, warnings
 
 from zope.interface import implements
 
@@ -17,6 +17,7 @@ from epsilon.view import SlicedView
 from axiom import item, attributes, iaxiom, batch
 from axiom.upgrade import registerUpgrader, registerAttributeCopyingUpgrader
 from axiom.store import Store, AttributeQuery
+from axiom.errors import SQLError
 from axiom.attributes import AttributeValueComparison, SimpleOrdering
 
 from xmantissa import ixmantissa
@@ -53,7 +54,8 @@ class _IndexerInputSource(item.Item):
 class _RemoveDocument(item.Item):
     """
     Tracks a document deletion which should occur before the next search is
-    performed.
+    performed.  Searches of indexes which are not suspended for searching
+    leave the document out of their results until the deletion has been done.
     """
     indexer = attributes.reference(doc="""
     The indexer item with which this deletion is associated.
@@ -66,6 +68,43 @@ class _RemoveDocument(item.Item):
 
 
 
+class _PendingDocument(item.Item):
+    """
+    Tracks an item which the batch process has given to an indexer's write
+    index, but which the index has buffered rather than written.  If the
+    process exits before the buffered documents are written, the items are
+    given to the next write index the indexer opens, so that the batch
+    processor having moved past them does not leave them out of the index.
+    """
+    indexer = attributes.reference(doc="""
+    The indexer which was given the item.
+    """, whenDeleted=attributes.reference.CASCADE, allowNone=False)
+
+    item = attributes.reference(doc="""
+    The item whose document has not yet been written.
+    """, whenDeleted=attributes.reference.CASCADE, allowNone=False)
+
+
+
+class _IndexerGeneration(item.Item):
+    """
+    Counts the changes made to the documents of an indexer, so that results
+    of searching it which have been cached can be recognized as out of date.
+
+    Documents are added by the batch process and removed by any process, so
+    the count is incremented in SQL rather than through this item, whose
+    in-memory value may be out of date; see L{RemoteIndexer.generation}.
+    """
+    indexer = attributes.reference(doc="""
+    The indexer whose changes are counted.
+    """, whenDeleted=attributes.reference.CASCADE, allowNone=False)
+
+    generation = attributes.integer(doc="""
+    The number of changes.
+    """, default=0, allowNone=False)
+
+
+
 class RemoteIndexer(object):
     """
     Implements most of a full-text indexer.
@@ -99,6 +138,19 @@ class RemoteIndexer(object):
         raise NotImplementedError
 
 
+    def openSnapshotIndex(self):
+        """
+        Return an object usable to search this index while documents are
+        being added to it by the batch process, or C{None} if the index does
+        not support this, in which case the batch process is suspended for
+        each search.  The object belongs to the indexer, and is not closed
+        after searching it.
+
+        Subclasses may override this.
+        """
+        return None
+
+
     def __finalizer__(self):
         d = self.__dict__
         id = self.storeID
@@ -131,10 +183,56 @@ class RemoteIndexer(object):
         return self.store.query(_IndexerInputSource, _IndexerInputSource.indexer == self).getColumn("source")
 
 
+    def generation(self):
+        """
+        Get a number which changes whenever documents are added to or removed
+        from this index, or it is reset.
+
+        @rtype: C{int}
+        """
+        return sum(self.store.query(
+                _IndexerGeneration,
+                _IndexerGeneration.indexer == self).getColumn("generation"))
+
+
+    def _bumpGeneration(self):
+        """
+        Change the number returned by L{generation}.
+        """
+        self.store.executeSQL(
+            'UPDATE %s SET %s = %s + 1 WHERE %s = ?' % (
+                self.store.getTableName(_IndexerGeneration),
+                _IndexerGeneration.generation.getShortColumnName(self.store),
+                _IndexerGeneration.generation.getShortColumnName(self.store),
+                _IndexerGeneration.indexer.getShortColumnName(self.store)),
+            [self.storeID])
+        [(changed,)] = self.store.querySQL('SELECT changes()')
+        if not changed:
+            _IndexerGeneration(store=self.store, indexer=self, generation=1)
+
+
+    def _bufferedDocuments(self):
+        """
+        Get the number of documents which the write index has been given but
+        has not yet written, which is always zero for indexes which do not
+        buffer documents.  Those which do have a C{buffered} method returning
+        this number.
+        """
+        if self._index is None:
+            return 0
+        buffered = getattr(self._index, 'buffered', None)
+        if buffered is None:
+            return 0
+        return buffered()
+
+
     def reset(self):
         """
         Process everything all over again.
         """
+        self._bumpGeneration()
+        self.store.query(
+            _PendingDocument, _PendingDocument.indexer == self).deleteFromStore()
         self.indexCount = 0
         indexDir = self.store.newDirectory(self.indexDirectory)
         if indexDir.exists():
@@ -150,8 +248,11 @@ class RemoteIndexer(object):
         if self._index is not None:
             if VERBOSE:
                 log.msg("%s/%d *really* closing index" % (self.store, self.storeID))
+            buffered = self._bufferedDocuments()
             self._index.close()
             self._index = None
+            if buffered:
+                self._documentsWritten()
 
 
     # IFulltextIndexer
@@ -165,11 +266,54 @@ class RemoteIndexer(object):
 
             if VERBOSE:
                 log.msg("Opened %s %s/%d for writing" % (self._index, self.store, self.storeID))
+            self._addPendingDocuments()
 
         if VERBOSE:
             log.msg("%s/%d indexing document" % (self.store, self.storeID))
         self._index.add(ixmantissa.IFulltextIndexable(item))
         self.indexCount += 1
+        self._documentAdded(item)
+
+
+    def _documentAdded(self, item):
+        """
+        Note that the document for C{item} has been given to the write index,
+        which may have buffered it or written it.
+        """
+        if self._bufferedDocuments():
+            _PendingDocument(store=self.store, indexer=self, item=item)
+        else:
+            self._documentsWritten()
+
+
+    def _documentsWritten(self):
+        """
+        Note that the write index has written every document it was given.
+        Searches can only see a document once it has been written, so the
+        generation changes when a whole batch is, not before.
+        """
+        self.store.query(
+            _PendingDocument, _PendingDocument.indexer == self).deleteFromStore()
+        self._bumpGeneration()
+
+
+    def _addPendingDocuments(self):
+        """
+        Give the write index which has just been opened the documents which
+        an earlier one buffered but may not have written.
+        """
+        query = self.store.query(
+            _PendingDocument, _PendingDocument.indexer == self)
+        items = list(query.getColumn("item"))
+        if not items:
+            return
+        if VERBOSE:
+            log.msg("%s/%d indexing %d pending documents" % (
+                    self.store, self.storeID, len(items)))
+        query.deleteFromStore()
+        for item in items:
+            self._index.add(ixmantissa.IFulltextIndexable(item))
+            self._documentAdded(item)
 
 
     def remove(self, item):
@@ -179,6 +323,7 @@ class RemoteIndexer(object):
         _RemoveDocument(store=self.store,
                         indexer=self,
                         documentIdentifier=identifier)
+        self._bumpGeneration()
 
 
 
@@ -198,12 +343,24 @@ class RemoteIndexer(object):
         remove.deleteFromStore()
 
 
+    def _applyRemovals(self):
+        """
+        Write any documents the write index has buffered and then remove the
+        documents which are pending removal.  This is run in the batch process
+        when a search of a snapshot index finds that there are removals to be
+        done.
+        """
+        # Close the index first, so that any documents it has buffered are
+        # written before pending deletes are processed.
+        self._closeIndex()
+        self._flush()
+
+
     # IReliableListener
     def suspend(self):
-        self._flush() # Make sure any pending deletes are processed.
         if VERBOSE:
             log.msg("%s/%d suspending" % (self.store, self.storeID))
-        self._closeIndex()
+        self._applyRemovals() # Make sure any pending deletes are processed.
         return defer.succeed(None)
 
 
@@ -217,9 +374,84 @@ class RemoteIndexer(object):
         return self.add(item)
 
 
-    # ISearchProvider
-    def search(self, aString, keywords=None, count=None, offset=0,
-               sortAscending=True, retry=3):
+    def _searchIndex(self, idx, aString, keywords, count, offset,
+                     sortAscending, removed=()):
+        """
+        Search an open index and slice the results.
+
+        @param removed: the identifiers of documents which should be left out
+        of the results because they are pending removal from the index.
+        @type removed: C{set} of C{str}
+        """
+        ident = "%s/%d" % (self.store, self.storeID)
+        if VERBOSE:
+            log.msg("%s searching for %s" % (
+                ident, aString.encode('utf-8')))
+        results = idx.search(aString, keywords, sortAscending)
+        if VERBOSE:
+            log.msg("%s found %d results" % (ident, len(results)))
+
+        if count is None:
+            end = None
+        else:
+            end = offset + count
+
+        if removed:
+            # Removed documents may be anywhere before the end of the slice,
+            # so take enough extra results to make up for all of them.
+            if end is None:
+                results = results[:]
+            else:
+                results = results[:end + len(removed)]
+            results = [result for result in results
+                       if str(result.uniqueIdentifier) not in removed]
+
+        results = results[offset:end]
+
+        if VERBOSE:
+            log.msg("%s sliced from %s to %s, leaving %d results" % (
+                    ident, offset, end, len(results)))
+        return results
+
+
+    def _countIndex(self, idx, aString, keywords, removed=()):
+        """
+        Count the results of searching an open index.
+
+        @param removed: the identifiers of documents which should not be
+        counted because they are pending removal from the index.
+        @type removed: C{set} of C{str}
+        """
+        results = idx.search(aString, keywords)
+        if removed:
+            return len([result for result in results
+                        if str(result.uniqueIdentifier) not in removed])
+        return len(results)
+
+
+    def _searchSnapshot(self, idx, f):
+        """
+        Call C{f} with an index returned by L{openSnapshotIndex} and the
+        identifiers of the documents which are pending removal, asking the
+        batch process to remove them.
+        """
+        removed = set(self.store.query(
+                _RemoveDocument,
+                _RemoveDocument.indexer == self).getColumn(
+                "documentIdentifier"))
+        results = f(idx, removed)
+        if removed:
+            b = iaxiom.IBatchService(self.store)
+            b.call(self._applyRemovals).addErrback(log.err)
+        return results
+
+
+    def _searchSuspended(self, f):
+        """
+        Suspend the batch process, call C{f} with an index open for reading
+        and an empty set of pending removals, and then resume the batch
+        process.
+        """
         ident = "%s/%d" % (self.store, self.storeID)
         b = iaxiom.IBatchService(self.store)
         if VERBOSE:
@@ -230,25 +462,7 @@ class RemoteIndexer(object):
             if VERBOSE:
                 log.msg("%s getting reader index" % (ident,))
             idx = self.openReadIndex()
-
-            if VERBOSE:
-                log.msg("%s searching for %s" % (
-                    ident, aString.encode('utf-8')))
-            results = idx.search(aString, keywords, sortAscending)
-            if VERBOSE:
-                log.msg("%s found %d results" % (ident, len(results)))
-
-            if count is None:
-                end = None
-            else:
-                end = offset + count
-
-            results = results[offset:end]
-
-            if VERBOSE:
-                log.msg("%s sliced from %s to %s, leaving %d results" % (
-                        ident, offset, end, len(results)))
-            return results
+            return f(idx, set())
 
         d.addCallback(reallySearch)
 
@@ -258,21 +472,72 @@ class RemoteIndexer(object):
             b.resume(self.storeID).addErrback(log.err)
             return results
         d.addBoth(resumeIndexing)
+        return d
+
+
+    def _search(self, f, failed, retry):
+        """
+        Call C{f} with an index which can be searched and the identifiers of
+        documents which should be left out of its results.
+
+        If L{openSnapshotIndex} returns an index, it is searched while the
+        batch process goes on indexing; otherwise the batch process is
+        suspended for the duration of the search, so that the index is not
+        changed while it is being read.
+
+        @param failed: the result to give if searching fails C{retry} more
+        times.
+
+        @return: a L{Deferred} which fires with the result of C{f}.
+        """
+        ident = "%s/%d" % (self.store, self.storeID)
+        snapshot = self.openSnapshotIndex()
+        if snapshot is not None:
+            if VERBOSE:
+                log.msg("%s searching snapshot" % (ident,))
+            d = defer.maybeDeferred(self._searchSnapshot, snapshot, f)
+        else:
+            d = self._searchSuspended(f)
 
         def searchFailed(err):
             log.msg("Search failed somehow:")
             log.err(err)
             if retry:
                 log.msg("Re-issuing search")
-                return self.search(aString, keywords, count, offset, retry=retry-1)
+                return self._search(f, failed, retry - 1)
             else:
                 log.msg("Wow, lots of failures searching.  Giving up and "
                         "returning (probably wrong!) no results to user.")
-                return []
+                return failed
         d.addErrback(searchFailed)
         return d
 
 
+    # ISearchProvider
+    def count(self, aString, keywords=None):
+        """
+        Count the documents which match a search of this index.
+
+        @return: a L{Deferred} which fires with an C{int}.
+        """
+        return self._search(
+            lambda idx, removed: self._countIndex(
+                idx, aString, keywords, removed),
+            0, 3)
+
+
+    def search(self, aString, keywords=None, count=None, offset=0,
+               sortAscending=True, retry=3):
+        """
+        Search this index.
+        """
+        return self._search(
+            lambda idx, removed: self._searchIndex(
+                idx, aString, keywords, count, offset, sortAscending,
+                removed),
+            [], retry)
+
+
 
 try:
     import hype
@@ -753,105 +1018,447 @@ registerUpgrader(pyLuceneIndexer4to5, PyLuceneIndexer.typeName, 4, 5)
 class _SQLiteResultWrapper(object):
     """
     Trivial wrapper around SQLite FTS search results.
+
+    @ivar uniqueIdentifier: the identifier of the document which matched.
+
+    @ivar documentType: the L{IFulltextIndexable.documentType} of the
+    document.
+
+    @ivar sortKey: the L{IFulltextIndexable.sortKey} of the document.
+
+    @ivar score: the bm25 rank of the document for the search, lower being a
+    better match, or C{None} if the index does not support ranking.
+
+    @ivar snippet: a fragment of the text of the document around the terms it
+    matched, or C{None} if the search was for keywords only.
     """
-    def __init__(self, docId):
+    def __init__(self, docId, documentType=None, sortKey=None, score=None,
+                 snippet=None):
         self.uniqueIdentifier = docId
+        self.documentType = documentType
+        self.sortKey = sortKey
+        self.score = score
+        self.snippet = snippet
 
 
 
-class _SQLiteIndex(object):
+def _ftsPhrases(text):
     """
-    FTS3 index interface.
+    Split some text into a list of FTS5 query phrases, one for each word,
+    quoted so that no character of the text has any special meaning to the
+    FTS5 query parser.
     """
+    return [u'"' + word.replace(u'"', u'""') + u'"' for word in text.split()]
+
+
+
+_fts4Token = re.compile(r'[^\W_]+', re.UNICODE)
 
-    addSQL = """
-    INSERT INTO fts (docid, content) VALUES (?, ?)
+def _fts4Terms(text):
     """
+    Split some text into a list of FTS4 query terms, roughly as the FTS4
+    simple tokenizer would.  FTS4 does not allow a column filter to be
+    applied to a quoted phrase, so the terms are left unquoted, which is safe
+    because they contain no punctuation; the only words with any special
+    meaning, the uppercase operators, are lowercased.
+    """
+    terms = []
+    for term in _fts4Token.findall(text):
+        if term in (u'AND', u'OR', u'NOT', u'NEAR'):
+            term = term.lower()
+        terms.append(term)
+    return terms
 
-    removeSQL = """
-    DELETE FROM fts WHERE docid = ?
+
+
+def _sortKeyValue(sortKey):
+    """
+    Convert a sort key into the value to store for it.  Like Lucene's
+    automatic sort field type, keys which are integers sort as integers.
+    """
+    try:
+        return int(sortKey)
+    except ValueError:
+        return sortKey
+
+
+
+class _SQLiteResults(object):
+    """
+    The lazily evaluated results of a search of a L{_SQLiteIndex}.  Slicing
+    this runs a query with the slice's bounds as its LIMIT and OFFSET, so only
+    the requested results are ever loaded.
+    """
+    def __init__(self, index, match, hasTerm, sortAscending):
+        self.index = index
+        self.match = match
+        self.hasTerm = hasTerm
+        self.sortAscending = sortAscending
+
+
+    def __len__(self):
+        [(count,)] = self.index.store.querySQL(
+            'SELECT COUNT(*) FROM fts WHERE fts MATCH ?', (self.match,))
+        return count
+
+
+    def _fetch(self, limit, offset):
+        """
+        Retrieve C{limit} results, or all of them if C{limit} is C{None},
+        starting at C{offset}.
+        """
+        if limit is None:
+            limit = -1
+        return [_SQLiteResultWrapper(*row) for row in
+                self.index.store.querySQL(
+                    self.index.searchSQL(self.hasTerm, self.sortAscending),
+                    (self.match, limit, offset))]
+
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.start, index.stop, index.step
+            if (step is not None or (start is not None and start < 0) or
+                (stop is not None and stop < 0)):
+                return self[:][index]
+            start = start or 0
+            if stop is None:
+                return self._fetch(None, start)
+            return self._fetch(max(stop - start, 0), start)
+        if index < 0:
+            return self[:][index]
+        results = self._fetch(1, index)
+        if not results:
+            raise IndexError(index)
+        return results[0]
+
+
+    def __iter__(self):
+        return iter(self[:])
+
+
+
+def _ftsTableSQL(module, table, keywordColumns):
     """
+    Generate the statement which creates the FTS table of a L{_SQLiteIndex}.
 
-    searchSQL = """
-    SELECT docid
-    FROM fts
-    WHERE content MATCH ?
-    ORDER BY docid %s
+    @param module: C{'fts5'} or C{'fts4'}.
+    @param table: the name of the table to create.
+    @param keywordColumns: a C{list} of the names of the keyword columns.
     """
+    columns = ['content', 'documentType'] + keywordColumns
+    if module == 'fts5':
+        columns.append('sortKey UNINDEXED')
+    else:
+        columns.extend(['sortKey', 'notindexed=sortKey'])
+    return 'CREATE VIRTUAL TABLE %s USING %s(%s)' % (
+        table, module, ', '.join(columns))
+
 
-    def __init__(self, store):
+
+class _SQLiteIndex(object):
+    """
+    SQLite FTS5 index interface, which uses FTS4 if the SQLite library lacks
+    FTS5.
+
+    Documents are stored in a single FTS table with a column for their text,
+    their document type, their sort key, and each of the names of keywords
+    that have been indexed.  A new keyword name adds a column, which means
+    copying the table; this is rare, since most applications use a handful
+    of keyword names.
+
+    Documents passed to L{add} are buffered and written to the database
+    L{batchSize} at a time, each batch in a single transaction.  Any which are
+    still buffered are written before the index is searched, before a
+    document is removed from it, and when it is closed.  Writing a document
+    replaces any already in the database with the same identifier, so a
+    document can safely be written again.
+
+    @ivar batchSize: the number of documents to buffer before writing them.
+    @type batchSize: C{int}
+
+    @ivar module: the FTS module in use, C{'fts5'} or C{'fts4'}.
+
+    @ivar keywordColumns: a C{dict} mapping keyword names to the names of the
+    columns they are stored in.
+    """
+
+    removeSQL = """
+    DELETE FROM fts WHERE rowid = ?
+    """
+
+    def __init__(self, store, batchSize=1):
         self.store = store
-        self.close = self.store.close
+        self.batchSize = batchSize
+        self._pending = []
+        [(tableSQL,)] = store.querySQL(
+            "SELECT sql FROM sqlite_master WHERE name = 'fts'")
+        if 'fts5' in tableSQL.lower():
+            self.module = 'fts5'
+        else:
+            self.module = 'fts4'
+        self._loadKeywordColumns()
+
+
+    def _loadKeywordColumns(self):
+        """
+        Read the names of the keyword columns from the database into
+        C{keywordColumns}.
+        """
+        self.keywordColumns = {}
+        for (rowid, name) in self.store.querySQL(
+            'SELECT rowid, name FROM fts_columns'):
+            self.keywordColumns[name] = 'k%d' % (rowid,)
+
+
+    def _addKeywordColumns(self, names):
+        """
+        Add columns for the given keyword names to the FTS table, by copying
+        it to a new table which has them.  Must be run in a transaction.
+        """
+        oldColumns = sorted(self.keywordColumns.values())
+        for name in names:
+            rowid = self.store.executeSQL(
+                'INSERT INTO fts_columns (name) VALUES (?)', (name,))
+            self.keywordColumns[name] = 'k%d' % (rowid,)
+        newColumns = sorted(self.keywordColumns.values())
+        copied = ['rowid', 'content', 'documentType', 'sortKey'] + oldColumns
+        self.store.createSQL(_ftsTableSQL(self.module, 'fts_new', newColumns))
+        self.store.executeSQL(
+            'INSERT INTO fts_new (%s) SELECT %s FROM fts' % (
+                ', '.join(copied), ', '.join(copied)))
+        self.store.createSQL('DROP TABLE fts')
+        self.store.createSQL('ALTER TABLE fts_new RENAME TO fts')
 
 
     def add(self, document):
         """
         Add a document to the database.
         """
-        docid = int(document.uniqueIdentifier())
-        text = u' '.join(document.textParts())
+        self._pending.append(document)
+        if len(self._pending) >= self.batchSize:
+            self.flush()
+
+
+    def addMany(self, documents):
+        """
+        Add several documents to the database in a single transaction.
+        """
+        rows = []
+        names = set()
+        for document in documents:
+            keywords = document.keywordParts()
+            names.update(keywords)
+            rows.append((int(document.uniqueIdentifier()),
+                         u' '.join(document.textParts()),
+                         document.documentType(),
+                         _sortKeyValue(document.sortKey()),
+                         keywords))
+        def insert():
+            newNames = sorted(names.difference(self.keywordColumns))
+            if newNames:
+                self._addKeywordColumns(newNames)
+            columnNames = sorted(self.keywordColumns)
+            sql = 'INSERT OR REPLACE INTO fts (%s) VALUES (%s)' % (
+                ', '.join(['rowid', 'content', 'documentType', 'sortKey'] +
+                          [self.keywordColumns[name]
+                           for name in columnNames]),
+                ', '.join('?' * (4 + len(columnNames))))
+            # Store has no executemany, so use the cursor beneath it.  Its
+            # retrying when the database is locked is not needed, since the
+            # transaction began with BEGIN IMMEDIATE and so holds the lock.
+            self.store.cursor._cursor.executemany(
+                sql,
+                [[docid, text, documentType, sortKey] +
+                 [keywords.get(name) for name in columnNames]
+                 for (docid, text, documentType, sortKey, keywords) in rows])
+        self.store.transact(insert)
+
+
+    def buffered(self):
+        """
+        Get the number of documents which have been added but not yet written
+        to the database.
+        """
+        return len(self._pending)
+
 
-        self.store.executeSQL(self.addSQL, (docid, text))
+    def flush(self):
+        """
+        Write any buffered documents to the database.
+        """
+        pending, self._pending = self._pending, []
+        if pending:
+            self.addMany(pending)
+
+
+    def close(self):
+        """
+        Write any buffered documents to the database and close it.
+        """
+        self.flush()
+        self.store.close()
 
 
     def remove(self, docid):
         """
         Remove a document from the database.
         """
+        self.flush()
         docid = int(docid)
         self.store.executeSQL(self.removeSQL, (docid,))
 
 
-    def search(self, term, keywords=None, sortAscending=True):
+    def _columnFilter(self, column, text):
         """
-        Search the database.
+        Generate an FTS query expression matching documents which have all of
+        the words of C{text} in C{column}.
+        """
+        if self.module == 'fts5':
+            phrases = _ftsPhrases(text)
+            if not phrases:
+                return None
+            return u'%s : (%s)' % (column, u' '.join(phrases))
+        return u' '.join([u'%s:%s' % (column, term)
+                          for term in _fts4Terms(text)])
+
+
+    def searchSQL(self, hasTerm, sortAscending):
+        """
+        Generate the query which retrieves a page of search results.
         """
         if sortAscending:
             direction = 'ASC'
         else:
             direction = 'DESC'
+        if self.module == 'fts5':
+            score = 'bm25(fts)'
+            snippet = "snippet(fts, 0, '', '', '...', 16)"
+        else:
+            score = 'NULL'
+            snippet = "snippet(fts, '', '', '...', 0, 16)"
+        if not hasTerm:
+            snippet = 'NULL'
+        order = ['sortKey %s' % (direction,)]
+        if self.module == 'fts5':
+            order.append(score)
+        order.append('rowid %s' % (direction,))
+        return ('SELECT rowid, documentType, sortKey, %s, %s '
+                'FROM fts WHERE fts MATCH ? '
+                'ORDER BY %s '
+                'LIMIT ? OFFSET ?') % (score, snippet, ', '.join(order))
+
+
+    def search(self, term, keywords=None, sortAscending=True):
+        """
+        Search the database for documents with all of the words of C{term} in
+        their text and all of the words of each of C{keywords} in the keyword
+        of that name.
+
+        @return: a L{_SQLiteResults}, sorted by sort key, then by rank, then
+        by document identifier.
+        """
+        self.flush()
+        filters = []
+        if term:
+            filters.append(self._columnFilter('content', term))
+        for (name, value) in (keywords or {}).iteritems():
+            if name == 'documentType':
+                column = 'documentType'
+            else:
+                if name not in self.keywordColumns:
+                    # Another connection may have added the column since
+                    # this one was opened.
+                    self._loadKeywordColumns()
+                    if name not in self.keywordColumns:
+                        return []
+                column = self.keywordColumns[name]
+            filters.append(self._columnFilter(column, value))
+        filters = [f for f in filters if f]
+        if not filters:
+            return []
+        if self.module == 'fts5':
+            match = u' AND '.join(filters)
+        else:
+            match = u' '.join(filters)
+        return _SQLiteResults(self, match, bool(term), sortAscending)
+
 
-        return [_SQLiteResultWrapper(r[0]) for r in
-                self.store.querySQL(self.searchSQL % (direction,), (term,))]
+
+# The SQLite FTS modules which _SQLiteIndex can use, most preferred first.
+_FTS_MODULES = ['fts5', 'fts4']
+
+def _createSQLiteIndexSchema(store):
+    """
+    Create the tables of a L{_SQLiteIndex} in a new store, using the first of
+    L{_FTS_MODULES} which is available.
+    """
+    store.createSQL('CREATE TABLE fts_columns (name TEXT PRIMARY KEY)')
+    for module in _FTS_MODULES:
+        try:
+            store.createSQL(_ftsTableSQL(module, 'fts', []))
+        except SQLError:
+            continue
+        return module
+    raise SQLError(None, None, 'Neither FTS5 nor FTS4 is available')
 
 
 
 class SQLiteIndexer(RemoteIndexer, item.Item):
     """
-    Indexer implementation using SQLite FTS3.
+    Indexer implementation using SQLite FTS5, or FTS4 where FTS5 is not
+    available.
 
-    XXX: Keywords are currently not supported; see #2877
+    Keywords are indexed in columns of their own, and results are sorted by
+    sort key in the database, so that a slice of the results of a search only
+    loads the results in it.  Results found by FTS5 with equal sort keys are
+    ordered by their bm25 rank.
     """
+    schemaVersion = 2
+
     indexCount = attributes.integer(default=0)
     indexDirectory = attributes.text(default=u'sqlite.index')
 
+    batchSize = attributes.integer(doc="""
+    The number of documents which are buffered in memory and then added to the
+    index in a single transaction.  Raising this makes indexing, particularly
+    after L{reset}, much faster.  Buffered documents are tracked by
+    L{_PendingDocument}s, so those which are still buffered when the indexing
+    process exits are added to the index when it starts again.
+    """, default=1, allowNone=False)
+
     _index = attributes.inmemory()
 
-    schemaSQL = """
-    CREATE VIRTUAL TABLE fts
-    USING fts3(content)
-    """
+    # The index returned by openSnapshotIndex, and the inode number of its
+    # database file, or None.
+    _snapshotIndex = attributes.inmemory()
+
+    def activate(self):
+        RemoteIndexer.activate(self)
+        self._snapshotIndex = None
+
 
     def _getStore(self):
         """
         Get the Store used for FTS.
 
-        If it does not exist, it is created and initialised.
+        If it does not exist, it is created and initialised.  It is opened in
+        WAL mode, so that it can be read while it is being written to.
         """
         storeDir = self.store.newDirectory(self.indexDirectory)
         if not storeDir.exists():
-            store = Store(storeDir)
+            store = Store(storeDir, journalMode=u'WAL')
             self._initStore(store)
             return store
         else:
-            return Store(storeDir)
+            return Store(storeDir, journalMode=u'WAL')
 
 
     def _initStore(self, store):
         """
         Initialise a store for FTS use.
         """
-        store.createSQL('CREATE VIRTUAL TABLE fts USING fts3')
+        _createSQLiteIndexSchema(store)
 
 
     def openReadIndex(self):
@@ -859,4 +1466,53 @@ class SQLiteIndexer(RemoteIndexer, item.Item):
 
 
     def openWriteIndex(self):
-        return _SQLiteIndex(self._getStore())
+        return _SQLiteIndex(self._getStore(), self.batchSize)
+
+
+    def openSnapshotIndex(self):
+        """
+        Get an index open for reading, which is kept open between searches.
+        The index is in WAL mode, so each query sees the documents written to
+        it when the query began, and neither waits for nor blocks the batch
+        process writing to it.  If the index has been deleted and created
+        again since it was opened, by L{reset} in this or another process,
+        it is opened again.
+        """
+        dbfile = self.store.newDirectory(
+            self.indexDirectory).child('db.sqlite')
+        if self._snapshotIndex is not None:
+            # The open index keeps its file from being freed, so a new file
+            # cannot have the same inode number.
+            index, inode = self._snapshotIndex
+            if dbfile.exists() and dbfile.getInodeNumber() == inode:
+                return index
+            self._snapshotIndex = None
+            index.close()
+        index = self.openReadIndex()
+        dbfile.restat()
+        self._snapshotIndex = (index, dbfile.getInodeNumber())
+        return index
+
+
+
+item.declareLegacyItem(SQLiteIndexer.typeName, 1,
+                       dict(indexCount=attributes.integer(default=0),
+                            indexDirectory=attributes.text(
+                                default=u'sqlite.index')))
+
+
+
+def sqliteIndexer1to2(oldIndexer):
+    """
+    Upgrade an L{SQLiteIndexer} from an FTS3 index without keywords to an
+    FTS5 or FTS4 one with them, which means reindexing everything.  Documents
+    are not buffered until C{batchSize} is raised.
+    """
+    newIndexer = oldIndexer.upgradeVersion(
+        SQLiteIndexer.typeName, 1, 2,
+        indexCount=oldIndexer.indexCount,
+        indexDirectory=oldIndexer.indexDirectory)
+    newIndexer.reset()
+    return newIndexer
+
+registerUpgrader(sqliteIndexer1to2, SQLiteIndexer.typeName, 1, 2)
@@ -54,6 +54,8 @@ to be made without changing any of your application code, just the high-level
 routing glue.
 """
 
+import random
+
 from datetime import timedelta
 
 from zope.interface import implements
@@ -67,13 +69,14 @@ from epsilon.structlike import record
 
 from epsilon.expose import Exposer
 
-from axiom.iaxiom import IScheduler
+from axiom.iaxiom import IScheduler, IStatEvent
 from axiom.item import Item, declareLegacyItem
 from axiom.errors import UnsatisfiedRequirement
-from axiom.attributes import text, bytes, integer, AND, reference, inmemory
+from axiom.attributes import (
+    text, bytes, integer, timestamp, AND, OR, reference, inmemory)
 from axiom.dependency import dependsOn, requiresFromSite
 from axiom.userbase import LoginSystem, LoginMethod
-from axiom.upgrade import registerUpgrader
+from axiom.upgrade import registerUpgrader, registerAttributeCopyingUpgrader
 
 from xmantissa.ixmantissa import (
     IMessageRouter, IDeliveryConsequence, IMessageReceiver)
@@ -84,6 +87,7 @@ from xmantissa.error import (
 
 from xmantissa.sharing import getPrimaryRole, NoSuchShare, Identifier
 from xmantissa._recordattr import RecordAttribute, WithRecordAttributes
+from xmantissa._userstores import userStoreCache
 
 DELIVERY_ERROR = u'mantissa.delivery.error'
 
@@ -92,7 +96,37 @@ ERROR_NO_USER = 'no-user'
 ERROR_REMOTE_EXCEPTION = 'remote-exception'
 ERROR_BAD_SENDER = 'bad-sender'
 
+# The delay, in seconds, before the first retransmission of a message or
+# answer.  Each further retransmission waits twice as long as the one before
+# it, up to _MAXIMUM_RETRANSMIT_DELAY.
 _RETRANSMIT_DELAY = 120
+_MAXIMUM_RETRANSMIT_DELAY = 60 * 60
+
+# The largest fraction of a retransmission delay which is randomly added to it,
+# so that queues which failed at the same time do not all retry at once.
+_RETRANSMIT_JITTER = 0.1
+
+# The source of the randomness for _RETRANSMIT_JITTER; returns a float in
+# [0.0, 1.0).
+_jitter = random.random
+
+# The maximum number of messages for one account routed in a single call.
+_BATCH_SIZE = 100
+
+
+
+def _retransmitDelay(attempts):
+    """
+    Compute how long to wait before retransmitting a message or an answer.
+
+    @param attempts: the number of delivery attempts made so far.
+    @type attempts: C{int}
+
+    @return: a L{timedelta}.
+    """
+    delay = min(_RETRANSMIT_DELAY * 2 ** max(attempts - 1, 0),
+                _MAXIMUM_RETRANSMIT_DELAY)
+    return timedelta(seconds=delay * (1 + _RETRANSMIT_JITTER * _jitter()))
 
 
 
@@ -118,6 +152,7 @@ class _QueuedMessage(Item, WithRecordAttributes):
     This is a message, queued in the sender's store, awaiting delivery to the
     target.
     """
+    schemaVersion = 2
 
     senderUsername = text(
         """
@@ -189,6 +224,19 @@ class _QueuedMessage(Item, WithRecordAttributes):
         """, allowNone=True)
 
 
+    attempts = integer(
+        """
+        The number of times L{MessageQueue.run} has attempted to deliver this
+        message.
+        """, default=0, allowNone=False)
+
+    nextAttempt = timestamp(
+        """
+        The time at which L{MessageQueue.run} should next attempt to deliver
+        this message, or C{None} if it should do so the next time it runs.
+        """, indexed=True, default=None)
+
+
 
 class _FailedAnswer(Item, WithRecordAttributes):
     """
@@ -307,6 +355,7 @@ class _AlreadyAnswered(Item, WithRecordAttributes):
     pending delivery attempt.  This is L{None} if no delivery attempt is
     currently pending.
     """
+    schemaVersion = 2
 
     deliveryDeferred = inmemory()
 
@@ -400,6 +449,52 @@ class _AlreadyAnswered(Item, WithRecordAttributes):
     value = RecordAttribute(Value,
                                [answerType, answerData])
 
+    attempts = integer(
+        """
+        The number of times L{MessageQueue.run} has attempted to deliver this
+        answer.
+        """, default=0, allowNone=False)
+
+    nextAttempt = timestamp(
+        """
+        The time at which L{MessageQueue.run} should next attempt to deliver
+        this answer, or C{None} if it should do so the next time it runs.
+        """, indexed=True, default=None)
+
+
+
+# The text attributes of these items are passed their docstrings as their first
+# positional argument, caseSensitive, so they are all case sensitive.
+declareLegacyItem(
+    _QueuedMessage.typeName, 1,
+    dict(senderUsername=text(caseSensitive=True, allowNone=False),
+         senderDomain=text(caseSensitive=True, allowNone=False),
+         senderShareID=text(caseSensitive=True),
+         targetUsername=text(caseSensitive=True, allowNone=False),
+         targetDomain=text(caseSensitive=True, allowNone=False),
+         targetShareID=text(caseSensitive=True, allowNone=False),
+         messageType=text(caseSensitive=True, allowNone=False),
+         messageData=bytes(allowNone=False),
+         messageID=integer(allowNone=False),
+         consequence=reference(allowNone=True)))
+
+registerAttributeCopyingUpgrader(_QueuedMessage, 1, 2)
+
+
+declareLegacyItem(
+    _AlreadyAnswered.typeName, 1,
+    dict(originalSenderShareID=text(caseSensitive=True, allowNone=True),
+         originalSenderUsername=text(caseSensitive=True, allowNone=False),
+         originalSenderDomain=text(caseSensitive=True, allowNone=False),
+         originalTargetShareID=text(caseSensitive=True, allowNone=False),
+         originalTargetUsername=text(caseSensitive=True, allowNone=False),
+         originalTargetDomain=text(caseSensitive=True, allowNone=False),
+         messageID=integer(allowNone=False),
+         answerType=text(caseSensitive=True, allowNone=False),
+         answerData=bytes(allowNone=False)))
+
+registerAttributeCopyingUpgrader(_AlreadyAnswered, 1, 2)
+
 
 
 class _NullRouter(object):
@@ -439,17 +534,18 @@ class LocalMessageRouter(record("loginSystem")):
         """
         Locate an avatar by the username and domain portions of an
         L{Identifier}, so that we can deliver a message to the appropriate
-        user.
+        user.  Recently used user stores are kept open by the site store's
+        L{xmantissa._userstores.UserStoreCache}.
         """
-        acct = self.loginSystem.accountByAddress(identifier.localpart,
-                                                 identifier.domain)
-        return IMessageRouter(acct, None)
+        userStore = userStoreCache(self.loginSystem.store).open(
+            identifier.localpart, identifier.domain)
+        return IMessageRouter(userStore, None)
 
 
     def routeMessage(self, sender, target, value, messageID):
         """
         Implement L{IMessageRouter.routeMessage} by synchronously locating an
-        account via L{axiom.userbase.LoginSystem.accountByAddress}, and
+        account via L{_routerForAccount}, and
         delivering a message to it by calling a method on it.
         """
         router = self._routerForAccount(target)
@@ -462,10 +558,31 @@ class LocalMessageRouter(record("loginSystem")):
                                       messageID)
 
 
+    def routeMessages(self, messages):
+        """
+        Route several messages at once, locating each target account only
+        once.
+
+        @param messages: a C{list} of C{(sender, target, value, messageID)}
+        tuples, as would be passed to L{routeMessage}.
+        """
+        for batch in _groupByTargetAccount(messages):
+            target = batch[0][1]
+            router = self._routerForAccount(target)
+            if router is not None:
+                _routeMessages(router, batch)
+            else:
+                for (sender, target, value, messageID) in batch:
+                    reverseRouter = self._routerForAccount(sender)
+                    reverseRouter.routeAnswer(
+                        sender, target, Value(DELIVERY_ERROR, ERROR_NO_USER),
+                        messageID)
+
+
     def routeAnswer(self, originalSender, originalTarget, value, messageID):
         """
         Implement L{IMessageRouter.routeMessage} by synchronously locating an
-        account via L{axiom.userbase.LoginSystem.accountByAddress}, and
+        account via L{_routerForAccount}, and
         delivering a response to it by calling a method on it and returning a
         deferred containing its answer.
         """
@@ -475,6 +592,70 @@ class LocalMessageRouter(record("loginSystem")):
 
 
 
+def _groupByTargetAccount(messages, batchSize=_BATCH_SIZE):
+    """
+    Divide some messages into batches addressed to the same account.
+
+    @param messages: a C{list} of C{(sender, target, value, messageID)}
+    tuples.
+
+    @param batchSize: the maximum number of messages in a batch.
+
+    @return: a C{list} of non-empty C{list}s of those tuples.  Batches are in
+    the order their first message appeared in, and messages keep their
+    relative order within each batch.
+    """
+    batches = {}
+    order = []
+    for message in messages:
+        target = message[1]
+        key = (target.localpart, target.domain)
+        if key not in batches:
+            batches[key] = []
+            order.append(key)
+        batches[key].append(message)
+    result = []
+    for key in order:
+        batch = batches[key]
+        for i in range(0, len(batch), batchSize):
+            result.append(batch[i:i + batchSize])
+    return result
+
+
+
+def _answerKey(sender, messageID):
+    """
+    Get a hashable key identifying the answer to a message.
+
+    L{Identifier}s compare by value but hash by identity, so the identifier
+    of the sender is broken into its parts.
+
+    @param sender: the L{Identifier} of the sender of the message.
+
+    @param messageID: the ID of the message.
+    """
+    return (sender.shareID, sender.localpart, sender.domain, messageID)
+
+
+
+def _routeMessages(router, messages):
+    """
+    Route several messages via an L{IMessageRouter}, using its
+    C{routeMessages} method if it has one, or calling its C{routeMessage}
+    method for each message if it does not.
+
+    @param messages: a C{list} of C{(sender, target, value, messageID)}
+    tuples.
+    """
+    routeMessages = getattr(router, 'routeMessages', None)
+    if routeMessages is not None:
+        routeMessages(messages)
+    else:
+        for (sender, target, value, messageID) in messages:
+            router.routeMessage(sender, target, value, messageID)
+
+
+
 def _accidentalSiteRouter(siteStore):
     """
     Create an L{IMessageRouter} provider for an item in a user store
@@ -534,6 +715,20 @@ class MessageQueue(Item):
         """,
         default=0, allowNone=False)
 
+    _batching = inmemory(
+        """
+        C{True} while L{routeMessages} is delivering a batch of messages, so
+        that the queue is scheduled once for the whole batch rather than once
+        per message.
+        """)
+
+
+    def activate(self):
+        """
+        Initialize in-memory state.
+        """
+        self._batching = False
+
 
     def _scheduleMePlease(self):
         """
@@ -541,9 +736,17 @@ class MessageQueue(Item):
         future.  Tell the dependent scheduler to schedule it if it isn't
         already pending execution.
         """
+        if self._batching:
+            return
         sched = IScheduler(self.store)
-        if len(list(sched.scheduledTimes(self))) == 0:
-            sched.schedule(self, sched.now())
+        now = sched.now()
+        for when in sched.scheduledTimes(self):
+            # The queue may be waiting to retransmit to an unreachable target;
+            # don't make new messages wait for it too.
+            if when > now:
+                sched.reschedule(self, when, now)
+            return
+        sched.schedule(self, now)
 
 
     def routeMessage(self, sender, target, value, messageID):
@@ -559,7 +762,6 @@ class MessageQueue(Item):
         L{IMessageReceiver.messageReceived} method may be invoked, generate a
         L{DELIVERY_ERROR} response instead.
         """
-        avatarName = sender.localpart + u"@" + sender.domain
         # Look for the sender.
         answer = self.store.findUnique(
             _AlreadyAnswered,
@@ -567,37 +769,85 @@ class MessageQueue(Item):
                 _AlreadyAnswered.messageID == messageID),
             default=None)
         if answer is None:
-            role = getPrimaryRole(self.store, avatarName)
-            try:
-                receiver = role.getShare(target.shareID)
-            except NoSuchShare:
-                response = Value(DELIVERY_ERROR,  ERROR_NO_SHARE)
-            else:
-                try:
-                    def txn():
-                        output = receiver.messageReceived(value, sender,
-                                                          target)
-                        if not isinstance(output, Value):
-                            raise TypeError("%r returned non-Value %r" %
-                                            (receiver, output))
-                        return output
-                    response = self.store.transact(txn)
-                except RevertAndRespond, rar:
-                    response = rar.value
-                except:
-                    log.err(Failure(),
-                            "An error occurred during inter-store "
-                            "message delivery.")
-                    response = Value(DELIVERY_ERROR, ERROR_REMOTE_EXCEPTION)
-            answer = _AlreadyAnswered.create(store=self.store,
-                                             originalSender=sender,
-                                             originalTarget=target,
-                                             messageID=messageID,
-                                             value=response)
+            answer = self._answerMessage(sender, target, value, messageID)
         self._deliverAnswer(answer)
         self._scheduleMePlease()
 
 
+    def routeMessages(self, messages):
+        """
+        Route several messages to this queue's store at once.  This has the
+        same effect as calling L{routeMessage} for each of them, but looks for
+        existing answers with a single query and schedules this queue only
+        once.
+
+        @param messages: a C{list} of C{(sender, target, value, messageID)}
+        tuples.
+        """
+        answers = {}
+        for answer in self.store.query(
+            _AlreadyAnswered,
+            _AlreadyAnswered.messageID.oneOf(
+                [messageID for (sender, target, value, messageID)
+                 in messages])):
+            answers[_answerKey(answer.originalSender,
+                               answer.messageID)] = answer
+        self._batching = True
+        try:
+            for (sender, target, value, messageID) in messages:
+                key = _answerKey(sender, messageID)
+                answer = answers.get(key)
+                if answer is None:
+                    answer = self._answerMessage(
+                        sender, target, value, messageID)
+                    answers[key] = answer
+                self._deliverAnswer(answer)
+        finally:
+            self._batching = False
+        self._scheduleMePlease()
+
+
+    def _answerMessage(self, sender, target, value, messageID):
+        """
+        Deliver a message which has not been answered before to the shared
+        L{IMessageReceiver} it is addressed to, and record its answer.
+
+        Each message is processed in its own transaction, so that
+        L{RevertAndRespond} (or any other exception) only reverts the effects
+        of the message which raised it.
+
+        @return: the new L{_AlreadyAnswered}.
+        """
+        avatarName = sender.localpart + u"@" + sender.domain
+        role = getPrimaryRole(self.store, avatarName)
+        try:
+            receiver = role.getShare(target.shareID)
+        except NoSuchShare:
+            response = Value(DELIVERY_ERROR,  ERROR_NO_SHARE)
+        else:
+            try:
+                def txn():
+                    output = receiver.messageReceived(value, sender,
+                                                      target)
+                    if not isinstance(output, Value):
+                        raise TypeError("%r returned non-Value %r" %
+                                        (receiver, output))
+                    return output
+                response = self.store.transact(txn)
+            except RevertAndRespond, rar:
+                response = rar.value
+            except:
+                log.err(Failure(),
+                        "An error occurred during inter-store "
+                        "message delivery.")
+                response = Value(DELIVERY_ERROR, ERROR_REMOTE_EXCEPTION)
+        return _AlreadyAnswered.create(store=self.store,
+                                       originalSender=sender,
+                                       originalTarget=target,
+                                       messageID=messageID,
+                                       value=response)
+
+
     def _deliverAnswer(self, answer):
         """
         Attempt to deliver an answer to a message sent to this store, via my
@@ -671,19 +921,31 @@ class MessageQueue(Item):
             default=None)
 
 
-    def _verifySender(self, sender):
+    def _internalAccountNames(self):
+        """
+        Retrieve the names of the internal L{LoginMethod}s of this queue's
+        store, which are the names it may send messages as.
+
+        @return: a C{list} of C{(localpart, domain)} tuples.
+        """
+        return [(lm.localpart, lm.domain)
+                for lm in self.store.query(
+                LoginMethod, LoginMethod.internal == True)]
+
+
+    def _verifySender(self, sender, accountNames=None):
         """
         Verify that this sender is valid.
+
+        @param accountNames: the result of L{_internalAccountNames}, if it has
+        already been retrieved.
         """
-        if self.store.findFirst(
-            LoginMethod,
-            AND(LoginMethod.localpart == sender.localpart,
-                LoginMethod.domain == sender.domain,
-                LoginMethod.internal == True)) is None:
+        if accountNames is None:
+            accountNames = self._internalAccountNames()
+        if (sender.localpart, sender.domain) not in accountNames:
             raise BadSender(sender.localpart + u'@' + sender.domain,
-                            [lm.localpart + u'@' + lm.domain
-                             for lm in self.store.query(
-                        LoginMethod, LoginMethod.internal == True)])
+                            [localpart + u'@' + domain
+                             for (localpart, domain) in accountNames])
 
 
     def queueMessage(self, sender, target, value,
@@ -712,18 +974,59 @@ class MessageQueue(Item):
         self._scheduleMePlease()
 
 
+    def _recordAttempt(self, item, now):
+        """
+        Note that a delivery attempt was made for a L{_QueuedMessage} or an
+        L{_AlreadyAnswered}, and back off exponentially before the next one.
+        """
+        item.attempts += 1
+        item.nextAttempt = now + _retransmitDelay(item.attempts)
+
+
+    def _nextAttemptTime(self, now):
+        """
+        Find the time at which the earliest remaining L{_QueuedMessage} or
+        L{_AlreadyAnswered} is due to be retransmitted.
+
+        @return: a L{Time}, or C{None} if there is nothing left to deliver.
+        """
+        times = []
+        for itemType in [_QueuedMessage, _AlreadyAnswered]:
+            if self.store.findFirst(
+                itemType, itemType.nextAttempt == None,
+                default=None) is not None:
+                return now
+            item = self.store.findFirst(
+                itemType, sort=itemType.nextAttempt.ascending, default=None)
+            if item is not None:
+                times.append(item.nextAttempt)
+        if times:
+            return min(times)
+        return None
+
+
     def run(self):
         """
-        Attmept to deliver the first outgoing L{QueuedMessage}; return a time
-        to reschedule if there are still more retries or outgoing messages to
-        send.
+        Attempt to deliver the outgoing L{_QueuedMessage}s and
+        L{_AlreadyAnswered}s which are due; return the time at which the next
+        of the rest is due, if there are any.
+
+        Each message and answer which is not delivered by the time it is due
+        is retransmitted after an exponentially increasing delay, so that an
+        unreachable target does not cause every pending message to be sent
+        again every time the queue runs.
         """
-        delay = None
         router = self.siteRouter
-        for qmsg in self.store.query(_QueuedMessage,
-                                     sort=_QueuedMessage.storeID.ascending):
+        now = IScheduler(self.store).now()
+        accountNames = self._internalAccountNames()
+        messages = []
+        for qmsg in self.store.query(
+            _QueuedMessage,
+            OR(_QueuedMessage.nextAttempt == None,
+               _QueuedMessage.nextAttempt <= now),
+            sort=_QueuedMessage.storeID.ascending):
             try:
-                self._verifySender(qmsg.sender)
+                self._verifySender(qmsg.sender, accountNames)
             except:
                 self.routeAnswer(qmsg.sender, qmsg.target,
                                  Value(DELIVERY_ERROR, ERROR_BAD_SENDER),
@@ -731,21 +1034,25 @@ class MessageQueue(Item):
                 log.err(Failure(),
                         "Could not verify sender for sending message.")
             else:
-                router.routeMessage(qmsg.sender, qmsg.target,
-                                    qmsg.value, qmsg.messageID)
-
-        for answer in self.store.query(_AlreadyAnswered,
-                                       sort=_AlreadyAnswered.storeID.ascending):
+                self._recordAttempt(qmsg, now)
+                messages.append((qmsg.sender, qmsg.target,
+                                 qmsg.value, qmsg.messageID))
+        for batch in _groupByTargetAccount(messages):
+            _routeMessages(router, batch)
+
+        answerCount = 0
+        for answer in list(self.store.query(
+            _AlreadyAnswered,
+            OR(_AlreadyAnswered.nextAttempt == None,
+               _AlreadyAnswered.nextAttempt <= now),
+            sort=_AlreadyAnswered.storeID.ascending)):
+            self._recordAttempt(answer, now)
             self._deliverAnswer(answer)
-        nextmsg = self.store.findFirst(_QueuedMessage, default=None)
-        if nextmsg is not None:
-            delay = _RETRANSMIT_DELAY
-        else:
-            nextanswer = self.store.findFirst(_AlreadyAnswered, default=None)
-            if nextanswer is not None:
-                delay = _RETRANSMIT_DELAY
-        if delay is not None:
-            return IScheduler(self.store).now() + timedelta(seconds=delay)
+            answerCount += 1
+        log.msg(interface=IStatEvent,
+                stat_interstore_messages_sent=len(messages),
+                stat_interstore_answers_sent=answerCount)
+        return self._nextAttemptTime(now)
 
 
 declareLegacyItem(
@@ -142,6 +142,18 @@ class ISearchAggregator(Interface):
         returns the number of available search providers
         """
 
+    def mergedSearch(term, keywords=None, sortAscending=True, timeout=None):
+        """
+        Query all search providers, merging their results by sort key as they
+        are needed rather than retrieving all of them.
+
+        @param timeout: the number of seconds to wait for a provider before
+        giving up on it, or C{None} to wait forever.
+
+        @rtype: L{twisted.internet.defer.Deferred}
+        @return: a Deferred which will fire with a L{search.MergedSearch}.
+        """
+
 
 
 class IFulltextIndexer(Interface):
@@ -138,6 +138,44 @@ Mantissa.ScrollTable.Action.methods(
     });
 
 
+/**
+ * Turn rows sent by the server in the columnar format, as produced by
+ * C{xmantissa.scrolltable.ScrollableView.constructColumns}, into one object
+ * per row, as would have been sent in the default format.
+ *
+ * @param columnar: A two-element array of an array of column names and an
+ * array of arrays of the values in each of those columns.  A null value in
+ * the C{__id__} column means the row has no C{__id__}.
+ * @type columnar: C{Array}
+ *
+ * @return: An array of row objects.
+ * @rtype: C{Array}
+ */
+Mantissa.ScrollTable.decodeColumnarRows = function decodeColumnarRows(columnar) {
+    var names = columnar[0];
+    var columns = columnar[1];
+    var rows = [];
+    if (columns.length == 0) {
+        return rows;
+    }
+    var count = columns[0].length;
+    for (var i = 0; i < count; ++i) {
+        rows.push({});
+    }
+    for (var j = 0; j < names.length; ++j) {
+        var name = names[j];
+        var values = columns[j];
+        for (i = 0; i < count; ++i) {
+            if (name == '__id__' && values[i] === null) {
+                continue;
+            }
+            rows[i][name] = values[i];
+        }
+    }
+    return rows;
+};
+
+
 /**
  * Base class for shared ("legacy") methods between old (index-based)
  * ScrollModel and new (inequality-based) RegionModel.
@@ -1104,6 +1142,9 @@ Mantissa.ScrollTable.ScrollingWidget.methods(
      *
      *    A boolean indicating whether the ordering is currently ascending
      *    (true) or descending (false).
+     *
+     *    An array of the names of the formats, other than the default of one
+     *    object per row, in which the server can send rows.
      */
     function getTableMetadata(self) {
         return self.callRemote("getTableMetadata");
@@ -1129,12 +1170,26 @@ Mantissa.ScrollTable.ScrollingWidget.methods(
      * @type isAscendingNow: C{Boolean}
      * @param isAscendingNow: Whether the sort is ascending.
      *
+     * @type rowFormats: C{Array} of C{String}
+     * @param rowFormats: (optional) The names of the formats, other than the
+     * default, in which the server can send rows.  If C{"columnar"} is one of
+     * them, rows will be requested in that format.
+     *
      * @return: C{undefined}
      */
     function setTableMetadata(self, columnNames, columnTypes, rowCount,
-                              currentSort, isAscendingNow) {
+                              currentSort, isAscendingNow,
+                              /* optional */ rowFormats) {
         self.columnNames = columnNames;
         self.columnTypes = columnTypes;
+        self._columnarRows = false;
+        if (rowFormats !== undefined) {
+            for (var i = 0; i < rowFormats.length; ++i) {
+                if (rowFormats[i] == 'columnar') {
+                    self._columnarRows = true;
+                }
+            }
+        }
 
         if(self.actions && 0 < self.actions.length) {
             self.columnNames.push("actions");
@@ -1155,8 +1210,17 @@ Mantissa.ScrollTable.ScrollingWidget.methods(
      * @type lastRow: integer
      * @param lastRow: zero-based index of the message after the last message
      * to retrieve.
+     *
+     * @return: A Deferred which fires with an array of row objects.  If the
+     * server offered the columnar format, rows are requested in it and
+     * decoded.
      */
     function getRows(self, firstRow, lastRow) {
+        if (self._columnarRows) {
+            return self.callRemote(
+                "requestRowRange", firstRow, lastRow, "columnar").addCallback(
+                    Mantissa.ScrollTable.decodeColumnarRows);
+        }
         return self.callRemote("requestRowRange", firstRow, lastRow);
     },
 
@@ -2208,6 +2272,20 @@ Mantissa.ScrollTable.RowRegion.methods(
         }
     },
 
+    /**
+     * Insert a row into this region.
+     *
+     * @param offset: the offset within the entire data set (i.e. this
+     * RowRegion's RegionModel) which the new row will have.
+     *
+     * @param row: the row object to insert.
+     */
+    function insertRegionRow(self, offset, row) {
+        var innerOffset = offset - self.firstOffset();
+        self.rows.splice(innerOffset, 0, row);
+        self.viewPeer.insertViewRow(innerOffset, row);
+    },
+
     /**
      * Determine if this RowRegion's values come later than the given
      * RowRegion's values according to the current sort column and sort order.
@@ -2515,6 +2593,110 @@ Mantissa.ScrollTable.RegionModel.methods(
         throw Mantissa.ScrollTable.NoSuchWebID(webID);
     },
 
+    /**
+     * Find the locally available row with the given web ID.
+     *
+     * @return: a two-element Array of the index of the L{RowRegion} which
+     * contains the row and the row's offset within that region, or null if
+     * no such row is available.
+     */
+    function _locateWebID(self, webID) {
+        var region;
+        for (var i = 0; i < self._regions.length; i++) {
+            region = self._regions[i];
+            for (var j = 0; j < region.rows.length; j++) {
+                if (region.rows[j].__id__ == webID) {
+                    return [i, j];
+                }
+            }
+        }
+        return null;
+    },
+
+    /**
+     * Remove the row with the given web ID, if it is available locally, and
+     * move the regions after it up to close the gap.
+     */
+    function _removeChangedRow(self, webID) {
+        var location = self._locateWebID(webID);
+        if (location === null) {
+            return;
+        }
+        var index = location[0];
+        var region = self._regions[index];
+        if (region.rows.length !== 1) {
+            index++;
+        }
+        region.removeRegionRow(region.firstOffset() + location[1]);
+        self._adjustRegionOffsets(index, -1);
+    },
+
+    /**
+     * Insert a row immediately after the row with the given web ID, if that
+     * row is available locally, and move the regions after it down to make
+     * room.
+     *
+     * @param previousWebID: the web ID of the row which comes before the new
+     * one, or null if the new row comes first.
+     */
+    function _insertChangedRow(self, previousWebID, row) {
+        var index, region, offset;
+        if (previousWebID === null) {
+            if (self._regions.length === 0) {
+                /* If the table is known to be empty, this is its only row;
+                 * otherwise it will arrive with the rest of the data.
+                 */
+                if (self._initialized &&
+                    self._outstandingInitRequest === undefined) {
+                    self.insertRowData(0, [row]);
+                }
+                return;
+            }
+            index = 0;
+            region = self._regions[0];
+            offset = 0;
+            if (region.firstOffset() !== 0) {
+                return;
+            }
+        } else {
+            var location = self._locateWebID(previousWebID);
+            if (location === null) {
+                return;
+            }
+            index = location[0];
+            region = self._regions[index];
+            offset = region.firstOffset() + location[1] + 1;
+        }
+        region.insertRegionRow(offset, row);
+        self._adjustRegionOffsets(index + 1, 1);
+    },
+
+    /**
+     * Update the locally available rows to reflect changes to the data on
+     * the server.  Changed rows which fall in a range of rows that has not
+     * been loaded are ignored, since they will be retrieved with that range.
+     *
+     * @param changes: an Array of two-element Arrays of the web ID of the row
+     * which now comes immediately before a changed row, or null if it is the
+     * first row, and the data of the changed row, in the order of the rows.
+     *
+     * @param removedWebIDs: an Array of the web IDs of rows which are no
+     * longer present.
+     */
+    function rowsChanged(self, changes, removedWebIDs) {
+        var i;
+        for (i = 0; i < removedWebIDs.length; i++) {
+            self._removeChangedRow(removedWebIDs[i]);
+        }
+        for (i = 0; i < changes.length; i++) {
+            self._removeChangedRow(changes[i][1].__id__);
+        }
+        for (i = 0; i < changes.length; i++) {
+            self._insertChangedRow(
+                changes[i][0], self.dataAsRow(changes[i][1]));
+        }
+    },
+
     /**
      * @rtype: integer
      * @return: The number of rows in the model which we have already fetched.
@@ -3244,6 +3426,42 @@ Mantissa.ScrollTable.DOMRegionView.methods(
         });
     },
 
+    /**
+     * Insert a row node into this DOMRegionView's row content node.
+     *
+     * @param localOffset: an integer representing the offset into this
+     * DOMRegionView's data which the new row has.
+     *
+     * @param row: the row object to make a node for.
+     */
+    function insertViewRow(self, localOffset, row) {
+        var plat = Divmod.Runtime.Platform;
+        var rowNode = self.tableView._createRow(
+            self.rowRegion.firstOffset() + localOffset, row);
+        var container = self.node.childNodes[0];
+        var currentOffset = 0;
+        var inserted = false;
+        Divmod.Runtime.theRuntime.traverse(
+            container,
+            function (aNode) {
+                if (self._isRowContainerNode(aNode)) {
+                    return plat.DOM_DESCEND;
+                } else {
+                    if (currentOffset === localOffset) {
+                        aNode.parentNode.insertBefore(rowNode, aNode);
+                        inserted = true;
+                        return plat.DOM_TERMINATE;
+                    }
+                    container = aNode.parentNode;
+                    currentOffset++;
+                    return plat.DOM_CONTINUE;
+                }
+        });
+        if (!inserted) {
+            container.appendChild(rowNode);
+        }
+    },
+
     /**
      * Update this region's node's pixel offset within its parent node to
      * reflect a new offset of its region.
@@ -3401,6 +3619,14 @@ Mantissa.ScrollTable.ScrollTable.methods(
         self.model.removeRow(offset);
     },
 
+    /**
+     * Apply changes to rows which the server pushes; see
+     * L{RegionModel.rowsChanged}.
+     */
+    function rowsChanged(self, changes, removedWebIDs) {
+        self.model.rowsChanged(changes, removedWebIDs);
+    },
+
     /**
      * This is invoked internally to get a test row since it is overridden in
      * subclasses, but it should no longer be necessary.
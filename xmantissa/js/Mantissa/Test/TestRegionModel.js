@@ -1073,6 +1073,14 @@ Mantissa.Test.TestRegionModel.DummyRegionView.methods(
         self.tableView.removals.push([self, innerOffset]);
     },
 
+    /**
+     * Fake implementation of DOMRegionView.insertViewRow.  Record the fact
+     * that a row was inserted on the L{DummyTableView}.
+     */
+    function insertViewRow(self, innerOffset, row) {
+        self.tableView.insertions.push([self, innerOffset, row]);
+    },
+
     /**
      * Fake implementation of DOMRegionView.refreshViewOffset.  Record the
      * fact that the view offset was refreshed on the L{DummyTableView}.
@@ -1121,6 +1129,7 @@ Mantissa.Test.TestRegionModel.DummyTableView.methods(
         self.merges = [];
         self.destroyed = [];
         self.removals = [];
+        self.insertions = [];
     },
 
     /**
@@ -2334,6 +2343,125 @@ Mantissa.Test.TestRegionModel.RegionModelViewTests.methods(
 
 
 
+Mantissa.Test.TestRegionModel.RowsChangedTests =
+    Divmod.UnitTest.TestCase.subclass(
+        'Mantissa.Test.TestRegionModel.RowsChangedTests');
+
+/**
+ * Tests for L{Mantissa.ScrollTable.RegionModel.rowsChanged}, which applies
+ * changes pushed by the server to the rows which are available locally.
+ */
+Mantissa.Test.TestRegionModel.RowsChangedTests.methods(
+    /* ad-hoc mixin - see above */
+    Mantissa.Test.TestRegionModel.makeRegionModel,
+    Mantissa.Test.TestRegionModel.makeRow,
+
+    /**
+     * Create a model with two regions of rows, one at offset 0 and one at
+     * offset 10.
+     */
+    function setUp(self) {
+        var server = Mantissa.Test.TestRegionModel.ArrayRegionServer([]);
+        self.model = self.makeRegionModel(
+            server, Mantissa.Test.TestRegionModel.SkewedColumn('value'));
+        self.model.insertRowData(
+            0, [self.makeRow(1), self.makeRow(2), self.makeRow(3)]);
+        self.model.insertRowData(10, [self.makeRow(7), self.makeRow(8)]);
+    },
+
+    /**
+     * A changed row which was available locally is replaced by its new data.
+     */
+    function test_changedRow(self) {
+        var row = self.makeRow(2);
+        row.extra = 'changed';
+        self.model.rowsChanged([['TEST_1_VALUE', row]], []);
+        var rows = self.model._regions[0].rows;
+        self.assertIdentical(rows.length, 3);
+        self.assertIdentical(rows[1], row);
+        self.assertIdentical(self.dummyTableView.removals.length, 1);
+        self.assertIdentical(self.dummyTableView.insertions.length, 1);
+        self.assertIdentical(self.dummyTableView.insertions[0][1], 1);
+        self.assertIdentical(self.model._regions[1].firstOffset(), 10);
+    },
+
+    /**
+     * A removed row is taken out of its region, and the regions after it are
+     * moved up.
+     */
+    function test_removedRow(self) {
+        self.model.rowsChanged([], ['TEST_2_VALUE']);
+        self.assertIdentical(self.model._regions[0].rows.length, 2);
+        self.assertIdentical(self.model._regions[1].firstOffset(), 9);
+    },
+
+    /**
+     * When the only row of a region is removed, the region is destroyed and
+     * the regions after it are moved up.
+     */
+    function test_removedOnlyRow(self) {
+        self.model.rowsChanged([], ['TEST_1_VALUE', 'TEST_2_VALUE']);
+        self.model.rowsChanged([], ['TEST_3_VALUE']);
+        self.assertIdentical(self.model._regions.length, 1);
+        self.assertIdentical(self.model._regions[0].firstOffset(), 7);
+        self.assertIdentical(self.dummyTableView.destroyed.length, 1);
+    },
+
+    /**
+     * A new row is inserted after the row which comes before it, and the
+     * regions after it are moved down.
+     */
+    function test_insertedRow(self) {
+        self.model.rowsChanged(
+            [['TEST_3_VALUE', self.makeRow(4)],
+             ['TEST_4_VALUE', self.makeRow(5)]], []);
+        var rows = self.model._regions[0].rows;
+        self.assertIdentical(rows.length, 5);
+        self.assertIdentical(rows[3].value, 4);
+        self.assertIdentical(rows[4].value, 5);
+        self.assertIdentical(self.model._regions[1].firstOffset(), 12);
+    },
+
+    /**
+     * A new row which comes after a row which is not available locally is
+     * ignored.
+     */
+    function test_unloadedRow(self) {
+        self.model.rowsChanged([['TEST_5_VALUE', self.makeRow(6)]], []);
+        self.assertIdentical(self.dummyTableView.insertions.length, 0);
+        self.assertIdentical(self.model.rowCount(), 5);
+    },
+
+    /**
+     * A new first row is inserted at the beginning of the first region, but
+     * only if that region begins at the beginning of the table.
+     */
+    function test_firstRow(self) {
+        self.model.rowsChanged([[null, self.makeRow(0)]], []);
+        self.assertIdentical(self.model._regions[0].rows[0].value, 0);
+        self.assertIdentical(self.model._regions[1].firstOffset(), 11);
+
+        self.model._regions[0].adjustOffset(5);
+        self.model.rowsChanged([[null, self.makeRow(-1)]], []);
+        self.assertIdentical(self.model.rowCount(), 6);
+    },
+
+    /**
+     * A new row in a table which is known to be empty becomes its only row.
+     */
+    function test_emptyTable(self) {
+        self.model.empty();
+        self.model.rowsChanged([[null, self.makeRow(1)]], []);
+        self.assertIdentical(self.model._regions.length, 0);
+
+        self.model._initialized = true;
+        self.model.rowsChanged([[null, self.makeRow(1)]], []);
+        self.assertIdentical(self.model._regions.length, 1);
+        self.assertIdentical(self.model._regions[0].rows[0].value, 1);
+    });
+
+
+
 Mantissa.Test.TestRegionModel.TestableWidget =
     Mantissa.ScrollTable.ScrollingWidget.subclass(
         "Mantissa.Test.TestRegionModel.TestableWidget");
@@ -2510,6 +2638,44 @@ Mantissa.Test.TestRegionModel.RegionDOMTests.methods(
         self.assertIdentical(rowNode.className, "row-temporary-placeholder");
     },
 
+    /**
+     * L{Mantissa.ScrollTable.DOMRegionView.insertViewRow} should create a
+     * node for the new row and put it among the other row nodes at the given
+     * offset.
+     */
+    function test_insertViewRow(self) {
+        var fakeTableView = {
+          node: document.createElement('div'),
+          _getRowHeight: function () {
+                return 3;
+            },
+          _createRow: function (offset, row) {
+                var rowNode = document.createElement('div');
+                rowNode.appendChild(document.createTextNode(row.value));
+                return rowNode;
+            }
+        };
+        var fakeRowRegion = {
+          rows: [{value: 'a'}, {value: 'c'}],
+          firstOffset: function () {
+                return 0;
+            },
+          previousRegion: function () {
+                return undefined;
+            }
+        };
+        var regionView = Mantissa.ScrollTable.DOMRegionView(
+            fakeTableView, fakeRowRegion);
+        regionView.insertViewRow(1, {value: 'b'});
+        regionView.insertViewRow(3, {value: 'd'});
+        var rowNodes = fakeTableView.node.childNodes[0].childNodes[0].childNodes;
+        var values = [];
+        for (var i = 0; i < rowNodes.length; i++) {
+            values.push(rowNodes[i].childNodes[0].nodeValue);
+        }
+        self.assertArraysEqual(values, ['a', 'b', 'c', 'd']);
+    },
+
     /**
      * Verify that the ScrollTable widget's C{visiblePixelTop} method returns
      * the vertical offset of the node's scrollbar.
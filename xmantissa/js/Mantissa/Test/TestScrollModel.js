@@ -311,3 +311,44 @@ Mantissa.Test.TestScrollModel.ScrollModelTests.methods(
         self.assertIdentical(observer.events[0].type, 'deactivated');
         self.assertIdentical(observer.events[0].row.__id__, 'a');
     });
+
+
+Mantissa.Test.TestScrollModel.ColumnarRowsTests = Divmod.UnitTest.TestCase.subclass(
+    'Mantissa.Test.TestScrollModel.ColumnarRowsTests');
+/**
+ * Tests for L{Mantissa.ScrollTable.decodeColumnarRows}.
+ */
+Mantissa.Test.TestScrollModel.ColumnarRowsTests.methods(
+    /**
+     * Each value in each column becomes a property of the row object at its
+     * index.
+     */
+    function test_decode(self) {
+        var rows = Mantissa.ScrollTable.decodeColumnarRows(
+            [['a', 'b', '__id__'], [[1, 2], [null, 'x'], ['one', 'two']]]);
+        self.assertIdentical(rows.length, 2);
+        self.assertIdentical(rows[0].a, 1);
+        self.assertIdentical(rows[0].b, null);
+        self.assertIdentical(rows[0].__id__, 'one');
+        self.assertIdentical(rows[1].a, 2);
+        self.assertIdentical(rows[1].b, 'x');
+        self.assertIdentical(rows[1].__id__, 'two');
+    },
+
+    /**
+     * Rows with a null C{__id__} have no C{__id__} property.
+     */
+    function test_missingID(self) {
+        var rows = Mantissa.ScrollTable.decodeColumnarRows(
+            [['a', '__id__'], [[1, 2], [null, 'two']]]);
+        self.assertIdentical('__id__' in rows[0], false);
+        self.assertIdentical(rows[1].__id__, 'two');
+    },
+
+    /**
+     * No columns decode to no rows.
+     */
+    function test_empty(self) {
+        self.assertIdentical(
+            Mantissa.ScrollTable.decodeColumnarRows([[], []]).length, 0);
+    });
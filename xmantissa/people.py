@@ -49,7 +49,8 @@ from xmantissa import ixmantissa, webnav, webtheme, liveform, signup
 from xmantissa.ixmantissa import IOrganizerPlugin, IContactType
 from xmantissa.webapp import PrivateApplication
 from xmantissa.tdbview import TabularDataView, ColumnViewBase
-from xmantissa.scrolltable import ScrollingElement, UnsortableColumn
+from xmantissa.scrolltable import (
+    ScrollingElement, UnsortableColumn, RowChangeMixin)
 from xmantissa.fragmentutils import dictFillSlots
 from xmantissa.webtheme import ThemedDocumentFactory
 
@@ -471,7 +472,7 @@ class PeopleBenefactor(item.Item):
 
 
 
-class Person(item.Item):
+class Person(RowChangeMixin, item.Item):
     """
     Person Per"son (p[~e]r"s'n; 277), n.
 
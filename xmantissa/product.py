@@ -14,6 +14,7 @@ from xmantissa.ixmantissa import INavigableElement, INavigableFragment
 from xmantissa import liveform
 from xmantissa.offering import getInstalledOfferings
 from xmantissa.webnav import Tab
+from xmantissa._itemloader import loadItems
 
 from zope.interface import implements
 
@@ -86,8 +87,8 @@ class Installation(Item):
         """
         Loads the items this Installation refers to.
         """
-        for id in self._items:
-            yield self.store.getItemByID(int(id))
+        for item in loadItems(self.store, [int(id) for id in self._items]):
+            yield item
     items = property(items)
     def allPowerups(self):
         return set(chain(self.items, *[installedRequirements(self.store, i) for
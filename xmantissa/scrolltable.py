@@ -10,19 +10,31 @@ Nevow Athena front-end.
 import inspect
 import warnings
 
+from collections import OrderedDict
+from weakref import WeakKeyDictionary
+
 from zope.interface import implements
 
+from twisted.python import log
 from twisted.python.components import registerAdapter
 from twisted.python.reflect import qual
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred
 
 from epsilon.extime import Time
 
 from nevow.athena import LiveElement, expose
 
-from axiom.attributes import timestamp, SQLAttribute, AND
+from axiom.iaxiom import IStatEvent
+from axiom.attributes import (
+    timestamp, reference, SQLAttribute, AND, OR, MICRO)
+from axiom.store import ItemQuery, _DistinctQuery, _FakeItemForFilter
 
 from xmantissa.ixmantissa import IWebTranslator, IColumn
 from xmantissa.error import Unsortable
+from xmantissa.search import MergedSearch
+from xmantissa._itemloader import loadItems, _chunks
+from xmantissa._storechange import storeChangeToken
 
 
 
@@ -347,6 +359,69 @@ def _webTranslator(store, fallback):
 
 
 
+class _RowCountCache(object):
+    """
+    The numbers of items matching the queries of the scrolltables of one
+    store.
+
+    Counts are kept, by item type and constraint, for as long as
+    L{storeChangeToken} stays the same; that is, until an item in the store
+    is created, changed or deleted.
+
+    @ivar maximumSize: the number of counts to keep.
+    """
+    maximumSize = 64
+
+    def __init__(self, store):
+        self.store = store
+        self._token = None
+        # Maps (itemType, SQL, arguments) to counts, least recently used
+        # first.
+        self._counts = OrderedDict()
+
+
+    def count(self, itemType, baseConstraint):
+        """
+        Count the items of type C{itemType} which match C{baseConstraint}.
+        """
+        query = self.store.query(itemType, baseConstraint)
+        if baseConstraint is None:
+            key = (itemType, None, ())
+        else:
+            key = (itemType, baseConstraint.getQuery(self.store),
+                   tuple(baseConstraint.getArgs(self.store)))
+        try:
+            hash(key)
+        except TypeError:
+            return query.count()
+        token = storeChangeToken(self.store)
+        if token != self._token:
+            self._counts.clear()
+            self._token = token
+        count = self._counts.pop(key, None)
+        if count is None:
+            log.msg(interface=IStatEvent, stat_scrolltable_count_cache_misses=1)
+            count = query.count()
+            if len(self._counts) >= self.maximumSize:
+                self._counts.popitem(last=False)
+        else:
+            log.msg(interface=IStatEvent, stat_scrolltable_count_cache_hits=1)
+        self._counts[key] = count
+        return count
+
+
+
+def _rowCountCache(store):
+    """
+    Get the L{_RowCountCache} of a store, creating it if necessary.
+    """
+    cache = getattr(store, '_rowCountCache', None)
+    if cache is None:
+        cache = store._rowCountCache = _RowCountCache(store)
+    return cache
+
+
+
 class InequalityModel(_ScrollableBase):
     """
     This is a utility base class for things which want to communicate about
@@ -443,6 +518,89 @@ class InequalityModel(_ScrollableBase):
                                 limit=count).distinct()
 
 
+    def _attributeRowPlan(self, query):
+        """
+        Determine whether the rows for the results of C{query} can be built
+        from the values of their attributes alone, without loading any items.
+
+        This is the case when C{query} is a query for C{itemType}, as made by
+        L{inequalityQuery}, every column is a plain L{AttributeColumn} or
+        L{TimestampAttributeColumn} of an attribute of C{itemType} which is
+        not a reference, rows are built by L{ScrollableView.constructRows},
+        and links by L{_ScrollableBase.linkToItem} with a web translator which
+        can make web IDs from storeIDs.
+
+        @return: C{None} if the items must be loaded, otherwise a two-tuple of
+        a function which takes a storeID and returns the web ID for it, and a
+        list of three-tuples of the attribute ID of each column, its
+        attribute, and a function which converts a value from the database
+        into a value for the row.
+        """
+        if not (isinstance(query, _DistinctQuery)
+                and isinstance(query.query, ItemQuery)
+                and query.query.tableClass is self.itemType):
+            return None
+        for (name, base) in [('constructRows', ScrollableView),
+                             ('linkToItem', _ScrollableBase)]:
+            method = getattr(type(self), name, None)
+            if (name in self.__dict__
+                or getattr(method, 'im_func', None) is not
+                getattr(base, name).im_func):
+                return None
+        webIDForStoreID = getattr(self.webTranslator, 'webIDForStoreID', None)
+        if webIDForStoreID is None:
+            return None
+
+        fakeItem = _FakeItemForFilter(self.store)
+        columns = []
+        for (attributeID, column) in self.columns.iteritems():
+            if (type(column) not in (AttributeColumn, TimestampAttributeColumn)
+                or 'extractValue' in vars(column)):
+                return None
+            attribute = column.attribute
+            if (not isinstance(attribute, SQLAttribute)
+                or isinstance(attribute, reference)
+                or attribute.type is not self.itemType):
+                return None
+            if type(column) is TimestampAttributeColumn:
+                def convert(value, attribute=attribute):
+                    if value is None:
+                        raise AttributeError("%r was None" % (attribute,))
+                    return value / MICRO
+            else:
+                def convert(value, outfilter=attribute.outfilter):
+                    return outfilter(value, fakeItem)
+            columns.append((attributeID, attribute, convert))
+        return webIDForStoreID, columns
+
+
+    def _constructQueryRows(self, query):
+        """
+        Build the rows for the results of C{query}, as C{constructRows} does.
+
+        When L{_attributeRowPlan} allows it, the storeIDs and column values are
+        selected from the database in one query and the rows are built from
+        them directly, without loading any items.
+        """
+        plan = self._attributeRowPlan(query)
+        if plan is None:
+            return self.constructRows(query)
+        webIDForStoreID, columns = plan
+        itemQuery = query.query
+        target = ', '.join(
+            [self.itemType.storeID.getColumnName(self.store)] +
+            [attribute.getColumnName(self.store)
+             for (attributeID, attribute, convert) in columns])
+        rows = []
+        for values in itemQuery._runQuery('SELECT DISTINCT', target):
+            row = dict((attributeID, convert(value))
+                       for ((attributeID, attribute, convert), value)
+                       in zip(columns, values[1:]))
+            row[u'__id__'] = unicode(webIDForStoreID(values[0]), 'ascii')
+            rows.append(row)
+        return rows
+
+
     def rowsAfterValue(self, value, count):
         """
         Retrieve some rows at or after a given sort-column value.
@@ -467,7 +625,7 @@ class InequalityModel(_ScrollableBase):
             pyvalue = self._toComparableValue(value)
             currentSortAttribute = self.currentSortColumn.sortAttribute()
             query = self.inequalityQuery(currentSortAttribute >= pyvalue, count, True)
-        return self.constructRows(query)
+        return self._constructQueryRows(query)
     expose(rowsAfterValue)
 
 
@@ -490,13 +648,13 @@ class InequalityModel(_ScrollableBase):
             AND(currentSortAttribute == value,
                 self.itemType.storeID > item.storeID),
             count, True)
-        results = self.constructRows(firstQuery)
+        results = self._constructQueryRows(firstQuery)
         count -= len(results)
         if count:
             secondQuery = self.inequalityQuery(
                 currentSortAttribute > value,
                 count, True)
-            results.extend(self.constructRows(secondQuery))
+            results.extend(self._constructQueryRows(secondQuery))
         return results
 
 
@@ -585,7 +743,7 @@ class InequalityModel(_ScrollableBase):
             currentSortAttribute = self.currentSortColumn.sortAttribute()
             query = self.inequalityQuery(
                 currentSortAttribute < pyvalue, count, False)
-        return self.constructRows(query)[::-1]
+        return self._constructQueryRows(query)[::-1]
     expose(rowsBeforeValue)
 
 
@@ -608,12 +766,12 @@ class InequalityModel(_ScrollableBase):
             AND(currentSortAttribute == value,
                 self.itemType.storeID < item.storeID),
             count, False)
-        results = self.constructRows(firstQuery)
+        results = self._constructQueryRows(firstQuery)
         count -= len(results)
         if count:
             secondQuery = self.inequalityQuery(currentSortAttribute < value,
                                                count, False)
-            results.extend(self.constructRows(secondQuery))
+            results.extend(self._constructQueryRows(secondQuery))
         return results[::-1]
 
 
@@ -636,7 +794,7 @@ class IndexingModel(_ScrollableBase):
     @ivar currentSortColumn: An L{IColumn} representing the current
     sort key.
     """
-    def requestRowRange(self, rangeBegin, rangeEnd):
+    def requestRowRange(self, rangeBegin, rangeEnd, rowFormat=None):
         """
         Retrieve display data for the given range of rows.
 
@@ -646,9 +804,26 @@ class IndexingModel(_ScrollableBase):
         @type rangeEnd: C{int}
         @param rangeEnd: The index of the last row to retrieve.
 
-        @return: A C{list} of C{dict}s giving row data.
+        @type rowFormat: C{unicode} or C{None}
+        @param rowFormat: C{None} for a C{list} of rows, as made by
+        C{constructRows}, or C{u'columnar'} for the columns of the rows, as
+        made by C{constructColumns}.
+
+        @return: A C{list} of C{dict}s giving row data, or the columns of the
+        rows, or, if C{performQuery} returns a L{Deferred}, a L{Deferred}
+        which fires with one of those.
         """
-        return self.constructRows(self.performQuery(rangeBegin, rangeEnd))
+        if rowFormat is None:
+            construct = self.constructRows
+        elif (rowFormat == u'columnar'
+              and rowFormat in getattr(self, 'rowFormats', ())):
+            construct = self.constructColumns
+        else:
+            raise ValueError("Unknown row format: %r" % (rowFormat,))
+        results = self.performQuery(rangeBegin, rangeEnd)
+        if isinstance(results, Deferred):
+            return results.addCallback(construct)
+        return construct(results)
     expose(requestRowRange)
 
 
@@ -657,12 +832,13 @@ class IndexingModel(_ScrollableBase):
         """
         Retrieve a description of the various properties of this scrolltable.
 
-        @return: A sequence containing 5 elements.  They are, in order, a
+        @return: A sequence containing 6 elements.  They are, in order, a
         list of the names of the columns present, a mapping of column names
         to two-tuples of their type and a boolean indicating their
         sortability, the total number of rows in the scrolltable, the name
-        of the default sort column, and a boolean indicating whether or not
-        the current sort order is ascending.
+        of the default sort column, a boolean indicating whether or not
+        the current sort order is ascending, and a list of the row formats
+        other than the default which L{requestRowRange} can produce.
         """
         coltypes = {}
         for (colname, column) in self.columns.iteritems():
@@ -678,7 +854,7 @@ class IndexingModel(_ScrollableBase):
             csc = None
 
         return [self.columnNames, coltypes, self.requestCurrentSize(),
-                csc, self.isAscending]
+                csc, self.isAscending, list(getattr(self, 'rowFormats', []))]
     expose(getTableMetadata)
 
 
@@ -726,11 +902,26 @@ class ScrollableView(object):
 
     Subclasses must also mix in L{_ScrollableBase} to provide required attributes
     and methods.
+
+    @ivar rowFormats: the names of the formats, other than a list of rows,
+    which rows can be sent to the client in.  This is C{(u'columnar',)}
+    unless L{constructRows} is overridden, since L{constructColumns} would
+    not build the same rows.  Subclasses which override both to match may
+    set it to C{(u'columnar',)} themselves.
     """
 
     jsClass = u'Mantissa.ScrollTable.ScrollingWidget'
     fragmentName = 'scroller'
 
+    def rowFormats(self):
+        method = getattr(type(self), 'constructRows', None)
+        if ('constructRows' in self.__dict__
+            or getattr(method, 'im_func', None) is not
+            ScrollableView.constructRows.im_func):
+            return ()
+        return (u'columnar',)
+    rowFormats = property(rowFormats)
+
     def constructRows(self, items):
         """
         Build row objects that are serializable using Athena for sending to the
@@ -754,6 +945,35 @@ class ScrollableView(object):
         return rows
 
 
+    def constructColumns(self, items):
+        """
+        Build the same data as L{constructRows}, arranged by column rather
+        than by row, so that the name of each column is only sent to the
+        client once.
+
+        @param items: an iterable of objects compatible with my columns'
+        C{extractValue} methods.
+
+        @return: a two-element list of a list of column names and a list of
+        lists of the values in each of those columns, one for each item.  If
+        there are links to any of the items, the last column is C{u'__id__'},
+        with C{None} for the items which have no link.
+        """
+        extractors = [self.columns[colname].extractValue
+                      for colname in self.columnNames]
+        columns = [[] for extractValue in extractors]
+        links = []
+        for item in items:
+            for (values, extractValue) in zip(columns, extractors):
+                values.append(extractValue(self, item))
+            links.append(self.linkToItem(item))
+        names = list(self.columnNames)
+        if any(link is not None for link in links):
+            names.append(u'__id__')
+            columns.append(links)
+        return [names, columns]
+
+
 
 class ItemQueryScrollingFragment(IndexingModel, ScrollableView, LiveElement):
     """
@@ -763,7 +983,19 @@ class ItemQueryScrollingFragment(IndexingModel, ScrollableView, LiveElement):
 
     New code which wants to display a scrollable list of data should probably
     use L{ScrollingElement} instead.
+
+    Counts are kept in the L{_RowCountCache} of the store.  Rows are only
+    found by offset when the client asks for a part of the table near which
+    it has not asked for anything before: the end of each range of rows is
+    remembered, with the sort value and storeID of its last item, and a range
+    which begins at or after one of those positions is found by asking for
+    the items which sort after that item, which takes time proportional to
+    the size of the range rather than to its position.
+
+    @ivar maximumAnchors: the number of range ends to remember.
     """
+    maximumAnchors = 64
+
     def __init__(self, store, itemType, baseConstraint, columns,
                  defaultSortColumn=None, defaultSortAscending=True,
                  webTranslator=None,
@@ -778,6 +1010,11 @@ class ItemQueryScrollingFragment(IndexingModel, ScrollableView, LiveElement):
             defaultSortColumn,
             defaultSortAscending)
         LiveElement.__init__(self, *a, **kw)
+        # Maps row indexes to the (sort value, storeID) of the item before
+        # them, oldest first, for the store, sort and constraint they were
+        # found with.
+        self._anchors = OrderedDict()
+        self._anchorState = self._anchorColumn = self._anchorConstraint = None
 
 
     def _cannotDetermineSort(self, defaultSortColumn):
@@ -800,19 +1037,83 @@ class ItemQueryScrollingFragment(IndexingModel, ScrollableView, LiveElement):
 
 
     def performCount(self):
-        return self.store.query(self.itemType, self.baseConstraint).count()
+        return _rowCountCache(self.store).count(
+            self.itemType, self.baseConstraint)
+
+
+    def _validateAnchors(self):
+        """
+        Forget the ends of the ranges which have been found if the store, the
+        sort or the base constraint has changed since they were found.
+        """
+        state = (storeChangeToken(self.store), self.isAscending)
+        if (state != self._anchorState
+            or self.currentSortColumn is not self._anchorColumn
+            or self.baseConstraint is not self._anchorConstraint):
+            self._anchors.clear()
+            self._anchorState = state
+            self._anchorColumn = self.currentSortColumn
+            self._anchorConstraint = self.baseConstraint
+
+
+    def _afterAnchor(self, value, storeID):
+        """
+        Make a comparison which matches the items which sort after the item
+        with the given sort value and storeID.  C{NULL}s sort first.
+        """
+        sortAttribute = self.currentSortColumn.sortAttribute()
+        itemStoreID = self.itemType.storeID
+        if self.isAscending:
+            if value is None:
+                return OR(AND(sortAttribute == None, itemStoreID > storeID),
+                          sortAttribute != None)
+            return OR(sortAttribute > value,
+                      AND(sortAttribute == value, itemStoreID > storeID))
+        if value is None:
+            return AND(sortAttribute == None, itemStoreID < storeID)
+        return OR(sortAttribute < value,
+                  AND(sortAttribute == value, itemStoreID < storeID),
+                  sortAttribute == None)
 
 
     def performQuery(self, rangeBegin, rangeEnd):
+        sortAttribute = self.currentSortColumn.sortAttribute()
         if self.isAscending:
-            sort = self.currentSortColumn.sortAttribute().ascending
+            sort = (sortAttribute.ascending,
+                    self.itemType.storeID.ascending)
         else:
-            sort = self.currentSortColumn.sortAttribute().descending
-        return list(self.store.query(self.itemType,
-                                     self.baseConstraint,
-                                     offset=rangeBegin,
-                                     limit=rangeEnd - rangeBegin,
-                                     sort=sort))
+            sort = (sortAttribute.descending,
+                    self.itemType.storeID.descending)
+        if not isinstance(sortAttribute, SQLAttribute):
+            return list(self.store.query(self.itemType,
+                                         self.baseConstraint,
+                                         offset=rangeBegin,
+                                         limit=rangeEnd - rangeBegin,
+                                         sort=sort))
+
+        self._validateAnchors()
+        comparison = self.baseConstraint
+        offset = rangeBegin
+        before = [index for index in self._anchors if index <= rangeBegin]
+        if before:
+            index = max(before)
+            comparison = self._afterAnchor(*self._anchors[index])
+            if self.baseConstraint is not None:
+                comparison = AND(self.baseConstraint, comparison)
+            offset = rangeBegin - index
+        items = list(self.store.query(self.itemType,
+                                      comparison,
+                                      offset=offset,
+                                      limit=rangeEnd - rangeBegin,
+                                      sort=sort))
+        if items:
+            last = items[-1]
+            self._anchors.pop(rangeBegin + len(items), None)
+            if len(self._anchors) >= self.maximumAnchors:
+                self._anchors.popitem(last=False)
+            self._anchors[rangeBegin + len(items)] = (
+                sortAttribute.__get__(last, type(last)), last.storeID)
+        return items
 ScrollingFragment = ItemQueryScrollingFragment
 
 
@@ -878,8 +1179,8 @@ class StoreIDSequenceScrollingFragment(SequenceScrollingFragment):
     backed by a sequence of Item storeID values rather than Items themselves.
     """
     def performQuery(self, rangeBegin, rangeEnd):
-        return map(
-            self.store.getItemByID,
+        return loadItems(
+            self.store,
             super(
                 StoreIDSequenceScrollingFragment,
                 self).performQuery(rangeBegin, rangeEnd))
@@ -888,28 +1189,296 @@ class StoreIDSequenceScrollingFragment(SequenceScrollingFragment):
 class SearchResultScrollingFragment(SequenceScrollingFragment):
     """
     Scrolltable implementation like L{SequenceScrollingFragment} but which is
-    backed by a sequence of L{_PyLuceneHitWrapper} instances.
+    backed by a sequence of L{_PyLuceneHitWrapper} instances, or by a
+    L{MergedSearch}, from which only the results in each range of rows which
+    is requested are retrieved.
+
+    When the rows come from a L{MergedSearch}, C{isAscending} is the order of
+    their sort keys, and the rows are retrieved from the front of a search in
+    that order: C{elements} if its C{sortAscending} matches, or else a
+    reversed copy of it.  L{fromSearch} makes one of these for a search.
 
     XXX _PyLuceneHitWrapper should probably implement IFulltextIndexable instead
     of a subtly different interface.
     """
+    _reversedSearch = None
+
+    def fromSearch(cls, aggregator, term, keywords=None, columns=(),
+                   defaultSortAscending=True, timeout=None,
+                   webTranslator=None):
+        """
+        Search every provider of an L{ISearchAggregator} with its
+        C{mergedSearch}, and make a fragment which shows the results.
+
+        @param aggregator: the L{SearchAggregator} to search.
+
+        @param columns: the columns of the fragment.
+
+        @param defaultSortAscending: whether results are shown in ascending
+        order of their sort keys, which is the order they are searched for.
+
+        @param timeout: passed to C{mergedSearch}.
+
+        @return: a L{Deferred} which fires with the fragment.
+        """
+        d = aggregator.mergedSearch(
+            term, keywords, defaultSortAscending, timeout)
+        d.addCallback(
+            lambda results: cls(aggregator.store, results, columns, None,
+                                defaultSortAscending, webTranslator))
+        return d
+    fromSearch = classmethod(fromSearch)
+
+
+    def _itemsFromHits(self, hits):
+        """
+        Load the items which were found by a search.
+        """
+        return loadItems(
+            self.store,
+            [int(hit.uniqueIdentifier) for hit in hits])
+
+
+    def _searchInOrder(self):
+        """
+        Get the L{MergedSearch} of C{elements}, or its reversed copy, whichever
+        is sorted in the current sort order.
+        """
+        if self.elements.sortAscending == self.isAscending:
+            return self.elements
+        if self._reversedSearch is None:
+            self._reversedSearch = self.elements.reversed()
+        return self._reversedSearch
+
+
     def performQuery(self, rangeBegin, rangeEnd):
-        results = SequenceScrollingFragment.performQuery(
-            self, rangeBegin, rangeEnd)
-        return [
-            self.store.getItemByID(int(hit.uniqueIdentifier))
-            for hit
-            in results]
+        """
+        Get the items from C{rangeBegin} to C{rangeEnd}.
+
+        @return: a C{list}, or, if the rows come from a L{MergedSearch}, a
+        L{Deferred} which fires with one.
+        """
+        if not isinstance(self.elements, MergedSearch):
+            return self._itemsFromHits(SequenceScrollingFragment.performQuery(
+                    self, rangeBegin, rangeEnd))
+        d = self._searchInOrder().slice(rangeBegin, rangeEnd - rangeBegin)
+        return d.addCallback(self._itemsFromHits)
+
+
+
+class _RowWindowCache(object):
+    """
+    The windows of rows most recently sent to the client of a
+    L{ScrollingElement}.
+
+    Each window is the result of one request for rows before or after some
+    boundary, and is kept along with the number of rows which were asked for,
+    so that a later request for as many rows or fewer can be answered from
+    it.  Windows are only used while L{storeChangeToken} stays the same, and
+    are also discarded when the base constraint of the element is replaced.
+
+    @ivar maximumSize: the number of windows to keep.
+
+    @ivar hits: the number of requests which were answered from this cache.
+
+    @ivar misses: the number of requests which had to query the store.
+    """
+    maximumSize = 16
+
+    def __init__(self, store):
+        self.store = store
+        self.hits = self.misses = 0
+        self._token = self._baseConstraint = None
+        # Maps keys to (count, rows), least recently used first.
+        self._windows = OrderedDict()
+
+
+    def _validate(self, baseConstraint):
+        """
+        Discard every window if the store has been changed, or the base
+        constraint replaced, since the windows were built.
+        """
+        token = storeChangeToken(self.store)
+        if (self._token is None or baseConstraint is not self._baseConstraint
+            or token != self._token):
+            self._windows.clear()
+            self._token = token
+            self._baseConstraint = baseConstraint
+
+
+    def get(self, baseConstraint, key, count, after):
+        """
+        Look up a window of rows.
+
+        @param after: C{True} if the window runs forward from its boundary,
+        C{False} if it runs backward to it.
+
+        @return: a C{list} of at most C{count} rows, or C{None} if they are
+        not cached.
+        """
+        self._validate(baseConstraint)
+        window = self._windows.pop(key, None)
+        if window is not None:
+            self._windows[key] = window
+            fetched, rows = window
+            if count <= fetched or len(rows) < fetched:
+                self.hits += 1
+                log.msg(interface=IStatEvent, stat_scrolltable_row_cache_hits=1)
+                if count >= len(rows):
+                    return list(rows)
+                if after:
+                    return rows[:count]
+                return rows[len(rows) - count:]
+        self.misses += 1
+        log.msg(interface=IStatEvent, stat_scrolltable_row_cache_misses=1)
+        return None
+
+
+    def contains(self, baseConstraint, key, count):
+        """
+        Determine whether a window of at least C{count} rows is cached,
+        without counting it as a hit or a miss.
+        """
+        self._validate(baseConstraint)
+        window = self._windows.get(key)
+        return window is not None and window[0] >= count
+
+
+    def put(self, baseConstraint, key, count, rows):
+        """
+        Remember a window of rows, which was built from the store as it is
+        now.
+        """
+        self._validate(baseConstraint)
+        self._windows.pop(key, None)
+        if len(self._windows) >= self.maximumSize:
+            self._windows.popitem(last=False)
+        self._windows[key] = (count, list(rows))
+
+
+    def invalidate(self):
+        """
+        Discard every window.
+        """
+        self._windows.clear()
+
+
+
+class _RowChangeChannel(object):
+    """
+    The connected L{ScrollingElement}s of one store, which are told about the
+    items of that store which have been created, changed or deleted.
+
+    Elements are only referred to weakly, so that an element which is never
+    disconnected is not kept in memory.
+    """
+    def __init__(self, store):
+        self.store = store
+        self._listeners = WeakKeyDictionary()
+
+
+    def addListener(self, listener):
+        """
+        Start telling C{listener} about changed items.
+
+        @param listener: an object with an C{itemsChanged} method, which
+        takes a C{list} of items.
+        """
+        self._listeners[listener] = True
+
+
+    def removeListener(self, listener):
+        """
+        Stop telling C{listener} about changed items.
+        """
+        self._listeners.pop(listener, None)
+
+
+    def itemsChanged(self, items):
+        """
+        Tell every listener that C{items} have been created, changed or
+        deleted.
+        """
+        for listener in self._listeners.keys():
+            listener.itemsChanged(items)
+
+
+
+def _rowChangeChannel(store):
+    """
+    Get the L{_RowChangeChannel} of a store, creating it if necessary.
+    """
+    channel = getattr(store, '_rowChangeChannel', None)
+    if channel is None:
+        channel = store._rowChangeChannel = _RowChangeChannel(store)
+    return channel
+
+
+
+def itemsChanged(store, items):
+    """
+    Tell the connected L{ScrollingElement}s showing items of C{store} that
+    C{items} have been created, changed or deleted, so that they can update
+    the rows their clients have.
+
+    Items whose types mix in L{RowChangeMixin} are reported automatically.
+    Call this for other items, and after changes which bypass the in-memory
+    items (for example, bulk deletes with
+    L{axiom.store.ItemQuery.deleteFromStore}).
+
+    @param store: the L{axiom.store.Store} the items are, or were, in.
+
+    @param items: a C{list} of items.
+    """
+    channel = getattr(store, '_rowChangeChannel', None)
+    if channel is not None:
+        channel.itemsChanged(items)
+
+
+
+class RowChangeMixin(object):
+    """
+    Mixin for L{axiom.item.Item} subclasses which reports every change to an
+    item to L{itemsChanged} once it is in the database, so that the
+    L{ScrollingElement}s showing the item are updated.  It must come before
+    L{axiom.item.Item} in the bases of the class.
+    """
+    def committed(self):
+        """
+        Report this item to L{itemsChanged}.
+        """
+        store = self.store
+        super(RowChangeMixin, self).committed()
+        itemsChanged(store, [self])
 
 
 
 class ScrollingElement(InequalityModel, ScrollableView, LiveElement):
     """
     Element for scrolling lists of items, which uses L{InequalityModel}.
+
+    The rows sent to the client are kept in a L{_RowWindowCache}, and after
+    each request the window of rows which follows it in the same direction is
+    built ahead of time, so that a client which is scrolling steadily is
+    answered without a query.  Writes to C{store} are noticed automatically;
+    if the values of the columns depend on anything else, call
+    L{invalidateRows} when it changes.
+
+    While it is connected, the element also listens for items reported to
+    L{itemsChanged}.  The items reported during one reactor iteration are
+    collected, and then the new rows of the ones which are still in the table
+    and the web IDs of the ones which are not are sent to the client in one
+    call, so that it can update the rows it has instead of fetching them all
+    again.
+
+    @ivar callLater: a function like L{IReactorTime.callLater}, with which
+    rows are built ahead of time and changes are sent to the client.
     """
     jsClass = u'Mantissa.ScrollTable.ScrollTable'
     fragmentName = 'inequality-scroller'
 
+    callLater = staticmethod(reactor.callLater)
+
     def __init__(self, store, itemType, baseConstraint, columns,
                  defaultSortColumn=None, defaultSortAscending=True,
                  webTranslator=None,
@@ -918,6 +1487,210 @@ class ScrollingElement(InequalityModel, ScrollableView, LiveElement):
             self, store, itemType, baseConstraint, columns,
             defaultSortColumn, defaultSortAscending, webTranslator)
         LiveElement.__init__(self, *a, **kw)
+        self._rowCache = _RowWindowCache(store)
+        # Maps storeIDs to the items reported to itemsChanged which have not
+        # been sent to the client yet.
+        self._changedItems = {}
+        self._changeCall = None
+
+
+    def connectionMade(self):
+        """
+        Start listening for changed items.
+        """
+        LiveElement.connectionMade(self)
+        _rowChangeChannel(self.store).addListener(self)
+
+
+    def connectionLost(self, reason):
+        """
+        Stop listening for changed items, and forget the ones which have not
+        been sent to the client.
+        """
+        _rowChangeChannel(self.store).removeListener(self)
+        if self._changeCall is not None:
+            self._changeCall.cancel()
+            self._changeCall = None
+        self._changedItems.clear()
+        LiveElement.connectionLost(self, reason)
+
+
+    def itemsChanged(self, items):
+        """
+        Note that some items have been created, changed or deleted, and
+        arrange for the client to be told about the ones of C{itemType} on the
+        next iteration of the reactor.
+
+        @param items: a C{list} of items.
+        """
+        for item in items:
+            if isinstance(item, self.itemType):
+                self._changedItems[item.storeID] = item
+        if self._changedItems and self._changeCall is None:
+            self._changeCall = self.callLater(0, self._sendChangedRows)
+
+
+    def _rowChanges(self, changedItems):
+        """
+        Find out how the rows of the table have been affected by changes to
+        some items.
+
+        @param changedItems: a C{dict} mapping storeIDs to items which have
+        been created, changed or deleted.
+
+        @return: a two-tuple of a C{list} of two-element C{list}s of the web
+        ID of the row which now comes immediately before a changed row, or
+        C{None} if it is the first row, and the changed row, in the order they
+        are shown; and a C{list} of the web IDs of the changed items which are
+        no longer in the table.
+        """
+        present = []
+        for chunk in _chunks(sorted(changedItems)):
+            comparison = self.itemType.storeID.oneOf(chunk)
+            if self.baseConstraint is not None:
+                comparison = AND(self.baseConstraint, comparison)
+            present.extend(self.store.query(self.itemType, comparison))
+        sortAttribute = self.currentSortColumn.sortAttribute()
+        present.sort(
+            key=lambda item: (sortAttribute.__get__(item, type(item)),
+                              item.storeID),
+            reverse=not self.isAscending)
+        changes = []
+        for (item, row) in zip(present, self.constructRows(present)):
+            if self.isAscending:
+                previous = self.rowsBeforeItem(item, 1)
+            else:
+                previous = self.rowsAfterItem(item, 1)
+            if previous:
+                previous = previous[0].get(u'__id__')
+            else:
+                previous = None
+            changes.append([previous, row])
+        presentIDs = set(item.storeID for item in present)
+        removed = [
+            self.linkToItem(item)
+            for (storeID, item) in sorted(changedItems.iteritems())
+            if storeID not in presentIDs]
+        return changes, removed
+
+
+    def _sendChangedRows(self):
+        """
+        Send the client the rows of the items reported to L{itemsChanged}
+        since this was last called.
+        """
+        self._changeCall = None
+        changedItems = self._changedItems
+        self._changedItems = {}
+        changes, removed = self._rowChanges(changedItems)
+        log.msg(interface=IStatEvent,
+                stat_scrolltable_rows_pushed=len(changes) + len(removed))
+        return self.callRemote('rowsChanged', changes, removed)
+
+
+    def invalidateRows(self):
+        """
+        Discard the rows which have been built, so that they are built again
+        from the store when they are next requested.
+        """
+        self._rowCache.invalidate()
+
+
+    def _rowWindow(self, after, boundaryType, boundary, count, build):
+        """
+        Get a window of rows from the cache, or build and cache it, and then
+        arrange for the next window in the same direction to be built.
+
+        @param after: C{True} for rows after C{boundary}, C{False} for rows
+        before it.
+
+        @param boundaryType: C{u'value'} if C{boundary} is a sort column value,
+        or C{u'row'} if it is the web ID of a row.
+
+        @param build: a one-argument callable which takes a count and returns
+        that many rows.
+        """
+        key = (self.currentSortColumn.attributeID, after, boundaryType,
+               boundary)
+        try:
+            hash(key)
+        except TypeError:
+            return build(count)
+        rows = self._rowCache.get(self.baseConstraint, key, count, after)
+        if rows is None:
+            rows = build(count)
+            self._rowCache.put(self.baseConstraint, key, count, rows)
+        if rows and len(rows) == count:
+            if after:
+                edge = rows[-1]
+            else:
+                edge = rows[0]
+            webID = edge.get(u'__id__')
+            if webID is not None:
+                self.callLater(0, self._prefetch, after, webID, count)
+        return rows
+
+
+    def _prefetch(self, after, webID, count):
+        """
+        Build the window of C{count} rows after or before the row with the
+        given web ID, unless it is already cached.
+        """
+        key = (self.currentSortColumn.attributeID, after, u'row', webID)
+        if self._rowCache.contains(self.baseConstraint, key, count):
+            return
+        item = self.webTranslator.fromWebID(webID)
+        if item is None:
+            return
+        if after:
+            rows = self.rowsAfterItem(item, count)
+        else:
+            rows = self.rowsBeforeItem(item, count)
+        self._rowCache.put(self.baseConstraint, key, count, rows)
+
+
+    def rowsAfterValue(self, value, count):
+        """
+        Retrieve some rows at or after a given sort-column value, as
+        L{InequalityModel.rowsAfterValue} does, from the cache if possible.
+        """
+        return self._rowWindow(
+            True, u'value', value, count,
+            lambda count: InequalityModel.rowsAfterValue(self, value, count))
+    expose(rowsAfterValue)
+
+
+    def rowsBeforeValue(self, value, count):
+        """
+        Retrieve some rows before a given sort-column value, as
+        L{InequalityModel.rowsBeforeValue} does, from the cache if possible.
+        """
+        return self._rowWindow(
+            False, u'value', value, count,
+            lambda count: InequalityModel.rowsBeforeValue(self, value, count))
+    expose(rowsBeforeValue)
+
+
+    def rowsAfterRow(self, rowObject, count):
+        """
+        Retrieve some rows after a given row, as
+        L{InequalityModel.rowsAfterRow} does, from the cache if possible.
+        """
+        return self._rowWindow(
+            True, u'row', rowObject['__id__'], count,
+            lambda count: InequalityModel.rowsAfterRow(self, rowObject, count))
+    expose(rowsAfterRow)
+
+
+    def rowsBeforeRow(self, rowObject, count):
+        """
+        Retrieve some rows before a given row, as
+        L{InequalityModel.rowsBeforeRow} does, from the cache if possible.
+        """
+        return self._rowWindow(
+            False, u'row', rowObject['__id__'], count,
+            lambda count: InequalityModel.rowsBeforeRow(self, rowObject, count))
+    expose(rowsBeforeRow)
 
 
     def _getColumnList(self):
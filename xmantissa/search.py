@@ -2,14 +2,17 @@
 
 from __future__ import division
 
+from collections import OrderedDict
+
 from zope.interface import implements
 
-from twisted.internet import defer
+from twisted.internet import defer, reactor
 from twisted.python import log, components
 
 from nevow import inevow, athena, tags
 
 from axiom import attributes, item
+from axiom.iaxiom import IStatEvent
 from axiom.upgrade import registerDeletionUpgrader
 
 from xmantissa import ixmantissa
@@ -36,6 +39,327 @@ registerDeletionUpgrader(SearchResult, 1, 2)
 
 
 
+class _ProviderResults(object):
+    """
+    The results of one L{ISearchProvider} which have been retrieved for a
+    L{MergedSearch}, in the order the provider sorted them.
+
+    @ivar hits: the results retrieved so far.
+
+    @ivar position: the index in C{hits} of the next result to be merged.
+
+    @ivar done: whether all of the provider's results have been retrieved,
+    or the provider has been given up on.
+    """
+    def __init__(self, provider):
+        self.provider = provider
+        self.hits = []
+        self.position = 0
+        self.done = False
+
+
+    def starved(self):
+        """
+        Determine whether more results must be retrieved before the next one
+        can be merged.
+        """
+        return not self.done and self.position == len(self.hits)
+
+
+    def next(self):
+        """
+        Get the next result to be merged, or C{None} if there are none left.
+        """
+        if self.position < len(self.hits):
+            return self.hits[self.position]
+        return None
+
+
+
+class MergedSearch(object):
+    """
+    A search of several L{ISearchProvider}s, whose results are retrieved from
+    each of them a page at a time and merged by sort key as they are needed.
+
+    Every result is expected to have a C{sortKey} attribute, and each provider
+    to return its results sorted by it.
+
+    @ivar pageSize: the smallest number of results to ask a provider for at a
+    time.
+
+    @ivar timeout: the number of seconds to wait for a provider to return
+    results before cancelling the search of that provider and leaving its
+    remaining results out, or C{None} to wait forever.
+
+    @ivar total: the number of results, or C{None} if it has not been counted.
+
+    @ivar failed: whether any provider has failed or been cancelled, so that
+    some results may be missing.
+    """
+    pageSize = 50
+    failed = False
+
+    def __init__(self, providers, term, keywords=None, sortAscending=True,
+                 timeout=None, clock=reactor):
+        self.term = term
+        self.keywords = keywords
+        self.sortAscending = sortAscending
+        self.timeout = timeout
+        self.clock = clock
+        self.total = None
+        self._providers = [_ProviderResults(p) for p in providers]
+        self._merged = []
+
+
+    def _withTimeout(self, d, provider):
+        """
+        Cancel C{d} if it has not fired after C{timeout} seconds, and log and
+        suppress any failure.
+        """
+        if self.timeout is not None:
+            call = self.clock.callLater(self.timeout, d.cancel)
+            def cancelTimeout(result):
+                if call.active():
+                    call.cancel()
+                return result
+            d.addBoth(cancelTimeout)
+        def failed(err):
+            self.failed = True
+            if err.check(defer.CancelledError):
+                log.msg("Search of %r took more than %s seconds; giving up "
+                        "on it." % (provider, self.timeout))
+            else:
+                log.err(err)
+            return None
+        return d.addErrback(failed)
+
+
+    def _retrieve(self, results, count):
+        """
+        Retrieve the next C{count} results of one provider, or all of them if
+        C{count} is C{None}.
+        """
+        d = defer.maybeDeferred(
+            results.provider.search, self.term, self.keywords, count,
+            len(results.hits), self.sortAscending)
+        def retrieved(hits):
+            if hits is None:
+                results.done = True
+                return
+            hits = list(hits)
+            results.hits.extend(hits)
+            if count is None or len(hits) < count:
+                results.done = True
+        return self._withTimeout(d, results.provider).addCallback(retrieved)
+
+
+    def _merge(self, end):
+        """
+        Merge results until there are C{end} of them, or all of them if
+        C{end} is C{None}, retrieving more from the providers as necessary.
+
+        @return: a L{Deferred} which fires when the results have been merged.
+        """
+        if self.sortAscending:
+            better = lambda a, b: a < b
+        else:
+            better = lambda a, b: a > b
+        while end is None or len(self._merged) < end:
+            starved = [r for r in self._providers if r.starved()]
+            if starved:
+                if end is None:
+                    count = None
+                else:
+                    count = max(end - len(self._merged), self.pageSize)
+                d = defer.gatherResults(
+                    [self._retrieve(results, count) for results in starved])
+                d.addCallback(lambda ign: self._merge(end))
+                return d
+            best = None
+            for results in self._providers:
+                hit = results.next()
+                if hit is None:
+                    continue
+                if best is None or better(hit.sortKey, best.next().sortKey):
+                    best = results
+            if best is None:
+                break
+            self._merged.append(best.next())
+            best.position += 1
+        return defer.succeed(None)
+
+
+    def count(self):
+        """
+        Count the results of this search, by adding up the counts of each
+        provider.  Providers which fail to count their results, or take more
+        than C{timeout} seconds to, are not counted.
+
+        @return: a L{Deferred} which fires with the number of results, which
+        is also kept as C{total}.
+        """
+        def countProvider(results):
+            if self.keywords:
+                d = defer.maybeDeferred(
+                    results.provider.count, self.term, self.keywords)
+            else:
+                d = defer.maybeDeferred(results.provider.count, self.term)
+            return self._withTimeout(d, results.provider)
+        d = defer.gatherResults(
+            [countProvider(results) for results in self._providers])
+        def counted(counts):
+            self.total = sum([n for n in counts if n is not None])
+            return self.total
+        return d.addCallback(counted)
+
+
+    def __len__(self):
+        """
+        Get the number of results of this search, which must have been
+        counted.  If all of the results have been merged, this is the number
+        of them, which may be less than C{total} if providers failed.
+        """
+        if all([results.done for results in self._providers]):
+            if all([results.position == len(results.hits)
+                    for results in self._providers]):
+                return len(self._merged)
+        if self.total is None:
+            raise ValueError("MergedSearch has not been counted")
+        return self.total
+
+
+    def reversed(self):
+        """
+        Get a search of the same providers for the same results as this one,
+        sorted the other way, whose results are retrieved separately.  If
+        this search has been counted, so has the new one.
+
+        @rtype: L{MergedSearch}
+        """
+        results = MergedSearch(
+            [r.provider for r in self._providers], self.term, self.keywords,
+            not self.sortAscending, self.timeout, self.clock)
+        results.pageSize = self.pageSize
+        results.total = self.total
+        return results
+
+
+    def slice(self, offset=0, count=None):
+        """
+        Retrieve some of the results of this search.
+
+        @param offset: the index of the first result to retrieve.
+
+        @param count: the number of results to retrieve, or C{None} to
+        retrieve all of them from C{offset} on.
+
+        @return: a L{Deferred} which fires with a C{list} of the results.
+        """
+        if count is None:
+            end = None
+        else:
+            end = offset + count
+        d = self._merge(end)
+        d.addCallback(lambda ign: self._merged[offset:end])
+        return d
+
+
+
+def _freeze(value):
+    """
+    Convert the arguments of a search into a hashable value.
+    """
+    if isinstance(value, dict):
+        return tuple(sorted([(k, _freeze(v)) for (k, v) in value.iteritems()]))
+    if isinstance(value, (list, tuple)):
+        return tuple([_freeze(v) for v in value])
+    return value
+
+
+
+class SearchResultCache(object):
+    """
+    A least-recently-used cache of the results of searches of the providers of
+    one store.
+
+    Each result is stored along with the generation of the providers it came
+    from: a tuple of the values returned by the C{generation} method of each
+    of them, which changes whenever their documents do (see
+    L{xmantissa.fulltext.RemoteIndexer.generation}).  A result is only used
+    if the generation has not changed since it was stored.  Searches of
+    providers without a C{generation} method are not cached.
+
+    @ivar maximumSize: the number of results to keep.
+
+    @ivar hits: the number of searches which were answered from this cache.
+
+    @ivar misses: the number of cacheable searches which were not.
+    """
+    maximumSize = 100
+
+    def __init__(self, maximumSize=None):
+        if maximumSize is not None:
+            self.maximumSize = maximumSize
+        self.hits = self.misses = 0
+        # Maps keys to (generation, result), least recently used first.
+        self._entries = OrderedDict()
+
+
+    def generation(self, providers):
+        """
+        Get the generation of some search providers, or C{None} if any of
+        them cannot report one.
+        """
+        generation = []
+        for provider in providers:
+            getGeneration = getattr(provider, 'generation', None)
+            if getGeneration is None:
+                return None
+            generation.append(getGeneration())
+        return tuple(generation)
+
+
+    def get(self, key, generation, usable=None):
+        """
+        Look up a result, counting and logging the lookup as a hit or a miss.
+
+        @param usable: if not C{None}, a one-argument callable which
+        determines whether a result which was found may still be used.
+
+        @return: a two-tuple of a C{bool} indicating whether a result for
+        C{key} from providers of the given generation was found, and the
+        result.
+        """
+        entry = self._entries.pop(key, None)
+        if (entry is not None and entry[0] == generation and
+            (usable is None or usable(entry[1]))):
+            self._entries[key] = entry
+            self.hits += 1
+            log.msg(interface=IStatEvent, stat_search_cache_hits=1)
+            return True, entry[1]
+        self.misses += 1
+        log.msg(interface=IStatEvent, stat_search_cache_misses=1)
+        return False, None
+
+
+    def put(self, key, generation, result):
+        """
+        Store a result.
+        """
+        self._entries.pop(key, None)
+        if len(self._entries) >= self.maximumSize:
+            self._entries.popitem(last=False)
+        self._entries[key] = (generation, result)
+
+
+    def invalidate(self):
+        """
+        Drop every result in this cache.
+        """
+        self._entries.clear()
+
+
+
 class SearchAggregator(item.Item):
     implements(ixmantissa.ISearchAggregator, ixmantissa.INavigableElement)
 
@@ -46,6 +370,38 @@ class SearchAggregator(item.Item):
     installedOn = attributes.reference()
     searches = attributes.integer(default=0)
 
+    _cache = attributes.inmemory()
+
+    def activate(self):
+        self._cache = SearchResultCache()
+
+
+    def _cached(self, key, search, usable=None):
+        """
+        Get a result from C{_cache}, or compute and cache it.
+
+        @param search: a one-argument callable, taking the list of providers,
+        which returns a L{Deferred} that fires with a two-tuple of the result
+        and a C{bool} indicating whether the result is complete enough to
+        cache.
+
+        @param usable: passed to L{SearchResultCache.get}.
+
+        @return: a L{Deferred} which fires with the result.
+        """
+        providers = self.providers()
+        generation = self._cache.generation(providers)
+        if generation is None:
+            return search(providers).addCallback(lambda (result, ok): result)
+        found, result = self._cache.get(key, generation, usable)
+        if found:
+            return defer.succeed(result)
+        def searched((result, ok)):
+            if ok:
+                self._cache.put(key, generation, result)
+            return result
+        return search(providers).addCallback(searched)
+
     # INavigableElement
     def getTabs(self):
         return []
@@ -59,39 +415,75 @@ class SearchAggregator(item.Item):
     def count(self, term):
         def countedHits(results):
             total = 0
+            ok = True
             for (success, result) in results:
                 if success:
                     total += result
                 else:
+                    ok = False
                     log.err(result)
-            return total
+            return total, ok
 
-        return defer.DeferredList([
-            provider.count(term)
-            for provider
-            in self.providers()], consumeErrors=True).addCallback(countedHits)
+        return self._cached(
+            ('count', term),
+            lambda providers: defer.DeferredList([
+                    provider.count(term)
+                    for provider
+                    in providers], consumeErrors=True).addCallback(
+                countedHits))
 
 
     def search(self, *a, **k):
         self.searches += 1
 
-        d = defer.DeferredList([
-            provider.search(*a, **k)
-            for provider in self.providers()
-            ], consumeErrors=True)
-
-        def searchCompleted(results):
-            allSearchResults = []
-            for (success, result) in results:
-                if success:
-                    allSearchResults.append(result)
-                else:
-                    log.err(result)
-            return allSearchResults
-        d.addCallback(searchCompleted)
-
-        return d
-
+        def search(providers):
+            d = defer.DeferredList([
+                provider.search(*a, **k)
+                for provider in providers
+                ], consumeErrors=True)
+
+            def searchCompleted(results):
+                allSearchResults = []
+                ok = True
+                for (success, result) in results:
+                    if success:
+                        allSearchResults.append(result)
+                    else:
+                        ok = False
+                        log.err(result)
+                return allSearchResults, ok
+            d.addCallback(searchCompleted)
+            return d
+
+        d = self._cached(('search', _freeze(a), _freeze(k)), search)
+        return d.addCallback(list)
+
+
+    def mergedSearch(self, term, keywords=None, sortAscending=True,
+                     timeout=None):
+        """
+        Search every provider, merging their results lazily.
+
+        Results are cached, along with those of L{count} and L{search}, in a
+        L{SearchResultCache}, so the same L{MergedSearch} is returned for the
+        same search until the providers' documents change or any of them
+        fails.
+
+        @param timeout: the number of seconds to wait for a provider before
+        leaving its results out.
+
+        @return: a L{Deferred} which fires with a L{MergedSearch} when its
+        results have been counted.
+        """
+        self.searches += 1
+        def search(providers):
+            results = MergedSearch(providers, term, keywords, sortAscending,
+                                   timeout)
+            return results.count().addCallback(
+                lambda ign: (results, not results.failed))
+        return self._cached(
+            ('mergedSearch', term, _freeze(keywords), sortAscending, timeout),
+            search, lambda results: not results.failed)
 
 
 def parseSearchTerm(term):
@@ -7,7 +7,7 @@ This module provides various abstractions for sharing public data in Axiom.
 import os
 import warnings
 
-from zope.interface import implementedBy, directlyProvides, Interface
+from zope.interface import implements, implementedBy, directlyProvides, Interface
 
 from twisted.python.reflect import qual, namedAny
 from twisted.protocols.amp import Argument, Box, parseString
@@ -15,14 +15,19 @@ from twisted.protocols.amp import Argument, Box, parseString
 from epsilon.structlike import record
 
 from axiom import userbase
+from axiom.iaxiom import IQuery, IComparison
 from axiom.item import Item
-from axiom.attributes import reference, text, AND
+from axiom.attributes import reference, text, integer, compoundIndex, AND, OR
 from axiom.upgrade import registerUpgrader
 
+from xmantissa._storechange import storeChangeToken
+
 
 ALL_IMPLEMENTED_DB = u'*'
 ALL_IMPLEMENTED = object()
 
+_unspecified = object()
+
 
 class NoSuchShare(Exception):
     """
@@ -58,6 +63,218 @@ class RoleRelationship(Item):
         """)
 
 
+
+class RoleMembership(Item):
+    """
+    RoleMembership is the transitive closure of L{RoleRelationship}: there is
+    one for every pair of roles where 'member' is authorized to act as
+    'group', including one for each role with itself.  It is maintained by
+    L{Role.becomeMemberOf} and L{Role.deleteFromStore} so that
+    L{Role.allRoles} can be answered with a single query.
+    """
+    schemaVersion = 1
+    typeName = 'sharing_role_membership'
+
+    member = reference(
+        doc="""
+        This is a reference to a L{Role} which may act as my 'group' attribute.
+        """, allowNone=False, whenDeleted=reference.CASCADE)
+
+    group = reference(
+        doc="""
+        This is a reference to a L{Role} which my 'member' attribute is a
+        direct or indirect member of.
+        """, allowNone=False, whenDeleted=reference.CASCADE, indexed=True)
+
+    depth = integer(
+        doc="""
+        The length of the shortest chain of L{RoleRelationship}s leading from
+        'member' to 'group'; 0 if they are the same role.
+        """, allowNone=False)
+
+    compoundIndex(member, depth)
+
+
+
+def _addMembership(member, group, depth):
+    """
+    Record that C{member} may act as C{group}, at the given C{depth}, unless a
+    shorter path between them is already known.
+    """
+    membership = member.store.findUnique(
+        RoleMembership,
+        AND(RoleMembership.member == member,
+            RoleMembership.group == group),
+        default=None)
+    if membership is None:
+        RoleMembership(store=member.store,
+                       member=member,
+                       group=group,
+                       depth=depth)
+    elif depth < membership.depth:
+        membership.depth = depth
+
+
+
+def _walkRoles(role):
+    """
+    Find all the roles that C{role} may act as by following
+    L{RoleRelationship}s, without consulting L{RoleMembership}.
+
+    @return: a C{list} of two-tuples of L{Role} and the depth at which it was
+        first found, in breadth-first order, beginning with C{(role, 0)}.
+    """
+    found = [(role, 0)]
+    seen = set([role])
+    for (current, depth) in found:
+        for groupRole in role.store.query(
+            Role,
+            AND(RoleRelationship.member == current,
+                RoleRelationship.group == Role.storeID),
+            sort=RoleRelationship.storeID.ascending):
+            if groupRole not in seen:
+                seen.add(groupRole)
+                found.append((groupRole, depth + 1))
+    return found
+
+
+
+def _rebuildMembershipsFor(role):
+    """
+    Discard and recompute all of the L{RoleMembership}s whose member is
+    C{role}.
+    """
+    role.store.query(RoleMembership,
+                     RoleMembership.member == role).deleteFromStore()
+    for (groupRole, depth) in _walkRoles(role):
+        RoleMembership(store=role.store,
+                       member=role,
+                       group=groupRole,
+                       depth=depth)
+
+
+
+def rebuildRoleMemberships(store):
+    """
+    Recompute every L{RoleMembership} in C{store} from its
+    L{RoleRelationship}s.  This is needed for stores whose roles were created
+    before L{RoleMembership} existed, and is always safe to run.
+
+    @return: the number of L{Role}s whose memberships were rebuilt.
+    """
+    def tx():
+        count = 0
+        for role in store.query(Role, sort=Role.storeID.ascending):
+            _rebuildMembershipsFor(role)
+            count += 1
+        return count
+    return store.transact(tx)
+
+
+
+class _ShareCache(object):
+    """
+    A cache of the shares that have been resolved for the roles in a single
+    store, used by L{Role.getShare}.
+
+    Entries are only added outside of transactions, and are kept only for as
+    long as L{storeChangeToken} stays the same, so the cache never disagrees
+    with the database, whichever connection writes to it.  Shared items are
+    remembered by storeID, so that the cache keeps no items in memory.
+
+    @ivar maximumSize: the number of entries after which the cache is
+    discarded rather than grown.
+    """
+    maximumSize = 1000
+
+    def __init__(self, store):
+        self.store = store
+        self._storeToken = None
+        self._resolved = {}
+
+
+    def _validate(self):
+        """
+        Discard everything in this cache if the store may have changed since
+        it was filled.
+        """
+        storeToken = storeChangeToken(self.store)
+        if storeToken != self._storeToken:
+            self._resolved.clear()
+            self._storeToken = storeToken
+
+
+    def get(self, role, shareID):
+        """
+        @return: the cached resolution of C{shareID} for C{role}; see
+        L{_resolveShare}.  If there is none, C{_unspecified}.
+        """
+        self._validate()
+        resolved = self._resolved.get((role.storeID, shareID), _unspecified)
+        if resolved is None or resolved is _unspecified:
+            return resolved
+        sharedItemID, interfaces = resolved
+        return self.store.getItemByID(sharedItemID), interfaces
+
+
+    def put(self, role, shareID, resolved):
+        """
+        Remember the resolution of C{shareID} for C{role}.
+        """
+        self._validate()
+        if len(self._resolved) >= self.maximumSize:
+            self._resolved.clear()
+        if resolved is not None:
+            sharedItem, interfaces = resolved
+            resolved = (sharedItem.storeID, interfaces)
+        self._resolved[role.storeID, shareID] = resolved
+
+
+
+def _shareCache(store):
+    """
+    Get the L{_ShareCache} of a store, creating it if necessary.
+    """
+    cache = getattr(store, '_shareCache', None)
+    if cache is None:
+        cache = store._shareCache = _ShareCache(store)
+    return cache
+
+
+
+def _resolveShare(role, shareID):
+    """
+    Find the item shared to C{role}, or any of its groups, as C{shareID}, and
+    the interfaces it is shared with, consulting and populating the share
+    cache of the role's store.
+
+    @return: a two-tuple of the shared L{Item} and a C{tuple} of interfaces, or
+    C{None} if there is no such share.
+    """
+    store = role.store
+    cache = _shareCache(store)
+    resolved = cache.get(role, shareID)
+    if resolved is not _unspecified:
+        return resolved
+    shares = list(
+        store.query(Share,
+                    AND(Share.shareID == shareID,
+                        Share.sharedTo.oneOf(role.allRoles())),
+                    sort=Share.storeID.ascending))
+    if shares:
+        interfaces = []
+        for share in shares:
+            interfaces += share.sharedInterfaces
+        resolved = (shares[0].sharedItem, tuple(interfaces))
+    else:
+        resolved = None
+    # Anything read inside a transaction might yet be reverted.
+    if store.autocommit:
+        cache.put(role, shareID, resolved)
+    return resolved
+
+
+
 def _entuple(r):
     """
     Convert a L{record} to a tuple.
@@ -194,33 +411,91 @@ class Role(Item):
 
         @param groupRole: The role that this group should become a member of.
         """
-        self.store.findOrCreate(RoleRelationship,
-                                group=groupRole,
-                                member=self)
+        def tx():
+            self.store.findOrCreate(RoleRelationship,
+                                    group=groupRole,
+                                    member=self)
+            # Everything that can act as me can now act as everything that
+            # groupRole can act as.
+            members = [(m.member, m.depth)
+                       for m in self._membershipsAs(RoleMembership.group)]
+            groups = [(m.group, m.depth)
+                      for m in groupRole._membershipsAs(RoleMembership.member)]
+            for (memberRole, memberDepth) in members:
+                for (ancestorRole, groupDepth) in groups:
+                    _addMembership(memberRole, ancestorRole,
+                                   memberDepth + 1 + groupDepth)
+        self.store.transact(tx)
+
+
+    def _membershipsAs(self, attribute):
+        """
+        Retrieve the L{RoleMembership}s which refer to this role via the given
+        attribute, computing this role's own memberships first if it predates
+        L{RoleMembership}.
 
+        @param attribute: L{RoleMembership.member} or L{RoleMembership.group}.
 
-    def allRoles(self, memo=None):
+        @return: a C{list} of L{RoleMembership}s.
         """
-        Identify all the roles that this role is authorized to act as.
+        if self.store.findUnique(
+            RoleMembership,
+            AND(RoleMembership.member == self,
+                RoleMembership.group == self),
+            default=None) is None:
+            _rebuildMembershipsFor(self)
+        return list(self.store.query(RoleMembership, attribute == self))
+
+
+    def stored(self):
+        """
+        Record that this role may act as itself.
+        """
+        RoleMembership(store=self.store, member=self, group=self, depth=0)
 
-        @param memo: used only for recursion.  Do not pass this.
+
+    def deleteFromStore(self, deleteObject=True):
+        """
+        Delete this role, along with any L{RoleRelationship}s which refer to
+        it, and recompute the L{RoleMembership}s of the roles which were
+        members of it.
+        """
+        if not deleteObject:
+            return super(Role, self).deleteFromStore(deleteObject)
+        def tx():
+            formerMembers = list(self.store.query(
+                    Role,
+                    AND(RoleMembership.group == self,
+                        RoleMembership.member == Role.storeID,
+                        RoleMembership.member != self)))
+            self.store.query(
+                RoleRelationship,
+                OR(RoleRelationship.member == self,
+                   RoleRelationship.group == self)).deleteFromStore()
+            super(Role, self).deleteFromStore(deleteObject)
+            for memberRole in formerMembers:
+                _rebuildMembershipsFor(memberRole)
+        self.store.transact(tx)
+
+
+    def allRoles(self):
+        """
+        Identify all the roles that this role is authorized to act as.
 
         @return: an iterator of all roles that this role is a member of,
-        including itself.
-        """
-        if memo is None:
-            memo = set()
-        elif self in memo:
-            # this is bad, but we have successfully detected and prevented the
-            # only really bad symptom, an infinite loop.
-            return
-        memo.add(self)
-        yield self
-        for groupRole in self.store.query(Role,
-                                          AND(RoleRelationship.member == self,
-                                              RoleRelationship.group == Role.storeID)):
-            for roleRole in groupRole.allRoles(memo):
-                yield roleRole
+        including itself, nearest first.
+        """
+        roles = list(self.store.query(
+                Role,
+                AND(RoleMembership.member == self,
+                    RoleMembership.group == Role.storeID),
+                sort=(RoleMembership.depth.ascending,
+                      RoleMembership.storeID.ascending)))
+        if not roles:
+            # This role predates RoleMembership, and nothing has caused its
+            # memberships to be computed yet.
+            roles = [role for (role, depth) in _walkRoles(self)]
+        return iter(roles)
 
 
     def shareItem(self, sharedItem, shareID=None, interfaces=ALL_IMPLEMENTED):
@@ -260,18 +535,11 @@ class Role(Item):
         @raise: L{NoSuchShare} if there is no item shared to the given role for
         the given shareID.
         """
-        shares = list(
-            self.store.query(Share,
-                             AND(Share.shareID == shareID,
-                                 Share.sharedTo.oneOf(self.allRoles()))))
-        interfaces = []
-        for share in shares:
-            interfaces += share.sharedInterfaces
-        if shares:
-            return SharedProxy(shares[0].sharedItem,
-                               interfaces,
-                               shareID)
-        raise NoSuchShare()
+        resolved = _resolveShare(self, shareID)
+        if resolved is None:
+            raise NoSuchShare()
+        sharedItem, interfaces = resolved
+        return SharedProxy(sharedItem, interfaces, shareID)
 
 
     def asAccessibleTo(self, query):
@@ -280,33 +548,185 @@ class Role(Item):
         role can access.
         @type query: an L{iaxiom.IQuery} provider.
 
-        @return: an iterable which yields the shared proxies that are available
-        to the given role, from the given query.
+        @return: an L{iaxiom.IQuery} provider which yields the shared proxies
+        that are available to the given role, from the given query.
         """
-        # XXX TODO #2371: this method really *should* be returning an L{IQuery}
-        # provider as well, but that is kind of tricky to do.  Currently, doing
-        # queries leaks authority, because the resulting objects have stores
-        # and "real" items as part of their interface; having this be a "real"
-        # query provider would obviate the need to escape the L{SharedProxy}
-        # security constraints in order to do any querying.
-        allRoles = list(self.allRoles())
-        count = 0
-        unlimited = query.cloneQuery(limit=None)
-        for result in unlimited:
-            allShares = list(query.store.query(
-                    Share,
-                    AND(Share.sharedItem == result,
-                        Share.sharedTo.oneOf(allRoles))))
+        return _AccessibleQuery(self, query)
+
+
+
+class _SharedWith(object):
+    """
+    An L{IComparison} which matches items of a particular type that have been
+    shared to any of a collection of roles.
+
+    This is expressed as a correlated I{EXISTS} against L{Share}, rather than
+    a join, so that it neither duplicates items shared more than once nor
+    prevents SQLite from walking the index of the query's sort and stopping
+    at its limit.
+
+    @ivar tableClass: the L{Item} subclass being queried.
+
+    @ivar roles: a C{list} of L{Role}s.
+    """
+    implements(IComparison)
+
+    def __init__(self, tableClass, roles):
+        self.tableClass = tableClass
+        self.roles = roles
+
+
+    def getInvolvedTables(self):
+        return [self.tableClass]
+
+
+    def getQuery(self, store):
+        return 'EXISTS (SELECT * FROM %s WHERE %s = %s AND %s IN (%s))' % (
+            store.getTableName(Share),
+            Share.sharedItem.getColumnName(store),
+            self.tableClass.storeID.getColumnName(store),
+            Share.sharedTo.getColumnName(store),
+            ', '.join(['?'] * len(self.roles)))
+
+
+    def getArgs(self, store):
+        return [role.storeID for role in self.roles]
+
+
+
+class _AccessibleQuery(object):
+    """
+    An L{IQuery} provider for the L{SharedProxy}s of the results of an item
+    query which have been shared with a particular L{Role}.
+
+    Access is determined in SQL, by L{_SharedWith}, so the limit, offset,
+    sort and count of the wrapped query apply to the accessible items only.
+    Each page of results is wrapped in L{SharedProxy}s using a single
+    additional L{Share} query.
+
+    @ivar role: the L{Role} whose access is being checked.
+
+    @ivar query: the wrapped item query.  This must be an L{ItemQuery}, not
+    merely an L{IQuery} provider, since its comparison, sort and offset are
+    used to construct the joined query.
+
+    @ivar batchSize: the maximum number of items whose shares are retrieved
+    with a single query.
+    """
+    implements(IQuery)
+
+    batchSize = 100
+
+    def __init__(self, role, query):
+        self.role = role
+        self.query = query
+        self.store = query.store
+        self.limit = query.limit
+        self._roles = list(role.allRoles())
+
+
+    def __repr__(self):
+        return '_AccessibleQuery(%r, %r)' % (self.role, self.query)
+
+
+    def cloneQuery(self, limit=_unspecified, sort=_unspecified):
+        """
+        Create a copy of this query with a different limit or sort.
+
+        @return: an L{_AccessibleQuery} wrapping a clone of the original query.
+        """
+        kw = {}
+        if limit is not _unspecified:
+            kw['limit'] = limit
+        if sort is not _unspecified:
+            kw['sort'] = sort
+        return self.__class__(self.role, self.query.cloneQuery(**kw))
+
+
+    def _accessibleComparison(self):
+        """
+        Construct a comparison which matches the results of the wrapped query
+        which have been shared to any of my roles.
+
+        @return: an L{IComparison} provider.
+        """
+        accessible = _SharedWith(self.query.tableClass, self._roles)
+        if self.query.comparison is not None:
+            accessible = AND(self.query.comparison, accessible)
+        return accessible
+
+
+    def _accessibleItems(self):
+        """
+        Construct a query for the items of the wrapped query which have been
+        shared to any of my roles.
+
+        @return: an L{IQuery} provider which yields L{Item}s.
+        """
+        return self.store.query(
+            self.query.tableClass, self._accessibleComparison(),
+            limit=self.query.limit,
+            offset=self.query.offset,
+            sort=self.query.sort)
+
+
+    def _proxiesFor(self, items):
+        """
+        Wrap some accessible items in L{SharedProxy}s.
+
+        @param items: a C{list} of L{Item}s, each of which is shared to at
+        least one of my roles.
+
+        @return: a C{list} of L{SharedProxy}s, in the same order as C{items}.
+        """
+        sharesByItem = {}
+        for share in self.store.query(
+            Share,
+            AND(Share.sharedItem.oneOf(items),
+                Share.sharedTo.oneOf(self._roles)),
+            sort=Share.storeID.ascending):
+            sharesByItem.setdefault(share.sharedItem, []).append(share)
+        proxies = []
+        for item in items:
+            shares = sharesByItem[item]
             interfaces = []
-            for share in allShares:
+            for share in shares:
                 interfaces += share.sharedInterfaces
-            if allShares:
-                count += 1
-                yield SharedProxy(result, interfaces, allShares[0].shareID)
-                if count == query.limit:
-                    return
+            proxies.append(SharedProxy(item, interfaces, shares[0].shareID))
+        return proxies
 
 
+    def __iter__(self):
+        """
+        Iterate the L{SharedProxy}s of the accessible results.
+        """
+        batch = []
+        for item in self._accessibleItems():
+            batch.append(item)
+            if len(batch) == self.batchSize:
+                for proxy in self._proxiesFor(batch):
+                    yield proxy
+                batch = []
+        if batch:
+            for proxy in self._proxiesFor(batch):
+                yield proxy
+
+
+    def count(self):
+        """
+        Count the accessible results, without loading them.
+
+        @return: an L{int}.
+        """
+        # Axiom's count() disregards the limit and offset, so apply them here.
+        total = self.store.query(
+            self.query.tableClass, self._accessibleComparison()).count()
+        if self.query.offset is not None:
+            total = max(0, total - self.query.offset)
+        if self.limit is not None:
+            total = min(total, self.limit)
+        return total
+
 
 
 class _really(object):
@@ -352,6 +772,64 @@ class _really(object):
 
 ALLOWED_ON_PROXY = ['__provides__', '__dict__']
 
+_uniqueInterfacesCache = {}
+
+def _uniqueInterfaces(interfaces):
+    """
+    Drop duplicate interfaces, and interfaces extended by others, from a
+    sequence of interfaces.  The result for each distinct sequence is
+    computed only once.
+
+    @param interfaces: an iterable of Interface objects.
+
+    @return: a C{tuple} of Interface objects, in their original order.
+    """
+    interfaces = tuple(interfaces)
+    try:
+        return _uniqueInterfacesCache[interfaces]
+    except KeyError:
+        pass
+    unique = []
+    for candidate in interfaces:
+        if candidate in unique:
+            continue
+        for other in interfaces:
+            if other.extends(candidate):
+                break
+        else:
+            unique.append(candidate)
+    unique = _uniqueInterfacesCache[interfaces] = tuple(unique)
+    return unique
+
+
+
+_attributeDispatchCache = {}
+
+def _attributeDispatch(interfaces):
+    """
+    Determine which interface each attribute of a L{SharedProxy} should be
+    retrieved through.  The result for each distinct sequence is computed only
+    once.
+
+    @param interfaces: a C{tuple} of Interface objects, as returned by
+    L{_uniqueInterfaces}.
+
+    @return: a C{dict} mapping each attribute name declared by any of the
+    interfaces (or their bases) to the first of the interfaces which declares
+    it.
+    """
+    try:
+        return _attributeDispatchCache[interfaces]
+    except KeyError:
+        pass
+    dispatch = {}
+    for iface in interfaces:
+        for name in iface:
+            dispatch.setdefault(name, iface)
+    _attributeDispatchCache[interfaces] = dispatch
+    return dispatch
+
+
 class SharedProxy(object):
     """
     A shared proxy is a dynamic proxy which provides exposes methods and
@@ -394,19 +872,14 @@ class SharedProxy(object):
         rself._sharedItem = sharedItem
         rself._shareID = shareID
         rself._adapterCache = {}
-        # Drop all duplicate shared interfaces.
-        uniqueInterfaces = list(sharedInterfaces)
-        # XXX there _MUST_ Be a better algorithm for this
-        for left in sharedInterfaces:
-            for right in sharedInterfaces:
-                if left.extends(right) and right in uniqueInterfaces:
-                    uniqueInterfaces.remove(right)
+        uniqueInterfaces = _uniqueInterfaces(sharedInterfaces)
         for eachInterface in uniqueInterfaces:
             if not eachInterface.providedBy(sharedItem):
                 impl = eachInterface(sharedItem, None)
                 if impl is not None:
                     rself._adapterCache[eachInterface] = impl
-        rself._sharedInterfaces = uniqueInterfaces
+        rself._sharedInterfaces = list(uniqueInterfaces)
+        rself._attributeDispatch = _attributeDispatch(uniqueInterfaces)
         # Make me look *exactly* like the item I am proxying for, at least for
         # the purposes of adaptation
         # directlyProvides(self, providedBy(sharedItem))
@@ -434,19 +907,23 @@ class SharedProxy(object):
         @raise AttributeError: if the attribute was not found or access to it was
         denied.
         """
+        # This is called for every attribute access on every proxy, so it
+        # avoids _really and looks the name up in a precomputed dispatch
+        # table rather than searching each interface.
+        get = object.__getattribute__
         if name in ALLOWED_ON_PROXY:
-            return object.__getattribute__(self, name)
-        rself = _really(self)
+            return get(self, name)
         if name == 'sharedInterfaces':
-            return rself._sharedInterfaces
+            return get(self, '_sharedInterfaces')
         elif name == 'shareID':
-            return rself._shareID
-        for iface in rself._sharedInterfaces:
-            if name in iface:
-                if iface in rself._adapterCache:
-                    return getattr(rself._adapterCache[iface], name)
-                return getattr(rself._sharedItem, name)
-        raise AttributeError("%r has no attribute %r" % (self, name))
+            return get(self, '_shareID')
+        iface = get(self, '_attributeDispatch').get(name)
+        if iface is None:
+            raise AttributeError("%r has no attribute %r" % (self, name))
+        adapterCache = get(self, '_adapterCache')
+        if iface in adapterCache:
+            return getattr(adapterCache[iface], name)
+        return getattr(get(self, '_sharedItem'), name)
 
 
     def __setattr__(self, name, value):
@@ -532,6 +1009,9 @@ class Share(Item):
         """,
         allowNone=False)
 
+    compoundIndex(sharedItem, sharedTo)
+    compoundIndex(shareID, sharedTo)
+
 
     def __init__(self, **kw):
         """
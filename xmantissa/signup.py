@@ -18,7 +18,6 @@ from axiom.item import Item, transacted, declareLegacyItem
 from axiom.attributes import integer, reference, text, timestamp, AND
 from axiom.iaxiom import IBeneficiary
 from axiom import userbase, upgrade
-from axiom.userbase import getDomainNames
 from axiom.dependency import installOn
 
 from nevow.rend import Page, NotFound
@@ -41,6 +40,7 @@ from xmantissa.websession import PersistentSession
 from xmantissa.smtp import parseAddress
 from xmantissa.error import ArgumentError
 from xmantissa.product import Product
+from xmantissa._domainindex import domainIndex
 
 
 _theMX = None
@@ -744,7 +744,7 @@ class UserInfoSignup(Item, PrefixURLMixin):
         """
         Return a list of domain names available on this site.
         """
-        return getDomainNames(self.store)
+        return list(domainIndex(self.store).domains)
 
 
     def usernameAvailable(self, username, domain):
@@ -12,6 +12,8 @@ import warnings
 from xmantissa.ixmantissa import IColumn
 from xmantissa.error import Unsortable
 from xmantissa.scrolltable import AttributeColumn as _STAttributeColumn
+from xmantissa.scrolltable import _rowCountCache
+from xmantissa._storechange import storeChangeToken
 
 class AttributeColumn(_STAttributeColumn):
     """
@@ -35,6 +37,13 @@ class TabularDataModel:
     I represent a window onto a query that can be paged backwards and forward,
     and re-sorted.
 
+    Pages are found with inequality queries from the sort keys of the first
+    or last item of the current page, so moving to any page takes the same
+    time however deep into the results it is.  The position of the page is
+    worked out from the position of the previous one, unless the store has
+    changed since, and the total number of items is counted only when the
+    store has changed.
+
     @ivar pageNumber: the number of the current page.
 
     @ivar totalPages: the total number of pages accessible to the query this
@@ -63,6 +72,12 @@ class TabularDataModel:
 
         self.store = store
         self._currentResults = []
+        # The sort keys of the items of _currentResults, the store change
+        # token from when they were found, and whether they were found by
+        # paging backwards.
+        self._currentKeys = []
+        self._resultsToken = None
+        self._resultsBackwards = False
         self.primaryTableClass = primaryTableClass
         assert columns, "You've got to pass some columns"
         cols = self.columns = {}
@@ -100,6 +115,13 @@ class TabularDataModel:
         else:
             offset = 0
             self.currentSortColumn = newSortColumn
+            if self._currentResults:
+                # The keys of the current page are for the old sort column.
+                item = self._currentResults[offset]['__item__']
+                self._currentKeys[offset] = (
+                    newSortColumn.sortAttribute().__get__(
+                        item, self.primaryTableClass),
+                    item.storeID)
         self.isAscending = isAscending
         self._updateResults(self._sortAttributeValue(offset), True)
 
@@ -139,11 +161,32 @@ class TabularDataModel:
         item, not the same item again.
         """
 
-        self._updateResults(self._sortAttributeValue(0), equalToStart=True, refresh=True)
+        # Finding the page again would give the same results if nothing has
+        # changed, unless it was found backwards and is not full.
+        if (self._currentResults and
+            (not self._resultsBackwards or
+             len(self._currentResults) == self.itemsPerPage) and
+            self._resultsToken == storeChangeToken(self.store)):
+            return self._currentResults
+        self._updateResults(self._sortAttributeValue(0), equalToStart=True,
+                            refresh=True)
         return self._currentResults
 
     def _updateResults(self, primaryColumnStart=None, equalToStart=False,
-                       backwards=False, refresh=False):
+                       backwards=False, refresh=False, itemsBefore=None):
+        """
+        Replace the current page with the results of a query.
+
+        @param itemsBefore: a one-argument callable which takes the new
+        results and returns the number of items before them, as worked out
+        from the position of the current page, or C{None} to count them.  It
+        is only used if the store has not changed since the current page was
+        found.
+        """
+        if itemsBefore is not None and (
+            not self._currentResults or
+            self._resultsToken != storeChangeToken(self.store)):
+            itemsBefore = None
         results = self._performQuery(primaryColumnStart,
                                      equalToStart,
                                      backwards)
@@ -159,9 +202,21 @@ class TabularDataModel:
             # anyway simply because we expect multiple frontends for this
             # model, and multiple frontends means lots of places for bugs.
             self.totalItems = self.totalPages = self.pageNumber = 0
+            # The position of the page has been forgotten, so it will have to
+            # be counted next time.
+            self._resultsToken = None
             return
+        if itemsBefore is not None:
+            itemsBefore = itemsBefore(results)
+        sortAttribute = self.currentSortColumn.sortAttribute()
         self._currentResults = results
-        self._paginate()
+        self._currentKeys = [
+            (sortAttribute.__get__(row['__item__'], self.primaryTableClass),
+             row['__item__'].storeID)
+            for row in results]
+        self._resultsToken = storeChangeToken(self.store)
+        self._resultsBackwards = backwards
+        self._paginate(itemsBefore)
 
     def _determineQuery(self, primaryColumnStart, equalToStart,
                         backwards, limit):
@@ -225,45 +280,69 @@ class TabularDataModel:
 
     def _sortAttributeValue(self, offset):
         """
-        return the value of the sort attribute for the item at
+        return the value of the sort attribute and the storeID of the item at
         'offset' in the results of the last query, otherwise None.
+
+        These are the values the item had when it was found, so that paging
+        from an item which has since been changed still starts where the user
+        expects, and they are the values of the sort attribute itself rather
+        than of the column, so that they can be compared with it.
         """
-        if self._currentResults:
-            pageStart = (self._currentResults[offset][
-                self.currentSortColumn.attributeID],
-                         self._currentResults[offset][
-                    '__item__'].storeID)
+        if self._currentKeys:
+            pageStart = self._currentKeys[offset]
         else:
             pageStart = None
         return pageStart
 
+    def _hasMore(self, primaryColumnStart, backwards):
+        """
+        Determine whether there are any items after (or, if C{backwards},
+        before) the given sort key, without finding a page of them.
+        """
+        query = self._determineQuery(primaryColumnStart, False, backwards, 1)
+        return bool(list(query.getColumn('storeID')))
+
     def nextPage(self):
-        self._updateResults(self._sortAttributeValue(-1))
+        self._updateResults(
+            self._sortAttributeValue(-1),
+            itemsBefore=lambda results: self.lastItem)
 
     def hasNextPage(self):
-        return bool(self._performQuery(self._sortAttributeValue(-1)))
+        return self._hasMore(self._sortAttributeValue(-1), False)
 
     def firstPage(self):
-        self._updateResults()
+        self._updateResults(itemsBefore=lambda results: 0)
 
     def prevPage(self):
-        self._updateResults(self._sortAttributeValue(0), backwards=True)
+        self._updateResults(
+            self._sortAttributeValue(0), backwards=True,
+            itemsBefore=lambda results: max(
+                0, self.firstItem - 1 - len(results)))
 
     def hasPrevPage(self):
-        return bool(self._performQuery(self._sortAttributeValue(0), backwards=True))
+        return self._hasMore(self._sortAttributeValue(0), True)
 
     def lastPage(self):
-        self._updateResults(backwards=True)
+        self._updateResults(
+            backwards=True,
+            itemsBefore=lambda results: self.totalItems - len(results))
 
-    def _paginate(self):
+    def _paginate(self, itemsBeforeThisPage=None):
+        """
+        Work out the position of the current page among all of the items.
+
+        @param itemsBeforeThisPage: the number of items before the current
+        page, or C{None} to count them.
+        """
         rslts = self._currentResults
-        self.totalItems = self.store.query(self.primaryTableClass,
-                                           self.baseComparison).count()
+        self.totalItems = _rowCountCache(self.store).count(
+            self.primaryTableClass, self.baseComparison)
         self.totalPages = int(math.ceil(float(self.totalItems) /
                                         self.itemsPerPage))
-        itemsBeforeThisPage = self._determineQuery(
-            self._sortAttributeValue(0),
-            equalToStart=False, backwards=True, limit=None).count()
+        if itemsBeforeThisPage is None:
+            itemsBeforeThisPage = self._determineQuery(
+                self._sortAttributeValue(0),
+                equalToStart=False, backwards=True, limit=None).count()
         itemsAfterThisPage = self.totalItems - len(rslts) - itemsBeforeThisPage
 
         self.firstItem = itemsBeforeThisPage + 1
@@ -0,0 +1,19 @@
+# -*- test-case-name: xmantissa.test.historic.test_alreadyanswered1to2 -*-
+
+from axiom.test.historic.stubloader import saveStub
+
+from xmantissa.sharing import Identifier
+from xmantissa.interstore import Value, _AlreadyAnswered
+
+SENDER = Identifier(u'sender.share', u'alice', u'example.com')
+TARGET = Identifier(u'target.share', u'bob', u'example.com')
+VALUE = Value(u'custom.answer.type', 'answer data')
+MESSAGE_ID = 5
+
+def createDatabase(store):
+    _AlreadyAnswered.create(store=store, originalSender=SENDER,
+                            originalTarget=TARGET, value=VALUE,
+                            messageID=MESSAGE_ID)
+
+if __name__ == '__main__':
+    saveStub(createDatabase, 17606)
@@ -0,0 +1,18 @@
+# -*- test-case-name: xmantissa.test.historic.test_queuedmessage1to2 -*-
+
+from axiom.test.historic.stubloader import saveStub
+
+from xmantissa.sharing import Identifier
+from xmantissa.interstore import Value, _QueuedMessage
+
+SENDER = Identifier(u'sender.share', u'alice', u'example.com')
+TARGET = Identifier(u'target.share', u'bob', u'example.com')
+VALUE = Value(u'custom.message.type', 'message data')
+MESSAGE_ID = 3
+
+def createDatabase(store):
+    _QueuedMessage.create(store=store, sender=SENDER, target=TARGET,
+                          value=VALUE, messageID=MESSAGE_ID)
+
+if __name__ == '__main__':
+    saveStub(createDatabase, 17606)
@@ -0,0 +1,18 @@
+# -*- test-case-name: xmantissa.test.historic.test_sqliteIndexer1to2 -*-
+
+from axiom.test.historic.stubloader import saveStub
+
+from xmantissa.fulltext import SQLiteIndexer
+from xmantissa.test.test_fulltext import FakeMessageSource
+
+INDEX_COUNT = 11
+INDEX_DIRECTORY = u'foo.index'
+
+def createDatabase(store):
+    indexer = SQLiteIndexer(store=store, indexCount=INDEX_COUNT,
+                            indexDirectory=INDEX_DIRECTORY)
+    source = FakeMessageSource(store=store)
+    indexer.addSource(source)
+
+if __name__ == '__main__':
+    saveStub(createDatabase, 17606)
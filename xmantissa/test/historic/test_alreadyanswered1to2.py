@@ -0,0 +1,28 @@
+
+"""
+Tests for the upgrade of L{_AlreadyAnswered} from version 1 to 2, in which its
+C{attempts} and C{nextAttempt} attributes were added.
+"""
+
+from axiom.test.historic.stubloader import StubbedTest
+
+from xmantissa.interstore import _AlreadyAnswered
+
+from xmantissa.test.historic.stub_alreadyanswered1to2 import (
+    SENDER, TARGET, VALUE, MESSAGE_ID)
+
+
+class AlreadyAnsweredUpgradeTests(StubbedTest):
+    def test_attributes(self):
+        """
+        The attributes of the answer are preserved by the upgrade, and it is
+        due for delivery the next time its queue runs.
+        """
+        answer = self.store.findUnique(_AlreadyAnswered)
+        self.assertEquals(answer.originalSender, SENDER)
+        self.assertEquals(answer.originalTarget, TARGET)
+        self.assertEquals(answer.answerType, VALUE.type)
+        self.assertEquals(answer.answerData, VALUE.data)
+        self.assertEquals(answer.messageID, MESSAGE_ID)
+        self.assertEquals(answer.attempts, 0)
+        self.assertIdentical(answer.nextAttempt, None)
@@ -0,0 +1,29 @@
+
+"""
+Tests for the upgrade of L{_QueuedMessage} from version 1 to 2, in which its
+C{attempts} and C{nextAttempt} attributes were added.
+"""
+
+from axiom.test.historic.stubloader import StubbedTest
+
+from xmantissa.interstore import _QueuedMessage
+
+from xmantissa.test.historic.stub_queuedmessage1to2 import (
+    SENDER, TARGET, VALUE, MESSAGE_ID)
+
+
+class QueuedMessageUpgradeTests(StubbedTest):
+    def test_attributes(self):
+        """
+        The attributes of the message are preserved by the upgrade, and it is
+        due for delivery the next time its queue runs.
+        """
+        message = self.store.findUnique(_QueuedMessage)
+        self.assertEquals(message.sender, SENDER)
+        self.assertEquals(message.target, TARGET)
+        self.assertEquals(message.messageType, VALUE.type)
+        self.assertEquals(message.messageData, VALUE.data)
+        self.assertEquals(message.messageID, MESSAGE_ID)
+        self.assertIdentical(message.consequence, None)
+        self.assertEquals(message.attempts, 0)
+        self.assertIdentical(message.nextAttempt, None)
@@ -0,0 +1,45 @@
+
+"""
+Tests for the upgrade of L{SQLiteIndexer} from version 1 to 2, in which it
+switched from FTS3 to FTS5 or FTS4, started indexing keywords, and gained its
+C{batchSize} attribute.
+"""
+
+from axiom.test.historic.stubloader import StubbedTest
+from axiom.iaxiom import REMOTE
+
+from xmantissa.fulltext import SQLiteIndexer
+from xmantissa.test.test_fulltext import FakeMessageSource
+
+from xmantissa.test.historic.stub_sqliteIndexer1to2 import INDEX_DIRECTORY
+
+
+class SQLiteIndexerUpgradeTests(StubbedTest):
+    def setUp(self):
+        # Hold a reference to the FakeMessageSource so that its in-memory
+        # attributes stick around long enough to make assertions about them.
+        result = StubbedTest.setUp(self)
+        self.messageSource = self.store.findUnique(FakeMessageSource)
+        return result
+
+
+    def test_attributes(self):
+        """
+        The C{indexDirectory} attribute is preserved by the upgrade, and
+        documents are not buffered.
+        """
+        indexer = self.store.findUnique(SQLiteIndexer)
+        self.assertEquals(indexer.indexDirectory, INDEX_DIRECTORY)
+        self.assertEquals(indexer.batchSize, 1)
+
+
+    def test_reset(self):
+        """
+        The indexer is reset by the upgrade, once, so that everything is
+        indexed again in the new format.
+        """
+        indexer = self.store.findUnique(SQLiteIndexer)
+        self.assertEquals(indexer.indexCount, 0)
+        self.assertEquals(list(indexer.getSources()), [self.messageSource])
+        self.assertEquals(self.messageSource.added, [(indexer, REMOTE)])
+        self.assertEquals(self.messageSource.removed, [indexer])
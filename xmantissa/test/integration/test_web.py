@@ -36,6 +36,7 @@ from xmantissa.port import SSLPort
 from xmantissa.offering import Offering
 from xmantissa.product import Product
 from xmantissa.web import SiteConfiguration
+from xmantissa.websession import TransientSessionStore
 from xmantissa.webapp import PrivateApplication
 from xmantissa.sharing import getEveryoneRole
 from xmantissa.websharing import addDefaultShareID
@@ -220,9 +221,11 @@ class IntegrationTestsMixin:
         self.store.transact(_tx)
 
         self.origFunctions = (GuardSession.checkExpired.im_func,
-                              athena.ReliableMessageDelivery)
+                              athena.ReliableMessageDelivery,
+                              TransientSessionStore._schedule.im_func)
         GuardSession.checkExpired = lambda self: None
         athena.ReliableMessageDelivery = lambda *a, **kw: None
+        TransientSessionStore._schedule = lambda self, key, session: None
 
 
     def tearDown(self):
@@ -231,6 +234,7 @@ class IntegrationTestsMixin:
         """
         GuardSession.checkExpired = self.origFunctions[0]
         athena.ReliableMessageDelivery = self.origFunctions[1]
+        TransientSessionStore._schedule = self.origFunctions[2]
         del self.origFunctions
 
 
@@ -0,0 +1,42 @@
+"""
+Utilities for tests which check the SQL run against a store.
+"""
+
+from axiom.test.util import QueryCounter
+
+
+
+class StatementCounter(QueryCounter):
+    """
+    A L{QueryCounter} which also records the SQL statements run against its
+    store while measuring.
+
+    @ivar statements: a C{list} of C{(sql, args)} two-tuples, one for each
+        statement run by the last call to L{measure}, in order.
+    """
+
+    def reset(self):
+        QueryCounter.reset(self)
+        self.statements = []
+
+
+    def measure(self, f, *a, **k):
+        """
+        Run C{f} as L{QueryCounter.measure} does, recording the statements it
+        runs in C{statements}.
+        """
+        statements = []
+        patched = 'querySQL' in vars(self.store)
+        querySQL = self.store.querySQL
+        def recordingQuerySQL(sql, args=()):
+            statements.append((sql, args))
+            return querySQL(sql, args)
+        self.store.querySQL = recordingQuerySQL
+        try:
+            return QueryCounter.measure(self, f, *a, **k)
+        finally:
+            if patched:
+                self.store.querySQL = querySQL
+            else:
+                del self.store.querySQL
+            self.statements = statements
@@ -0,0 +1,179 @@
+
+"""
+Tests for L{xmantissa._domainindex}.
+"""
+
+from twisted.trial.unittest import TestCase
+
+from axiom.store import Store
+from axiom.userbase import LoginMethod
+from axiom.test.util import QueryCounter
+
+from xmantissa._domainindex import (
+    DomainIndex, _StoreDomainIndex, storeDomainIndex, domainIndex)
+from xmantissa._storechange import storeChangeToken
+
+
+
+class DomainIndexTests(TestCase):
+    """
+    Tests for L{DomainIndex}.
+    """
+    def test_domains(self):
+        """
+        L{DomainIndex.domains} is a list of the domains it was created with.
+        """
+        domains = (u'example.com', u'example.net')
+        self.assertEqual(DomainIndex(domains).domains, list(domains))
+
+
+    def test_noMatches(self):
+        """
+        L{DomainIndex.matches} returns an empty list for a hostname which is
+        not in any of the domains.
+        """
+        index = DomainIndex([u'example.com'])
+        self.assertEqual(index.matches('example.net'), [])
+        self.assertEqual(index.matches('com'), [])
+        self.assertEqual(index.matches('badexample.com'), [])
+        self.assertEqual(DomainIndex([]).matches('example.com'), [])
+
+
+    def test_domain(self):
+        """
+        L{DomainIndex.matches} gives C{None} as the subdomain part of a
+        hostname which is one of the domains.
+        """
+        self.assertEqual(DomainIndex([u'example.com']).matches('example.com'),
+                         [(None, u'example.com')])
+
+
+    def test_subdomain(self):
+        """
+        L{DomainIndex.matches} gives the part of a hostname before the domain
+        it is a subdomain of.
+        """
+        index = DomainIndex([u'example.com'])
+        self.assertEqual(index.matches('bob.example.com'),
+                         [('bob', u'example.com')])
+        self.assertEqual(index.matches('www.bob.example.com'),
+                         [('www.bob', u'example.com')])
+
+
+    def test_order(self):
+        """
+        L{DomainIndex.matches} gives all of the domains a hostname is in, in
+        the order the domains were given.
+        """
+        index = DomainIndex([u'example.com', u'b.example.com', u'example.net'])
+        self.assertEqual(index.matches('a.b.example.com'),
+                         [('a.b', u'example.com'), ('a', u'b.example.com')])
+        index = DomainIndex([u'b.example.com', u'example.com'])
+        self.assertEqual(index.matches('b.example.com'),
+                         [(None, u'b.example.com'), ('b', u'example.com')])
+
+
+
+class StoreDomainIndexTests(TestCase):
+    """
+    Tests for L{_StoreDomainIndex} and L{domainIndex}.
+    """
+    def setUp(self):
+        self.store = Store()
+        self.cache = storeDomainIndex(self.store)
+
+
+    def addDomain(self, domain, internal=True):
+        """
+        Add a L{LoginMethod} for C{domain} to C{self.store}.
+        """
+        return LoginMethod(
+            store=self.store, account=self.store, protocol=u'*',
+            internal=internal, verified=True, localpart=u'alice',
+            domain=domain)
+
+
+    def test_storeDomainIndex(self):
+        """
+        L{storeDomainIndex} returns the same L{_StoreDomainIndex} every time
+        it is called with the same store.
+        """
+        self.assertIsInstance(self.cache, _StoreDomainIndex)
+        self.assertIdentical(self.cache.store, self.store)
+        self.assertIdentical(storeDomainIndex(self.store), self.cache)
+        self.assertNotIdentical(storeDomainIndex(Store()), self.cache)
+
+
+    def test_domains(self):
+        """
+        L{domainIndex} returns a L{DomainIndex} of the domains of the internal
+        L{LoginMethod}s in the store.
+        """
+        self.addDomain(u'example.net')
+        self.addDomain(u'example.com')
+        self.addDomain(u'example.com')
+        self.addDomain(u'example.org', internal=False)
+        self.assertEqual(domainIndex(self.store).domains,
+                         [u'example.com', u'example.net'])
+
+
+    def test_cached(self):
+        """
+        The domains are not queried again while the store has not changed.
+        """
+        self.addDomain(u'example.com')
+        index = domainIndex(self.store)
+        counter = QueryCounter(self.store)
+        self.assertEqual(
+            counter.measure(domainIndex, self.store),
+            counter.measure(storeChangeToken, self.store))
+        self.assertIdentical(domainIndex(self.store), index)
+        self.assertEqual(self.cache.rebuilds, 1)
+
+
+    def test_unrelatedChange(self):
+        """
+        The index is not built again when something in the store other than
+        the domains changes.
+        """
+        self.addDomain(u'example.com')
+        index = domainIndex(self.store)
+        self.addDomain(u'example.com')
+        self.assertIdentical(domainIndex(self.store), index)
+        self.assertEqual(self.cache.rebuilds, 1)
+
+
+    def test_domainAdded(self):
+        """
+        A domain added after the index was built is in the index.
+        """
+        domainIndex(self.store)
+        self.addDomain(u'example.com')
+        self.assertEqual(domainIndex(self.store).matches('bob.example.com'),
+                         [('bob', u'example.com')])
+
+
+    def test_domainRemoved(self):
+        """
+        A domain removed after the index was built is not in the index.
+        """
+        loginMethod = self.addDomain(u'example.com')
+        domainIndex(self.store)
+        loginMethod.deleteFromStore()
+        self.assertEqual(domainIndex(self.store).matches('bob.example.com'),
+                         [])
+
+
+    def test_invalidate(self):
+        """
+        L{_StoreDomainIndex.invalidate} makes the next call to C{index} query
+        the domains again.
+        """
+        self.addDomain(u'example.com')
+        self.cache.index()
+        self.cache.invalidate()
+        counter = QueryCounter(self.store)
+        self.assertTrue(
+            counter.measure(self.cache.index) >
+            counter.measure(storeChangeToken, self.store))
+        self.assertEqual(self.cache.rebuilds, 1)
@@ -3,15 +3,16 @@ import gc
 from zope.interface import implements
 
 from twisted.trial import unittest
-from twisted.application.service import IService
-from twisted.internet.defer import gatherResults
+from twisted.application.service import IService, Service
+from twisted.internet.defer import gatherResults, succeed
 
 from axiom import iaxiom, store, batch, item, attributes
 from axiom.userbase import LoginSystem
 from axiom.dependency import installOn
 from axiom.errors import SQLError
 
-from xmantissa import ixmantissa, fulltext
+from xmantissa import ixmantissa, fulltext, search
+from xmantissa.test.queryutil import StatementCounter
 
 
 def identifiersFrom(hits):
@@ -51,6 +52,36 @@ class IndexableThing(item.Item):
 
 
 
+class FakeBatchService(Service):
+    """
+    Stand-in for the batch processing controller service of a store, which
+    records the requests made of the batch process instead of sending them.
+
+    @ivar suspended: the storeIDs of the listeners which were suspended.
+    @ivar calls: the item methods which were called.
+    """
+    name = 'Batch Processing Controller'
+
+    def __init__(self):
+        self.suspended = []
+        self.calls = []
+
+
+    def suspend(self, storeID):
+        self.suspended.append(storeID)
+        return succeed(None)
+
+
+    def resume(self, storeID):
+        return succeed(None)
+
+
+    def call(self, itemMethod):
+        self.calls.append(itemMethod)
+        return succeed(None)
+
+
+
 class FakeMessageSource(item.Item):
     """
     Stand-in for an item type returned from L{axiom.batch.processor}.  Doesn't
@@ -881,10 +912,10 @@ class HypeIndexerAPISearchTestCase(HypeTestsMixin, IndexerAPISearchTestsMixin, u
 
 
 
-def _hasFTS3():
+def _hasFTS4():
     s = store.Store()
     try:
-        s.createSQL('CREATE VIRTUAL TABLE fts USING fts3')
+        s.createSQL('CREATE VIRTUAL TABLE fts USING fts4')
     except SQLError:
         return False
     else:
@@ -896,8 +927,8 @@ class SQLiteTestsMixin(object):
     """
     Mixin for tests for the SQLite indexer.
     """
-    if not _hasFTS3():
-        skip = 'No FTS3 support'
+    if not _hasFTS4():
+        skip = 'No FTS4 support'
 
 
     def createIndexer(self):
@@ -912,15 +943,460 @@ class SQLiteFulltextTestCase(SQLiteTestsMixin, FulltextTestsMixin, unittest.Test
     """
     Tests for SQLite fulltext indexing.
     """
-    def _noKeywords(self):
-        raise unittest.SkipTest('Keywords are not implemented')
+    def _thing(self, identifier, text):
+        """
+        Make an L{IndexableThing} with the given identifier and text.
+        """
+        return IndexableThing(
+            _documentType=u'thing',
+            _uniqueIdentifier=str(identifier),
+            _textParts=[text],
+            _keywordParts={})
+
+
+    def test_batchedAdd(self):
+        """
+        Documents added to a SQLite index are buffered until there are
+        C{batchSize} of them, and then written together.
+        """
+        self.indexer.batchSize = 2
+        writer = self.openWriteIndex()
+        writer.add(self._thing(1, u'apple'))
+        reader = self.openReadIndex()
+        self.assertEquals(identifiersFrom(reader.search(u'apple')), [])
+        writer.add(self._thing(2, u'apple'))
+        self.assertEquals(identifiersFrom(reader.search(u'apple')), [1, 2])
+        reader.close()
+        writer.close()
+
+
+    def test_closeWritesBuffered(self):
+        """
+        Closing a SQLite index writes the documents it has buffered.
+        """
+        self.indexer.batchSize = 10
+        writer = self.openWriteIndex()
+        writer.add(self._thing(1, u'apple'))
+        writer.close()
+        reader = self.openReadIndex()
+        self.assertEquals(identifiersFrom(reader.search(u'apple')), [1])
+        reader.close()
+
+
+    def test_removeBuffered(self):
+        """
+        Removing a document which a SQLite index has buffered removes it from
+        the index.
+        """
+        self.indexer.batchSize = 10
+        writer = self.openWriteIndex()
+        writer.add(self._thing(1, u'apple'))
+        writer.add(self._thing(2, u'apple'))
+        writer.remove('1')
+        self.assertEquals(identifiersFrom(writer.search(u'apple')), [2])
+        writer.close()
+
+
+    def test_addAgain(self):
+        """
+        Adding a document which is already in a SQLite index replaces it.
+        """
+        writer = self.openWriteIndex()
+        writer.add(self._thing(1, u'apple'))
+        writer.add(self._thing(1, u'banana'))
+        self.assertEquals(identifiersFrom(writer.search(u'apple')), [])
+        self.assertEquals(identifiersFrom(writer.search(u'banana')), [1])
+        writer.close()
+
+
+    def test_bufferedDocumentsPending(self):
+        """
+        Items whose documents the write index has buffered are tracked by
+        L{fulltext._PendingDocument}s until they are written, and are indexed
+        by the next write index if the process exits first.
+        """
+        self.indexer.batchSize = 3
+        things = [IndexableThing(store=self.store,
+                                 _documentType=u'thing',
+                                 _uniqueIdentifier=str(i),
+                                 _textParts=[u'apple'],
+                                 _keywordParts={})
+                  for i in range(3)]
+        self.indexer.add(things[0])
+        self.indexer.add(things[1])
+        self.assertEquals(
+            list(self.store.query(fulltext._PendingDocument).getColumn(
+                    "item")),
+            things[:2])
+
+        # Exit without writing the buffered documents.
+        index, self.indexer._index = self.indexer._index, None
+        index.store.close()
+
+        self.indexer.add(things[2])
+        self.assertEquals(
+            self.store.query(fulltext._PendingDocument).count(), 0)
+        reader = self.openReadIndex()
+        self.assertEquals(identifiersFrom(reader.search(u'apple')), [0, 1, 2])
+        reader.close()
+
+
+    def test_addMany(self):
+        """
+        L{_SQLiteIndex.addMany} adds all of the documents it is given in a
+        single transaction.
+        """
+        writer = self.openWriteIndex()
+        commits = []
+        original = writer.store._commit
+        def commit():
+            commits.append(None)
+            return original()
+        writer.store._commit = commit
+        writer.addMany([self._thing(i, u'apple') for i in range(5)])
+        self.assertEquals(len(commits), 1)
+        self.assertEquals(identifiersFrom(writer.search(u'apple')),
+                          range(5))
+        writer.close()
+
+
+    def test_suspendWritesBeforeRemoving(self):
+        """
+        When the indexer is suspended, documents it has buffered are written
+        before pending removals are processed, so a document which was removed
+        after being added is not in the index.
+        """
+        self.indexer.batchSize = 10
+        thing = self._thing(1, u'apple')
+        thing.store = self.store
+        self.indexer.add(thing)
+        self.indexer.remove(thing)
+        self.indexer.suspend()
+        reader = self.openReadIndex()
+        self.assertEquals(identifiersFrom(reader.search(u'apple')), [])
+        reader.close()
+
+
+    def test_slicedSearch(self):
+        """
+        Slicing the results of a search retrieves only the results in the
+        slice, using the query's LIMIT and OFFSET.
+        """
+        writer = self.openWriteIndex()
+        writer.addMany([self._thing(i, u'apple') for i in range(10)])
+        writer.close()
+        reader = self.openReadIndex()
+        results = reader.search(u'apple')
+        def slices():
+            self.assertEquals(len(results), 10)
+            self.assertEquals(identifiersFrom(results[3:6]), [3, 4, 5])
+            self.assertEquals(identifiersFrom(results[8:]), [8, 9])
+            self.assertEquals(results[2].uniqueIdentifier, 2)
+            self.assertEquals(identifiersFrom(results[-2:]), [8, 9])
+            self.assertRaises(IndexError, lambda: results[10])
+        counter = StatementCounter(reader.store)
+        counter.measure(slices)
+        self.assertEquals(
+            [args[1:] for (sql, args) in counter.statements[1:4]],
+                          [(3, 3), (-1, 8), (1, 2)])
+        self.assertEquals(
+            identifiersFrom(reader.search(u'apple', sortAscending=False)[:3]),
+            [9, 8, 7])
+        reader.close()
+
+
+    def test_resultDetails(self):
+        """
+        Search results carry the document type and sort key of the document
+        they are for, its rank and a snippet of its text.
+        """
+        writer = self.openWriteIndex()
+        writer.add(IndexableThing(
+                _documentType=u'thing',
+                _uniqueIdentifier='5',
+                _textParts=[u'an apple a day'],
+                _keywordParts={u'subject': u'fruit'}))
+        writer.close()
+        reader = self.openReadIndex()
+        [result] = reader.search(u'apple')
+        self.assertEquals(result.documentType, u'thing')
+        self.assertEquals(result.sortKey, 5)
+        self.assertIn(u'apple', result.snippet)
+        if reader.module == 'fts5':
+            self.assertNotIdentical(result.score, None)
+        [result] = reader.search(u'', {u'subject': u'fruit'})
+        self.assertIdentical(result.snippet, None)
+        reader.close()
+
+
+    def test_keywordColumnAdded(self):
+        """
+        Documents which were indexed before a keyword name was first used are
+        still found after the column for it is added.
+        """
+        writer = self.openWriteIndex()
+        writer.add(self._thing(1, u'apple'))
+        writer.add(IndexableThing(
+                _documentType=u'thing',
+                _uniqueIdentifier='2',
+                _textParts=[u'apple'],
+                _keywordParts={u'subject': u'fruit'}))
+        writer.close()
+        reader = self.openReadIndex()
+        self.assertEquals(reader.keywordColumns.keys(), [u'subject'])
+        self.assertEquals(identifiersFrom(reader.search(u'apple')), [1, 2])
+        self.assertEquals(
+            identifiersFrom(reader.search(u'', {u'subject': u'fruit'})), [2])
+        self.assertEquals(
+            identifiersFrom(reader.search(u'', {u'color': u'red'})), [])
+        reader.close()
+
+
+    def test_quotedTerms(self):
+        """
+        Characters which are part of the FTS query syntax are searched for as
+        text.
+        """
+        writer = self.openWriteIndex()
+        writer.add(self._thing(1, u'apple OR "banana'))
+        writer.close()
+        reader = self.openReadIndex()
+        self.assertEquals(
+            identifiersFrom(reader.search(u'apple OR "banana')), [1])
+        self.assertEquals(identifiersFrom(reader.search(u'NOT apple')), [])
+        reader.close()
+
+
+
+class SQLiteSnapshotSearchTestCase(SQLiteTestsMixin, IndexerTestsMixin,
+                                   unittest.TestCase):
+    """
+    Tests for searching a SQLite indexer without suspending its batch
+    processing.
+    """
+    def setUp(self):
+        IndexerTestsMixin.setUp(self)
+        self.batchService = FakeBatchService()
+        self.batchService.setServiceParent(IService(self.store))
+        self.things = [IndexableThing(store=self.store,
+                                      _documentType=u'thing',
+                                      _uniqueIdentifier=str(i),
+                                      _textParts=[u'apple'],
+                                      _keywordParts={})
+                       for i in range(5)]
+        for thing in self.things:
+            self.indexer.add(thing)
+        self.indexer._closeIndex()
+
+
+    def test_journalMode(self):
+        """
+        The index is kept in WAL mode, so that it can be read while it is
+        being written.
+        """
+        reader = self.openReadIndex()
+        self.assertEquals(
+            reader.store.querySQL('PRAGMA journal_mode'), [(u'wal',)])
+        reader.close()
 
 
-    testKeywordCombination = _noKeywords
-    testKeywordIndexing = _noKeywords
-    testKeywordTokenization = _noKeywords
-    testKeywordValuesInPhrase = _noKeywords
-    test_typeRestriction = _noKeywords
+    def test_searchWithoutSuspending(self):
+        """
+        L{SQLiteIndexer.search} does not suspend the batch processing of the
+        indexer.
+        """
+        d = self.indexer.search(u'apple', count=2, offset=1)
+        def searched(results):
+            self.assertEquals(identifiersFrom(results), [1, 2])
+            self.assertEquals(self.batchService.suspended, [])
+            self.assertEquals(self.batchService.calls, [])
+        return d.addCallback(searched)
+
+
+    def test_searchWhileWriting(self):
+        """
+        A search does not wait for documents which are being written in a
+        transaction which has not been committed, and does not find them.
+        """
+        self.indexer.openSnapshotIndex()
+        writer = self.openWriteIndex()
+        writer.store.executeSQL('BEGIN IMMEDIATE TRANSACTION')
+        writer.store.executeSQL(
+            "INSERT INTO fts (rowid, content) VALUES (10, 'apple')")
+        d = self.indexer.search(u'apple')
+        def searched(results):
+            self.assertEquals(identifiersFrom(results), range(5))
+            writer.store.executeSQL('ROLLBACK')
+            writer.close()
+        return d.addCallback(searched)
+
+
+    def test_snapshotKeptOpen(self):
+        """
+        L{SQLiteIndexer.openSnapshotIndex} returns the same index each time,
+        until the index is reset.
+        """
+        index = self.indexer.openSnapshotIndex()
+        self.assertIdentical(self.indexer.openSnapshotIndex(), index)
+        self.indexer.reset()
+        writer = self.openWriteIndex()
+        writer.add(self.things[0])
+        writer.close()
+        newIndex = self.indexer.openSnapshotIndex()
+        self.assertNotIdentical(newIndex, index)
+        self.assertEquals(identifiersFrom(newIndex.search(u'apple')), [0])
+
+
+    def test_keywordAddedAfterSnapshot(self):
+        """
+        A snapshot index finds documents by a keyword whose column was added
+        to the index after the snapshot was opened.
+        """
+        snapshot = self.indexer.openSnapshotIndex()
+        self.assertEquals(snapshot.search(u'', {u'b': u'banana'}), [])
+        self.indexer.add(IndexableThing(store=self.store,
+                                        _documentType=u'thing',
+                                        _uniqueIdentifier='10',
+                                        _textParts=[u'apple'],
+                                        _keywordParts={u'b': u'banana'}))
+        self.indexer._closeIndex()
+        self.assertIdentical(self.indexer.openSnapshotIndex(), snapshot)
+        self.assertEquals(
+            identifiersFrom(snapshot.search(u'', {u'b': u'banana'})), [10])
+
+
+    def test_pendingRemovalsHidden(self):
+        """
+        Documents which are pending removal are left out of search results,
+        without changing the number of results returned, and the batch
+        process is asked to remove them.
+        """
+        self.indexer.remove(self.things[0])
+        self.indexer.remove(self.things[2])
+        d = self.indexer.search(u'apple', count=2, offset=1)
+        def searched(results):
+            self.assertEquals(identifiersFrom(results), [3, 4])
+            self.assertEquals(self.batchService.suspended, [])
+            self.assertEquals(self.batchService.calls,
+                              [self.indexer._applyRemovals])
+        return d.addCallback(searched)
+
+
+    def test_count(self):
+        """
+        L{RemoteIndexer.count} counts the documents a search finds, leaving
+        out those which are pending removal.
+        """
+        self.indexer.remove(self.things[1])
+        d = self.indexer.count(u'apple')
+        d.addCallback(self.assertEquals, 4)
+        d.addCallback(lambda ign: self.indexer.count(u'banana'))
+        d.addCallback(self.assertEquals, 0)
+        return d
+
+
+    def test_generation(self):
+        """
+        L{RemoteIndexer.generation} changes when a document is added or
+        removed, or the indexer is reset, and is the same for every instance
+        of the indexer.
+        """
+        thing = IndexableThing(store=self.store,
+                               _documentType=u'thing',
+                               _uniqueIdentifier='10',
+                               _textParts=[u'apple'],
+                               _keywordParts={})
+        generations = [self.indexer.generation()]
+        self.indexer.add(thing)
+        generations.append(self.indexer.generation())
+        self.indexer.remove(thing)
+        generations.append(self.indexer.generation())
+        self.indexer.reset()
+        generations.append(self.indexer.generation())
+        self.assertEquals(len(set(generations)), 4)
+        self.assertEquals(
+            self.store.query(fulltext._IndexerGeneration).count(), 1)
+
+
+    def test_generationBatched(self):
+        """
+        L{RemoteIndexer.generation} does not change when a document is
+        buffered by the write index, but once when the batch it is in is
+        written, whether because the batch is full or because the index is
+        closed.
+        """
+        self.indexer.batchSize = 2
+        things = [IndexableThing(store=self.store,
+                                 _documentType=u'thing',
+                                 _uniqueIdentifier=str(i),
+                                 _textParts=[u'banana'],
+                                 _keywordParts={})
+                  for i in range(10, 13)]
+        generation = self.indexer.generation()
+        self.indexer.add(things[0])
+        self.assertEquals(self.indexer.generation(), generation)
+        self.indexer.add(things[1])
+        self.assertEquals(self.indexer.generation(), generation + 1)
+        self.indexer.add(things[2])
+        self.assertEquals(self.indexer.generation(), generation + 1)
+        self.indexer._closeIndex()
+        self.assertEquals(self.indexer.generation(), generation + 2)
+
+
+    def test_cachedSearchWhileBuffering(self):
+        """
+        Results cached by L{SearchAggregator} from a search made while a
+        document is buffered are not used once the document is written.
+        """
+        self.indexer.batchSize = 2
+        self.store.powerUp(self.indexer, ixmantissa.ISearchProvider)
+        aggregator = search.SearchAggregator(store=self.store)
+        self.indexer.add(IndexableThing(store=self.store,
+                                        _documentType=u'thing',
+                                        _uniqueIdentifier='10',
+                                        _textParts=[u'banana'],
+                                        _keywordParts={}))
+        d = aggregator.count(u'banana')
+        d.addCallback(self.assertEquals, 0)
+        d.addCallback(lambda ign: self.indexer._closeIndex())
+        d.addCallback(lambda ign: aggregator.count(u'banana'))
+        d.addCallback(self.assertEquals, 1)
+        return d
+
+
+    def test_applyRemovals(self):
+        """
+        L{RemoteIndexer._applyRemovals} removes the documents which are
+        pending removal from the index.
+        """
+        self.indexer.remove(self.things[0])
+        self.indexer._applyRemovals()
+        self.assertEquals(self.store.query(fulltext._RemoveDocument).count(),
+                          0)
+        d = self.indexer.search(u'apple')
+        def searched(results):
+            self.assertEquals(identifiersFrom(results), [1, 2, 3, 4])
+            self.assertEquals(self.batchService.calls, [])
+        return d.addCallback(searched)
+
+
+
+class SQLiteFTS4FulltextTestCase(SQLiteFulltextTestCase):
+    """
+    Tests for SQLite fulltext indexing when FTS5 is not available.
+    """
+    def setUp(self):
+        self.patch(fulltext, '_FTS_MODULES', ['fts4'])
+        return SQLiteFulltextTestCase.setUp(self)
+
+
+    def test_module(self):
+        """
+        An index created without FTS5 uses FTS4.
+        """
+        reader = self.openReadIndex()
+        self.assertEquals(reader.module, 'fts4')
+        reader.close()
 
 
 
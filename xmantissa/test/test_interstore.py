@@ -12,6 +12,7 @@ from datetime import timedelta
 
 from zope.interface import implements
 
+from twisted.python import log
 from twisted.trial.unittest import TestCase
 from twisted.internet.defer import Deferred
 
@@ -19,7 +20,7 @@ from twisted.protocols.amp import Box, Command, Integer, String
 
 from epsilon.extime import Time
 
-from axiom.iaxiom import IScheduler
+from axiom.iaxiom import IScheduler, IStatEvent
 from axiom.store import Store
 from axiom.errors import UnsatisfiedRequirement
 from axiom.item import Item, POWERUP_BEFORE
@@ -31,6 +32,7 @@ from axiom.dependency import installOn
 
 from axiom.scheduler import TimedEvent
 
+from xmantissa import interstore
 from xmantissa.interstore import (
     # Public Names
     MessageQueue, AMPMessenger, LocalMessageRouter, Value,
@@ -44,8 +46,9 @@ from xmantissa.interstore import (
     ERROR_REMOTE_EXCEPTION, ERROR_NO_SHARE, ERROR_NO_USER, ERROR_BAD_SENDER,
 
     # Private Names
-    _RETRANSMIT_DELAY, _QueuedMessage, _AlreadyAnswered, _FailedAnswer,
-    _AMPExposer, _AMPErrorExposer)
+    _RETRANSMIT_DELAY, _MAXIMUM_RETRANSMIT_DELAY, _RETRANSMIT_JITTER,
+    _QueuedMessage, _AlreadyAnswered, _FailedAnswer,
+    _AMPExposer, _AMPErrorExposer, _groupByTargetAccount, _retransmitDelay)
 
 from xmantissa.sharing import getEveryoneRole, Identifier
 from xmantissa.error import (
@@ -426,6 +429,8 @@ class SingleSiteMessagingTests(TestCase):
         getEveryoneRole(self.bobStore).shareItem(self.receiver, u"suitcase")
 
         self.retransmitDelta = timedelta(seconds=_RETRANSMIT_DELAY)
+        # Make retransmission times predictable.
+        self.patch(interstore, '_jitter', lambda: 0.0)
 
 
     def accountify(self, userStore):
@@ -841,10 +846,10 @@ class SingleSiteMessagingTests(TestCase):
         slowRouter = self.stubSlowRouter()
         self.receiver.buggy = True
         sdc = self.aliceToBobWithConsequence()
-        self.runQueue(self.aliceQueue)
+        retransmitTime = self.runQueue(self.aliceQueue)
         slowRouter.flushMessages(dropAcks=True)
         [err] = self.flushLoggedErrors(SampleException)
-        self.runQueue(self.aliceQueue)
+        self.runQueueAt(self.aliceQueue, retransmitTime)
         slowRouter.flushMessages()
         self.assertEqual(sdc.invocations, 1)
         self.assertEqual(sdc.succeeded, False)
@@ -1049,6 +1054,214 @@ class SingleSiteMessagingTests(TestCase):
         self.assertEqual(bobAMP.args, [(3, 'hello')])
 
 
+    def test_sendersVerifiedOnce(self):
+        """
+        L{MessageQueue.run} retrieves the names its store may send messages as
+        once, no matter how many messages are queued.
+        """
+        calls = []
+        original = MessageQueue._internalAccountNames
+        def internalAccountNames(queue):
+            calls.append(queue)
+            return original(queue)
+        self.patch(MessageQueue, '_internalAccountNames', internalAccountNames)
+        for i in range(3):
+            self.aliceToBobWithConsequence()
+        self.runQueue(self.aliceQueue)
+        self.assertEqual(calls, [self.aliceQueue])
+        self.assertEqual(self.receiver.receivedCount, 3)
+
+
+    def test_targetLocatedOnce(self):
+        """
+        L{MessageQueue.run} locates the account each message is addressed to
+        once per batch of messages for that account, rather than once per
+        message.
+        """
+        targets = []
+        original = LocalMessageRouter._routerForAccount
+        def routerForAccount(router, identifier):
+            targets.append(identifier.localpart)
+            return original(router, identifier)
+        self.patch(LocalMessageRouter, '_routerForAccount', routerForAccount)
+        for i in range(3):
+            self.aliceToBobWithConsequence()
+        del targets[:]
+        self.runQueue(self.aliceQueue)
+        # One lookup for bob's account to deliver the messages, and one for
+        # alice's account per answer.
+        self.assertEqual(targets, [u'bob', u'alice', u'alice', u'alice'])
+        self.assertEqual(self.receiver.receivedCount, 3)
+
+
+    def test_routeMessagesSchedulesOnce(self):
+        """
+        L{MessageQueue.routeMessages} delivers each of the messages it is given
+        and schedules its queue once.
+        """
+        scheduled = []
+        scheduler = IScheduler(self.bobStore)
+        original = scheduler.schedule
+        def schedule(runnable, when):
+            scheduled.append(runnable)
+            return original(runnable, when)
+        scheduler.schedule = schedule
+        alice = Identifier(u"nothing", u"alice", u"example.com")
+        bob = Identifier(u"suitcase", u"bob", u"example.com")
+        self.bobQueue.routeMessages(
+            [(alice, bob, Value(u'custom.message.type', 'one'), 1),
+             (alice, bob, Value(u'custom.message.type', 'two'), 2),
+             (alice, bob, Value(u'custom.message.type', 'one'), 1)])
+        self.assertEqual(self.receiver.receivedCount, 2)
+        self.assertEqual(len(scheduled), 1)
+
+
+    def test_routeMessagesAlreadyAnswered(self):
+        """
+        L{MessageQueue.routeMessages} does not deliver a message again if its
+        answer has not been acknowledged yet, even though the L{Identifier}s of
+        the retransmitted message are not the ones it was first sent with.
+        """
+        self.stubSlowRouter()
+        def message():
+            return (Identifier(u"nothing", u"alice", u"example.com"),
+                    Identifier(u"suitcase", u"bob", u"example.com"),
+                    Value(u'custom.message.type', 'one'), 1)
+        self.bobQueue.routeMessages([message(), message()])
+        self.bobQueue.routeMessages([message()])
+        self.assertEqual(self.receiver.receivedCount, 1)
+        self.assertEqual(self.bobStore.query(_AlreadyAnswered).count(), 1)
+
+
+    def test_throughputStatistics(self):
+        """
+        L{MessageQueue.run} logs an L{IStatEvent} reporting how many messages
+        and answers it attempted to deliver.
+        """
+        events = []
+        log.addObserver(events.append)
+        self.addCleanup(log.removeObserver, events.append)
+        for i in range(2):
+            self.aliceToBobWithConsequence()
+        self.runQueue(self.aliceQueue)
+        [event] = [e for e in events
+                   if e.get('interface') is IStatEvent and
+                   'stat_interstore_messages_sent' in e]
+        self.assertEqual(event['stat_interstore_messages_sent'], 2)
+        self.assertEqual(event['stat_interstore_answers_sent'], 0)
+
+
+    def runQueueAt(self, queue, when):
+        """
+        Run the given message queue as though the current time were C{when}.
+        """
+        self.time.currentSeconds = when.asPOSIXTimestamp() - 1
+        return queue.run()
+
+
+    def test_exponentialBackoff(self):
+        """
+        Each time a message is not delivered by the time it is due to be
+        retransmitted, L{MessageQueue.run} waits twice as long as the previous
+        time before retransmitting it again.
+        """
+        slowRouter = self.stubSlowRouter()
+        self.aliceToBobWithConsequence()
+        when = self.runQueue(self.aliceQueue)
+        delays = [when - self.time.peek()]
+        for i in range(3):
+            now = when
+            when = self.runQueueAt(self.aliceQueue, now)
+            delays.append(when - now)
+        self.assertEqual(
+            delays, [self.retransmitDelta * factor for factor in [1, 2, 4, 8]])
+        self.assertEqual(len(slowRouter.messages), 4)
+        [qmsg] = list(self.aliceStore.query(_QueuedMessage))
+        self.assertEqual(qmsg.attempts, 4)
+        self.assertEqual(qmsg.nextAttempt, when)
+
+
+    def test_notYetDue(self):
+        """
+        L{MessageQueue.run} does not retransmit messages or answers which are
+        not yet due.
+        """
+        slowRouter = self.stubSlowRouter()
+        self.aliceToBobWithConsequence()
+        self.runQueue(self.aliceQueue)
+        self.runQueue(self.aliceQueue)
+        self.assertEqual(len(slowRouter.messages), 1)
+        slowRouter.flushMessages(dropAcks=True)
+        self.runQueue(self.bobQueue)
+        self.runQueue(self.bobQueue)
+        self.assertEqual(len(slowRouter.acks), 1)
+
+
+    def test_earliestDue(self):
+        """
+        L{MessageQueue.run} returns the time at which the earliest of its
+        remaining messages is due to be retransmitted.
+        """
+        self.stubSlowRouter()
+        self.aliceToBobWithConsequence()
+        first = self.runQueue(self.aliceQueue)
+        now = first
+        # Back the first message off a second time, then queue another.
+        later = self.runQueueAt(self.aliceQueue, now)
+        self.aliceToBobWithConsequence()
+        self.time.currentSeconds = now.asPOSIXTimestamp()
+        soonest = self.aliceQueue.run()
+        self.assertEqual(soonest, self.time.peek() + self.retransmitDelta)
+        self.assertTrue(soonest < later)
+
+
+    def test_newMessageNotDelayed(self):
+        """
+        A message queued while the L{MessageQueue} is waiting to retransmit an
+        older one is delivered immediately, rather than when the older one is
+        due.
+        """
+        self.stubSlowRouter()
+        self.aliceToBobWithConsequence()
+        scheduler = IScheduler(self.aliceStore)
+        [event] = self.aliceStore.query(TimedEvent)
+        event.time = self.runQueue(self.aliceQueue)
+        self.aliceToBobWithConsequence()
+        self.assertEqual(list(scheduler.scheduledTimes(self.aliceQueue)),
+                         [self.time.peek()])
+
+
+    def test_retransmitDelay(self):
+        """
+        L{_retransmitDelay} doubles with each attempt up to
+        L{_MAXIMUM_RETRANSMIT_DELAY}, and adds up to L{_RETRANSMIT_JITTER} of
+        the delay at random.
+        """
+        self.assertEqual(_retransmitDelay(1), self.retransmitDelta)
+        self.assertEqual(_retransmitDelay(3), self.retransmitDelta * 4)
+        self.assertEqual(_retransmitDelay(100),
+                         timedelta(seconds=_MAXIMUM_RETRANSMIT_DELAY))
+        self.patch(interstore, '_jitter', lambda: 0.5)
+        self.assertEqual(
+            _retransmitDelay(1),
+            timedelta(seconds=_RETRANSMIT_DELAY * (1 + _RETRANSMIT_JITTER * 0.5)))
+
+
+    def test_groupByTargetAccount(self):
+        """
+        L{_groupByTargetAccount} divides messages into batches for each target
+        account, preserving their order and limiting the size of each batch.
+        """
+        def message(localpart, messageID):
+            return (None, Identifier(u'x', localpart, u'example.com'),
+                    None, messageID)
+        messages = [message(u'bob', 1), message(u'carol', 2),
+                    message(u'bob', 3), message(u'bob', 4)]
+        self.assertEqual(
+            _groupByTargetAccount(messages, 2),
+            [[messages[0], messages[2]], [messages[3]], [messages[1]]])
+
+
 
 class SimpleError(Exception):
     """
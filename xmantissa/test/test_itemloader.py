@@ -0,0 +1,144 @@
+
+"""
+Tests for L{xmantissa._itemloader}.
+"""
+
+from twisted.trial.unittest import TestCase
+
+from axiom.store import Store
+from axiom.item import Item
+from axiom.attributes import integer, text
+from axiom.errors import ItemNotFound
+
+from xmantissa import _itemloader
+from xmantissa._itemloader import loadItems
+from xmantissa.test.queryutil import StatementCounter
+
+
+
+class LoadedThing(Item):
+    """
+    An item type for L{loadItems} to load.
+    """
+    value = integer()
+
+
+
+class OtherLoadedThing(Item):
+    """
+    Another item type for L{loadItems} to load.
+    """
+    name = text()
+
+
+
+class LoadItemsTests(TestCase):
+    """
+    Tests for L{loadItems}.
+    """
+    def setUp(self):
+        """
+        Create a store with items of a couple of types in it, and then open
+        it again so that none of them are in memory.
+        """
+        self.dbdir = self.mktemp()
+        store = Store(self.dbdir)
+        self.storeIDs = []
+        for i in range(5):
+            self.storeIDs.append(LoadedThing(store=store, value=i).storeID)
+            self.storeIDs.append(
+                OtherLoadedThing(store=store, name=unicode(i)).storeID)
+        store.close()
+        self.store = Store(self.dbdir)
+
+
+    def countQueries(self, f, *a):
+        """
+        Call C{f} with C{a} and return the number of SQL statements it ran.
+        """
+        counter = StatementCounter(self.store)
+        counter.measure(f, *a)
+        return len(counter.statements)
+
+
+    def test_order(self):
+        """
+        L{loadItems} returns the items with the given storeIDs in the order
+        they were given, including duplicates.
+        """
+        storeIDs = self.storeIDs[::-1] + self.storeIDs[:1]
+        self.assertEquals(
+            [item.storeID for item in loadItems(self.store, storeIDs)],
+            storeIDs)
+        self.assertEquals(
+            [item.value for item in loadItems(self.store, self.storeIDs[::2])],
+            range(5))
+
+
+    def test_sameItems(self):
+        """
+        L{loadItems} returns the same item objects as
+        L{Store.getItemByID}.
+        """
+        items = loadItems(self.store, self.storeIDs)
+        self.assertEquals(items,
+                          map(self.store.getItemByID, self.storeIDs))
+        for (item, storeID) in zip(items, self.storeIDs):
+            self.assertIdentical(item, self.store.getItemByID(storeID))
+
+
+    def test_queriesPerType(self):
+        """
+        L{loadItems} uses one query to find the types of the items and one
+        for each type, however many items there are.
+        """
+        self.assertEquals(
+            self.countQueries(loadItems, self.store, self.storeIDs), 3)
+
+
+    def test_chunked(self):
+        """
+        Large numbers of items are loaded a few hundred at a time.
+        """
+        self.patch(_itemloader, '_CHUNK_SIZE', 3)
+        self.assertEquals(
+            self.countQueries(loadItems, self.store, self.storeIDs[:6]), 4)
+        self.assertEquals(
+            [item.storeID for item in loadItems(self.store, self.storeIDs)],
+            self.storeIDs)
+
+
+    def test_cachedItemsNotQueried(self):
+        """
+        Items which are already in memory are not loaded again.
+        """
+        items = loadItems(self.store, self.storeIDs)
+        self.assertEquals(
+            self.countQueries(loadItems, self.store, self.storeIDs), 0)
+
+
+    def test_missing(self):
+        """
+        L{loadItems} raises L{ItemNotFound} if one of the items does not
+        exist, unless a default is given.
+        """
+        self.store.getItemByID(self.storeIDs[0]).deleteFromStore()
+        self.assertRaises(ItemNotFound, loadItems, self.store, self.storeIDs)
+        self.assertEquals(loadItems(self.store, self.storeIDs[:2], None)[0],
+                          None)
+        self.assertRaises(ItemNotFound, loadItems, self.store, [12345])
+
+
+    def test_store(self):
+        """
+        The store's own storeID loads the store.
+        """
+        self.assertEquals(loadItems(self.store, [-1]), [self.store])
+
+
+    def test_notInteger(self):
+        """
+        L{loadItems} raises L{TypeError} if it is given a storeID which is not
+        an integer.
+        """
+        self.assertRaises(TypeError, loadItems, self.store, ['1'])
@@ -13,6 +13,8 @@ from string import lowercase
 from twisted.python.reflect import qual
 from twisted.python.filepath import FilePath
 from twisted.trial import unittest
+from twisted.internet.task import Clock
+from twisted.internet.defer import succeed
 
 from formless import nameToLabel
 from nevow.tags import div, slot
@@ -2475,6 +2477,28 @@ class PersonScrollingFragmentTests(unittest.TestCase):
             fragment.baseConstraint, queryComparison)
 
 
+    def test_personDeleted(self):
+        """
+        When a L{Person} is deleted, a connected L{PersonScrollingFragment}
+        tells its client to remove its row.
+        """
+        person = self.organizer.createPerson(u'alice')
+        fragment = PersonScrollingFragment(
+            self.organizer, None, Person.name,
+            StubTranslator('alice-id', person))
+        clock = Clock()
+        fragment.callLater = clock.callLater
+        calls = []
+        def callRemote(*args):
+            calls.append(args)
+            return succeed(None)
+        fragment.callRemote = callRemote
+        fragment.connectionMade()
+        person.deleteFromStore()
+        clock.advance(0)
+        self.assertEqual(calls, [('rowsChanged', [], [u'alice-id'])])
+
+
 
 class OrganizerFragmentTests(unittest.TestCase):
     """
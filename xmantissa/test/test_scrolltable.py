@@ -11,18 +11,27 @@ require("twisted", "trial_assertwarns")
 
 from zope.interface import implements
 
+from twisted.python import log
 from twisted.trial import unittest
+from twisted.internet.task import Clock
+from twisted.internet.defer import succeed
+
+from epsilon.extime import Time
 from twisted.trial.util import suppress as SUPPRESS
 
 from axiom.store import Store
+from axiom.iaxiom import IStatEvent
 from axiom.item import Item
-from axiom.attributes import integer, text
+from axiom.attributes import integer, text, timestamp, reference
 from axiom.dependency import installOn
 from axiom.test.util import QueryCounter
 
 from xmantissa.webapp import PrivateApplication
-from xmantissa.ixmantissa import IWebTranslator, IColumn
+from xmantissa.ixmantissa import IWebTranslator, IColumn, ISearchProvider
 from xmantissa.error import Unsortable
+from xmantissa.search import MergedSearch, SearchAggregator
+from xmantissa.test.test_search import FakeSearchProvider, FakeHit
+from xmantissa.test.queryutil import StatementCounter
 
 
 from xmantissa.scrolltable import (
@@ -32,9 +41,12 @@ from xmantissa.scrolltable import (
     ScrollingElement,
     SequenceScrollingFragment,
     StoreIDSequenceScrollingFragment,
+    SearchResultScrollingFragment,
     AttributeColumn,
     UnsortableColumnWrapper,
-    UnsortableColumn)
+    UnsortableColumn,
+    RowChangeMixin,
+    itemsChanged)
 
 
 _unsortableColumnSuppression = SUPPRESS(
@@ -62,6 +74,26 @@ class DataThunkWithIndex(Item):
 
 
 
+class TimestampedThunk(Item):
+    """
+    Another testing utility, with a timestamp and a reference, for the
+    columns of which rows are built in different ways.
+    """
+    a = integer()
+    when = timestamp()
+    other = reference()
+
+
+
+class NotifyingThunk(RowChangeMixin, Item):
+    """
+    Another testing utility, whose changes are reported to the
+    L{ScrollingElement}s showing it.
+    """
+    a = integer()
+
+
+
 class ScrollTestMixin(object):
     def setUp(self):
         self.store = Store()
@@ -100,6 +132,74 @@ class ScrollTestMixin(object):
                 [self.eight, self.seven, self.six, self.five][low:high])
 
 
+    def test_rowFormats(self):
+        """
+        The row formats which the fragment can produce, other than the
+        default, are the last element of its table metadata.
+        """
+        self.assertEqual(self.scrollFragment.getTableMetadata()[-1],
+                         [u'columnar'])
+
+
+    def test_columnarRows(self):
+        """
+        Rows requested in the columnar format have the same values as rows
+        requested in the default format, arranged by column, with the names
+        of the columns given once.
+        """
+        rows = self.scrollFragment.requestRowRange(0, 3)
+        names, columns = self.scrollFragment.requestRowRange(
+            0, 3, u'columnar')
+        self.assertEqual(sorted(names), sorted(rows[0].keys()))
+        self.assertEqual(
+            [dict(zip(names, values)) for values in zip(*columns)], rows)
+
+
+    def test_unknownRowFormat(self):
+        """
+        Requesting rows in a format which is not known raises L{ValueError}.
+        """
+        self.assertRaises(ValueError, self.scrollFragment.requestRowRange,
+                          0, 3, u'unknown')
+
+
+    def test_overriddenConstructRows(self):
+        """
+        A fragment whose C{constructRows} is overridden does not offer the
+        columnar row format, which would bypass it, and rows requested from
+        it are built by the override.
+        """
+        class CustomRows(self.scrollFragment.__class__):
+            def constructRows(self, items):
+                return [u'custom'] * len(items)
+        self.scrollFragment.__class__ = CustomRows
+        self.assertEqual(self.scrollFragment.getTableMetadata()[-1], [])
+        self.assertEqual(self.scrollFragment.requestRowRange(0, 2),
+                         [u'custom', u'custom'])
+        self.assertRaises(ValueError, self.scrollFragment.requestRowRange,
+                          0, 2, u'columnar')
+
+
+    def test_columnarOptIn(self):
+        """
+        A fragment which overrides both C{constructRows} and
+        C{constructColumns} can offer the columnar row format by setting
+        C{rowFormats}.
+        """
+        class CustomRows(self.scrollFragment.__class__):
+            rowFormats = (u'columnar',)
+            def constructRows(self, items):
+                return [u'custom'] * len(items)
+            def constructColumns(self, items):
+                return [[u'custom'], [[u'custom'] * len(items)]]
+        self.scrollFragment.__class__ = CustomRows
+        self.assertEqual(self.scrollFragment.getTableMetadata()[-1],
+                         [u'columnar'])
+        self.assertEqual(
+            self.scrollFragment.requestRowRange(0, 2, u'columnar'),
+            [[u'custom'], [[u'custom', u'custom']]])
+
+
 
 class ScrollingFragmentTestCase(ScrollTestMixin,
                                 unittest.TestCase):
@@ -242,6 +342,86 @@ class ScrollingFragmentTestCase(ScrollTestMixin,
     test_oneSortableSortMetadata.suppress = [_unsortableColumnSuppression]
 
 
+    def test_countCached(self):
+        """
+        The number of rows is counted once for all the scrolltables of the
+        same items, and counted again after items are created or deleted.
+        """
+        events = []
+        log.addObserver(events.append)
+        self.addCleanup(log.removeObserver, events.append)
+        other = self.getScrollFragment()
+        self.assertEqual(self.scrollFragment.requestCurrentSize(), 4)
+        self.assertEqual(other.requestCurrentSize(), 4)
+        DataThunk(store=self.store, a=9)
+        self.assertEqual(other.requestCurrentSize(), 5)
+        self.five.deleteFromStore()
+        self.assertEqual(self.scrollFragment.requestCurrentSize(), 4)
+        self.assertEqual(other.requestCurrentSize(), 4)
+        stats = [key
+                 for event in events if event.get('interface') is IStatEvent
+                 for key in event if key.startswith('stat_scrolltable_count')]
+        self.assertEqual(stats, ['stat_scrolltable_count_cache_misses',
+                                 'stat_scrolltable_count_cache_hits',
+                                 'stat_scrolltable_count_cache_misses',
+                                 'stat_scrolltable_count_cache_misses',
+                                 'stat_scrolltable_count_cache_hits'])
+
+
+    def test_keysetPaging(self):
+        """
+        A range of rows which begins where an earlier one ended is found
+        without an offset.
+        """
+        counter = StatementCounter(self.store)
+        for sortAscending in [True, False]:
+            self.scrollFragment.isAscending = sortAscending
+            rows = []
+            for start in range(0, 4, 2):
+                counter.measure(
+                    lambda: rows.extend(
+                        self.scrollFragment.performQuery(start, start + 2)))
+                statements = [sql for (sql, args) in counter.statements]
+                self.assertEqual(
+                    [sql for sql in statements if 'OFFSET 0' in sql],
+                    [sql for sql in statements if 'OFFSET' in sql])
+            expected = [self.five, self.six, self.seven, self.eight]
+            if not sortAscending:
+                expected.reverse()
+            self.assertEqual(rows, expected)
+
+
+    def test_keysetPagingDuplicatesAndNulls(self):
+        """
+        Paging from the ends of earlier ranges finds the same rows as paging
+        by offset when some of the sort values are the same or C{None}.
+        """
+        store = Store()
+        for a in [3, None, 1, 3, None, 2, 3, 1]:
+            DataThunk(store=store, a=a)
+        for sortAscending in [True, False]:
+            fragment = ScrollingFragment(
+                store, DataThunk, None, [DataThunk.a], DataThunk.a,
+                sortAscending, webTranslator=FakeTranslator())
+            expected = fragment.performQuery(0, 8)
+            fragment._anchors.clear()
+            for size in [1, 3]:
+                rows = []
+                for start in range(0, 8, size):
+                    rows.extend(fragment.performQuery(start, start + size))
+                self.assertEqual(rows, expected)
+
+
+    def test_keysetPagingAfterChange(self):
+        """
+        The ends of earlier ranges are not used after items are created.
+        """
+        self.scrollFragment.performQuery(0, 2)
+        DataThunk(store=self.store, a=5, c=u'five again')
+        self.assertEqual(self.scrollFragment.performQuery(2, 4),
+                         [self.six, self.seven])
+
+
 
 class SequenceScrollingFragmentTestCase(ScrollTestMixin, unittest.TestCase):
     """
@@ -268,6 +448,157 @@ class StoreIDSequenceScrollingFragmentTestCase(ScrollTestMixin, unittest.TestCas
 
 
 
+class SearchResultScrollingFragmentTestCase(ScrollTestMixin,
+                                            unittest.TestCase):
+    """
+    Run the general scrolling tests against L{SearchResultScrollingFragment}
+    backed by a list of search results.
+    """
+    def getScrollFragment(self):
+        return SearchResultScrollingFragment(
+            self.store,
+            [FakeHit(item.storeID, item.a)
+             for item in [self.five, self.six, self.seven, self.eight]],
+            [DataThunk.b, DataThunk.c], DataThunk.a)
+
+
+
+class MergedSearchScrollingFragmentTestCase(unittest.TestCase):
+    """
+    Tests for L{SearchResultScrollingFragment} backed by a L{MergedSearch}.
+    """
+    def setUp(self):
+        self.store = Store()
+        installOn(PrivateApplication(store=self.store), self.store)
+        self.things = [DataThunk(a=i, b=i, c=unicode(i), store=self.store)
+                       for i in range(6)]
+        providers = []
+        for things in [self.things[0::2], self.things[1::2]]:
+            provider = FakeSearchProvider([])
+            provider.hits = [FakeHit(str(thing.storeID), thing.a)
+                             for thing in things]
+            providers.append(provider)
+        self.providers = providers
+        self.results = MergedSearch(providers, u'term')
+        self.results.pageSize = 1
+        d = self.results.count()
+        self.scrollFragment = SearchResultScrollingFragment(
+            self.store, self.results, [DataThunk.b, DataThunk.c])
+        return d
+
+
+    def test_count(self):
+        """
+        The number of rows is the number of search results.
+        """
+        self.assertEquals(self.scrollFragment.requestCurrentSize(), 6)
+
+
+    def test_performQueryAscending(self):
+        """
+        L{SearchResultScrollingFragment.performQuery} merges only as many
+        results as are needed for the requested range.
+        """
+        d = self.scrollFragment.performQuery(1, 3)
+        d.addCallback(self.assertEquals, self.things[1:3])
+        d.addCallback(lambda ign: self.assertEquals(
+                [provider.searches for provider in self.providers],
+                [[(3, 0)], [(3, 0)]]))
+        return d
+
+
+    def test_performQueryDescending(self):
+        """
+        Ranges are counted from the end when the sort order is descending.
+        """
+        self.scrollFragment.isAscending = False
+        d = self.scrollFragment.performQuery(1, 3)
+        d.addCallback(self.assertEquals, [self.things[4], self.things[3]])
+        return d
+
+
+    def test_performQueryDescendingFromFront(self):
+        """
+        When the sort order is not that of the L{MergedSearch}, the results
+        are retrieved from the front of a reversed copy of it, and only as
+        many as are needed for the requested range.
+        """
+        self.scrollFragment.isAscending = False
+        d = self.scrollFragment.performQuery(0, 2)
+        d.addCallback(self.assertEquals, [self.things[5], self.things[4]])
+        d.addCallback(lambda ign: self.assertEquals(
+                [provider.searches for provider in self.providers],
+                [[(2, 0)], [(2, 0)]]))
+        d.addCallback(lambda ign: self.assertEquals(self.results._merged, []))
+        return d
+
+
+    def test_descendingSearch(self):
+        """
+        A fragment whose sort order is that of a descending L{MergedSearch}
+        retrieves its rows from that search.
+        """
+        results = MergedSearch(self.providers, u'term', sortAscending=False)
+        scrollFragment = SearchResultScrollingFragment(
+            self.store, results, [DataThunk.b, DataThunk.c],
+            defaultSortAscending=False)
+        d = results.count()
+        d.addCallback(lambda ign: scrollFragment.performQuery(1, 3))
+        d.addCallback(self.assertEquals, [self.things[4], self.things[3]])
+        d.addCallback(lambda ign: self.assertEquals(
+                len(results._merged), 3))
+        return d
+
+
+    def test_fromSearch(self):
+        """
+        L{SearchResultScrollingFragment.fromSearch} makes a fragment backed by
+        the L{MergedSearch} of an aggregator's providers, in the requested
+        order.
+        """
+        provider = FakeSearchProvider([])
+        provider.hits = [FakeHit(str(thing.storeID), thing.a)
+                         for thing in self.things]
+        self.store.inMemoryPowerUp(provider, ISearchProvider)
+        aggregator = SearchAggregator(store=self.store)
+        d = SearchResultScrollingFragment.fromSearch(
+            aggregator, u'term', columns=[DataThunk.b, DataThunk.c],
+            defaultSortAscending=False)
+        def made(scrollFragment):
+            self.assertIsInstance(scrollFragment, SearchResultScrollingFragment)
+            self.assertIsInstance(scrollFragment.elements, MergedSearch)
+            self.assertFalse(scrollFragment.elements.sortAscending)
+            self.assertFalse(scrollFragment.isAscending)
+            self.assertEquals(scrollFragment.requestCurrentSize(), 6)
+            return scrollFragment.performQuery(0, 2)
+        d.addCallback(made)
+        d.addCallback(self.assertEquals, [self.things[5], self.things[4]])
+        return d
+
+
+    def test_requestRowRange(self):
+        """
+        L{SearchResultScrollingFragment.requestRowRange} returns a L{Deferred}
+        which fires with the rows.
+        """
+        d = self.scrollFragment.requestRowRange(0, 2)
+        d.addCallback(lambda rows: [row['c'] for row in rows])
+        d.addCallback(self.assertEquals, [u'0', u'1'])
+        return d
+
+
+    def test_requestColumnarRowRange(self):
+        """
+        Rows from a L{MergedSearch} can also be requested in the columnar
+        format.
+        """
+        d = self.scrollFragment.requestRowRange(0, 2, u'columnar')
+        d.addCallback(lambda (names, columns): columns[names.index(u'c')])
+        d.addCallback(self.assertEquals, [u'0', u'1'])
+        return d
+
+
+
 class TestableInequalityModel(InequalityModel):
     """
     Helper for InequalityModel tests which implements the row construction
@@ -588,6 +919,448 @@ class ScrollingElementTests(unittest.TestCase):
 
 
 
+class ScrollingElementRowCacheTests(unittest.TestCase):
+    """
+    Tests for the cache of windows of rows kept by L{ScrollingElement}.
+    """
+    def setUp(self):
+        """
+        Create a L{ScrollingElement} of some L{DataThunk}s, which counts the
+        rows it builds, with a fake clock.
+        """
+        self.store = Store()
+        installOn(PrivateApplication(store=self.store), self.store)
+        self.data = [DataThunk(store=self.store, a=a, b=a, c=unicode(a))
+                     for a in range(10)]
+        self.clock = Clock()
+        self.built = []
+        self.element = ScrollingElement(
+            self.store, DataThunk, None, [DataThunk.a, DataThunk.c],
+            DataThunk.a)
+        self.element.callLater = self.clock.callLater
+        constructRows = self.element.constructRows
+        def countingConstructRows(items):
+            rows = constructRows(items)
+            self.built.extend(rows)
+            return rows
+        self.element.constructRows = countingConstructRows
+
+
+    def values(self, rows):
+        return [row[u'a'] for row in rows]
+
+
+    def test_cached(self):
+        """
+        Rows which have been requested once are not built again when they are
+        requested again, and fewer rows from the same boundary are also
+        answered from the cache.
+        """
+        self.assertEqual(self.values(self.element.rowsAfterValue(3, 4)),
+                         [3, 4, 5, 6])
+        self.assertEqual(self.values(self.element.rowsBeforeValue(3, 2)),
+                         [1, 2])
+        del self.built[:]
+        self.assertEqual(self.values(self.element.rowsAfterValue(3, 3)),
+                         [3, 4, 5])
+        self.assertEqual(self.values(self.element.rowsBeforeValue(3, 1)),
+                         [2])
+        self.assertEqual(self.built, [])
+        self.assertEqual(self.values(self.element.rowsAfterValue(3, 5)),
+                         [3, 4, 5, 6, 7])
+        self.assertEqual(
+            (self.element._rowCache.hits, self.element._rowCache.misses),
+            (2, 3))
+
+
+    def test_exhausted(self):
+        """
+        If fewer rows were found than were requested, more rows from the same
+        boundary are answered from the cache.
+        """
+        self.element.rowsAfterValue(8, 3)
+        del self.built[:]
+        self.assertEqual(self.values(self.element.rowsAfterValue(8, 10)),
+                         [8, 9])
+        self.assertEqual(self.built, [])
+
+
+    def test_prefetch(self):
+        """
+        After a full window of rows is requested, the window which follows it
+        in the same direction is built ahead of time.
+        """
+        rows = self.element.rowsAfterValue(None, 3)
+        self.assertEqual(self.values(rows), [0, 1, 2])
+        self.clock.advance(0)
+        self.assertEqual(self.values(self.built), [0, 1, 2, 3, 4, 5])
+        del self.built[:]
+        self.assertEqual(
+            self.values(self.element.rowsAfterRow(rows[-1], 3)), [3, 4, 5])
+        self.assertEqual(
+            self.values(self.element.rowsAfterRow(rows[-1], 2)), [3, 4])
+        self.assertEqual(self.built, [])
+
+        rows = self.element.rowsBeforeValue(7, 3)
+        self.clock.advance(0)
+        del self.built[:]
+        self.assertEqual(
+            self.values(self.element.rowsBeforeRow(rows[0], 3)), [1, 2, 3])
+        self.assertEqual(self.built, [])
+
+
+    def test_noPrefetchAtEnd(self):
+        """
+        Nothing is built ahead of time after a request which reached the end
+        of the rows.
+        """
+        self.element.rowsAfterValue(8, 3)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+    def test_storeChanged(self):
+        """
+        Rows are built again after any item in the store is created, changed
+        or deleted.
+        """
+        self.element.rowsAfterValue(4, 2)
+        DataThunk(store=self.store, a=4, c=u'another four')
+        self.assertEqual(
+            [row[u'c'] for row in self.element.rowsAfterValue(4, 2)],
+            [u'4', u'another four'])
+
+        self.data[4].c = u'four'
+        self.assertEqual(
+            [row[u'c'] for row in self.element.rowsAfterValue(4, 2)],
+            [u'four', u'another four'])
+
+        self.data[4].deleteFromStore()
+        self.assertEqual(
+            [row[u'c'] for row in self.element.rowsAfterValue(4, 2)],
+            [u'another four', u'5'])
+
+
+    def test_changedInAnotherConnection(self):
+        """
+        Rows are built again after another connection to the database writes
+        to it.
+        """
+        dbdir = self.mktemp()
+        store = Store(dbdir)
+        installOn(PrivateApplication(store=store), store)
+        DataThunk(store=store, a=1)
+        element = ScrollingElement(
+            store, DataThunk, None, [DataThunk.a], DataThunk.a)
+        element.rowsAfterValue(None, 5)
+        other = Store(dbdir)
+        DataThunk(store=other, a=2)
+        other.close()
+        self.assertEqual(
+            [row[u'a'] for row in element.rowsAfterValue(None, 5)], [1, 2])
+
+
+    def test_baseConstraintReplaced(self):
+        """
+        Rows are built again after the base constraint of the element is
+        replaced.
+        """
+        self.element.rowsAfterValue(None, 20)
+        self.element.baseConstraint = DataThunk.a > 7
+        self.assertEqual(self.values(self.element.rowsAfterValue(None, 20)),
+                         [8, 9])
+
+
+    def test_invalidateRows(self):
+        """
+        L{ScrollingElement.invalidateRows} causes rows to be built again.
+        """
+        self.element.rowsAfterValue(None, 20)
+        self.element.invalidateRows()
+        del self.built[:]
+        self.element.rowsAfterValue(None, 20)
+        self.assertEqual(len(self.built), 10)
+
+
+    def test_resort(self):
+        """
+        Rows sorted by a different column are cached separately.
+        """
+        self.assertEqual(self.values(self.element.rowsAfterValue(None, 2)),
+                         [0, 1])
+        self.element.resort(u'c')
+        self.clock.advance(0)
+        self.assertEqual(self.values(self.element.rowsAfterValue(u'5', 2)),
+                         [5, 6])
+
+
+
+class RowChangeTests(unittest.TestCase):
+    """
+    Tests for the changes to rows which L{ScrollingElement} sends to its
+    client.
+    """
+    def setUp(self):
+        """
+        Create a connected L{ScrollingElement} of some L{NotifyingThunk}s,
+        which records its remote calls, with a fake clock.
+        """
+        self.store = Store()
+        self.translator = PrivateApplication(store=self.store)
+        installOn(self.translator, self.store)
+        self.things = dict((a, NotifyingThunk(store=self.store, a=a))
+                           for a in [0, 2, 4, 6])
+        self.clock = Clock()
+        self.element = self.connect(
+            NotifyingThunk, NotifyingThunk.a < 100, NotifyingThunk.a)
+
+
+    def connect(self, itemType, baseConstraint, column):
+        """
+        Create a L{ScrollingElement} and connect it.
+        """
+        self.calls = []
+        element = ScrollingElement(
+            self.store, itemType, baseConstraint, [column], column)
+        element.callLater = self.clock.callLater
+        def callRemote(methodName, *args):
+            self.calls.append((methodName,) + args)
+            return succeed(None)
+        element.callRemote = callRemote
+        element.connectionMade()
+        return element
+
+
+    def webID(self, item):
+        return unicode(self.translator.toWebID(item), 'ascii')
+
+
+    def changes(self):
+        """
+        Let the reactor run, and return the changes which were sent to the
+        client, as a list of two-tuples of the web ID of the previous row and
+        the value of the changed row, and the list of removed web IDs.
+        """
+        self.clock.advance(0)
+        self.assertEqual(len(self.calls), 1)
+        methodName, changes, removed = self.calls.pop()
+        self.assertEqual(methodName, 'rowsChanged')
+        return [(previous, row[u'a']) for (previous, row) in changes], removed
+
+
+    def test_created(self):
+        """
+        A new item is sent to the client on the next iteration of the reactor,
+        along with the web ID of the row before it.
+        """
+        thing = NotifyingThunk(store=self.store, a=3)
+        self.assertEqual(self.calls, [])
+        self.assertEqual(self.changes(),
+                         ([(self.webID(self.things[2]), 3)], []))
+        self.assertEqual(self.element.constructRows([thing])[0][u'__id__'],
+                         self.webID(thing))
+
+
+    def test_firstRow(self):
+        """
+        A new item which comes first has no previous row.
+        """
+        NotifyingThunk(store=self.store, a=-1)
+        self.assertEqual(self.changes(), ([(None, -1)], []))
+
+
+    def test_changed(self):
+        """
+        A changed item is sent to the client with the web ID of the row which
+        is now before it.
+        """
+        self.things[2].a = 5
+        self.assertEqual(self.changes(),
+                         ([(self.webID(self.things[4]), 5)], []))
+
+
+    def test_deleted(self):
+        """
+        The web ID of a deleted item is sent to the client.
+        """
+        webID = self.webID(self.things[4])
+        self.things[4].deleteFromStore()
+        self.assertEqual(self.changes(), ([], [webID]))
+
+
+    def test_noLongerMatches(self):
+        """
+        The web ID of an item which no longer matches the base constraint is
+        sent to the client.
+        """
+        self.things[4].a = 200
+        self.assertEqual(self.changes(), ([], [self.webID(self.things[4])]))
+
+
+    def test_batched(self):
+        """
+        All of the changes made during one iteration of the reactor are sent
+        in one call, in the order of the rows, so that each row comes after
+        the rows before it.
+        """
+        def change():
+            NotifyingThunk(store=self.store, a=5)
+            self.things[0].a = 7
+            self.things[6].deleteFromStore()
+        self.store.transact(change)
+        NotifyingThunk(store=self.store, a=1)
+        webIDs = dict((a, self.webID(thing))
+                      for (a, thing) in self.things.iteritems())
+        self.assertEqual(
+            self.changes(),
+            ([(None, 1), (webIDs[4], 5), (self.webID(
+                            self.store.findUnique(NotifyingThunk,
+                                                  NotifyingThunk.a == 5)), 7)],
+             [webIDs[6]]))
+
+
+    def test_descending(self):
+        """
+        When the rows are in descending order, the previous row is the one
+        with the next highest value.
+        """
+        self.element.resort(u'a')
+        NotifyingThunk(store=self.store, a=3)
+        self.assertEqual(self.changes(),
+                         ([(self.webID(self.things[4]), 3)], []))
+
+
+    def test_otherItemTypes(self):
+        """
+        Changes to items of other types are not sent to the client.
+        """
+        itemsChanged(self.store, [DataThunk(store=self.store, a=1)])
+        self.clock.advance(0)
+        self.assertEqual(self.calls, [])
+
+
+    def test_itemsChanged(self):
+        """
+        Changes to items which do not report their own changes are sent to
+        the client when they are reported to L{itemsChanged}.
+        """
+        thing = DataThunk(store=self.store, a=1)
+        element = self.connect(DataThunk, None, DataThunk.a)
+        thing.a = 2
+        self.clock.advance(0)
+        self.assertEqual(self.calls, [])
+        itemsChanged(self.store, [thing])
+        self.assertEqual(self.changes(), ([(None, 2)], []))
+
+
+    def test_connectionLost(self):
+        """
+        Changes are not sent to the client once the connection has been lost,
+        even if they were made before it was.
+        """
+        self.things[2].a = 3
+        self.element.connectionLost(None)
+        self.things[4].a = 5
+        self.clock.advance(0)
+        self.assertEqual(self.calls, [])
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+    def test_notConnected(self):
+        """
+        Changes are not sent to the client of an element which has not been
+        connected.
+        """
+        self.element.connectionLost(None)
+        element = ScrollingElement(
+            self.store, NotifyingThunk, None, [NotifyingThunk.a],
+            NotifyingThunk.a)
+        element.callLater = self.clock.callLater
+        NotifyingThunk(store=self.store, a=1)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+
+class AttributeRowTests(unittest.TestCase):
+    """
+    Tests for building the rows of a L{ScrollingElement} whose columns are all
+    attributes straight from the database.
+    """
+    def setUp(self):
+        """
+        Create some items in an on-disk store and open it again, so that none
+        of them are in memory.
+        """
+        dbdir = self.mktemp()
+        store = Store(dbdir)
+        installOn(PrivateApplication(store=store), store)
+        for a in range(5):
+            TimestampedThunk(store=store, a=a,
+                             when=Time.fromPOSIXTimestamp(1000000 + a))
+        store.close()
+        self.store = Store(dbdir)
+        self.loaded = []
+        existingInStore = TimestampedThunk.existingInStore.im_func
+        def recordingExistingInStore(cls, store, storeID, attrs):
+            self.loaded.append(storeID)
+            return existingInStore(cls, store, storeID, attrs)
+        self.patch(TimestampedThunk, 'existingInStore',
+                   classmethod(recordingExistingInStore))
+
+
+    def makeElement(self, columns):
+        return ScrollingElement(
+            self.store, TimestampedThunk, None, columns, TimestampedThunk.a)
+
+
+    def test_sameRows(self):
+        """
+        The rows built from the database are the same as the rows built from
+        the items, and no items are loaded to build them.
+        """
+        element = self.makeElement([TimestampedThunk.a, TimestampedThunk.when])
+        rows = element.rowsAfterValue(1, 3)
+        self.assertEqual(self.loaded, [])
+        self.assertEqual([row[u'a'] for row in rows], [1, 2, 3])
+        self.assertEqual([row[u'when'] for row in rows],
+                         [1000001.0, 1000002.0, 1000003.0])
+
+        slowElement = self.makeElement(
+            [TimestampedThunk.a, TimestampedThunk.when])
+        slowElement.constructRows = slowElement.constructRows
+        self.assertEqual(slowElement.rowsAfterValue(1, 3), rows)
+        self.assertEqual(
+            element.rowsBeforeRow(rows[0], 2),
+            slowElement.rowsBeforeRow(rows[0], 2))
+
+
+    def test_missingTimestamp(self):
+        """
+        Building a row with a timestamp column whose value is C{None} fails,
+        as it does when the row is built from the item.
+        """
+        TimestampedThunk(store=self.store, a=10)
+        element = self.makeElement([TimestampedThunk.a, TimestampedThunk.when])
+        self.assertRaises(AttributeError, element.rowsAfterValue, 10, 1)
+
+
+    def test_computedColumns(self):
+        """
+        Items are loaded to build rows with columns which are not plain
+        attributes.
+        """
+        element = self.makeElement(
+            [TimestampedThunk.a, TimestampedThunk.other])
+        element.rowsAfterValue(None, 1)
+        self.assertEqual(len(self.loaded), 1)
+
+        column = AttributeColumn(TimestampedThunk.a)
+        column.extractValue = lambda model, item: item.a * 2
+        element = self.makeElement([column])
+        self.assertEqual(
+            [row[u'a'] for row in element.rowsAfterValue(None, 2)], [0, 2])
+
+
+
 class InequalityModelDuplicatesTestCase(unittest.TestCase):
     """
     Similar to L{InequalityModelTestCase}, but test cases where there are
@@ -1,11 +1,14 @@
 from zope.interface import implements
 
 from twisted.internet import defer
+from twisted.internet.task import Clock
+from twisted.python import log
 
 from axiom.store import Store
 from axiom.item import Item
 from axiom import attributes
 from axiom.dependency import installOn
+from axiom.iaxiom import IStatEvent
 
 from nevow.testutil import renderLivePage, FragmentWrapper, AccumulatingFakeRequest
 from nevow import loaders
@@ -168,3 +171,391 @@ class AggregatorTestCase(unittest.TestCase):
         dl = defer.DeferredList([agg.search(*a[0], **a[1]) for a in args])
         dl.addCallback(checkArgs)
         return dl
+
+
+
+class FakeHit(object):
+    """
+    A search result, as returned by L{FakeSearchProvider}.
+    """
+    def __init__(self, uniqueIdentifier, sortKey):
+        self.uniqueIdentifier = uniqueIdentifier
+        self.sortKey = sortKey
+
+
+
+class FakeSearchProvider(object):
+    """
+    An L{ixmantissa.ISearchProvider} which finds a fixed list of results,
+    whatever the search.
+
+    @ivar hits: the L{FakeHit}s to find, sorted by sort key.
+
+    @ivar searches: a C{list} of the C{count} and C{offset} of each search.
+
+    @ivar deferreds: if not C{None}, a C{list} to which the Deferreds
+    returned by L{search} are appended without being fired.
+    """
+    implements(ixmantissa.ISearchProvider)
+
+    def __init__(self, sortKeys, deferreds=None):
+        self.hits = [FakeHit(str(key), key) for key in sortKeys]
+        self.searches = []
+        self.deferreds = deferreds
+
+
+    def count(self, term, keywords=None):
+        return defer.succeed(len(self.hits))
+
+
+    def search(self, term, keywords=None, count=None, offset=0,
+               sortAscending=True):
+        self.searches.append((count, offset))
+        hits = self.hits
+        if not sortAscending:
+            hits = hits[::-1]
+        if count is None:
+            hits = hits[offset:]
+        else:
+            hits = hits[offset:offset + count]
+        if self.deferreds is not None:
+            d = defer.Deferred()
+            self.deferreds.append((d, hits))
+            return d
+        return defer.succeed(hits)
+
+
+
+class MergedSearchTests(unittest.TestCase):
+    """
+    Tests for L{search.MergedSearch}.
+    """
+    def setUp(self):
+        self.first = FakeSearchProvider([1, 4, 5, 7])
+        self.second = FakeSearchProvider([2, 3, 6])
+        self.results = search.MergedSearch(
+            [self.first, self.second], u'term')
+        self.results.pageSize = 2
+
+
+    def _sortKeys(self, d):
+        """
+        Add a callback to C{d} which turns the results it fires with into
+        their sort keys.
+        """
+        return d.addCallback(lambda hits: [hit.sortKey for hit in hits])
+
+
+    def test_merged(self):
+        """
+        The results of all of the providers are merged by sort key.
+        """
+        d = self._sortKeys(self.results.slice())
+        d.addCallback(self.assertEquals, [1, 2, 3, 4, 5, 6, 7])
+        return d
+
+
+    def test_descending(self):
+        """
+        Results are merged in descending order if the search is not
+        ascending.
+        """
+        self.results.sortAscending = False
+        d = self._sortKeys(self.results.slice(1, 3))
+        d.addCallback(self.assertEquals, [6, 5, 4])
+        return d
+
+
+    def test_onlyNeededResultsRetrieved(self):
+        """
+        A slice of the results only retrieves as many results from each
+        provider as could be in it, and results are not retrieved again for
+        later slices.
+        """
+        d = self._sortKeys(self.results.slice(1, 2))
+        d.addCallback(self.assertEquals, [2, 3])
+        d.addCallback(lambda ign: self.assertEquals(
+                (self.first.searches, self.second.searches),
+                ([(3, 0)], [(3, 0)])))
+        d.addCallback(lambda ign: self._sortKeys(self.results.slice(3, 3)))
+        d.addCallback(self.assertEquals, [4, 5, 6])
+        d.addCallback(lambda ign: self.assertEquals(
+                (self.first.searches, self.second.searches),
+                ([(3, 0), (2, 3)], [(3, 0)])))
+        return d
+
+
+    def test_slowProviderCancelled(self):
+        """
+        A provider which does not return its results within C{timeout}
+        seconds is cancelled, and its results are left out.
+        """
+        clock = Clock()
+        deferreds = []
+        slow = FakeSearchProvider([0], deferreds)
+        self.results = search.MergedSearch(
+            [self.first, slow], u'term', timeout=5, clock=clock)
+        found = []
+        d = self._sortKeys(self.results.slice(0, 2))
+        d.addCallback(found.append)
+        clock.advance(4)
+        self.assertEquals(found, [])
+        clock.advance(1)
+        self.assertEquals(found, [[1, 4]])
+        self.assertEquals(clock.getDelayedCalls(), [])
+        [(slowDeferred, hits)] = deferreds
+        self.assertTrue(slowDeferred.called)
+
+
+    def test_failingProvider(self):
+        """
+        The results of a provider whose search fails are left out, and the
+        failure is logged.
+        """
+        self.second.search = lambda *a, **kw: defer.fail(RuntimeError())
+        d = self._sortKeys(self.results.slice())
+        d.addCallback(self.assertEquals, [1, 4, 5, 7])
+        d.addCallback(
+            lambda ign: self.assertEquals(
+                len(self.flushLoggedErrors(RuntimeError)), 1))
+        return d
+
+
+    def test_count(self):
+        """
+        L{search.MergedSearch.count} adds up the counts of the providers, and
+        the total is the length of the results.
+        """
+        d = self.results.count()
+        d.addCallback(self.assertEquals, 7)
+        d.addCallback(lambda ign: self.assertEquals(len(self.results), 7))
+        return d
+
+
+    def test_lengthOfMergedResults(self):
+        """
+        Once every result has been merged, the length of the results is the
+        number which were merged, even if it differs from the count.
+        """
+        self.second.count = lambda term: defer.succeed(100)
+        d = self.results.count()
+        d.addCallback(lambda ign: self.results.slice())
+        d.addCallback(lambda ign: self.assertEquals(len(self.results), 7))
+        return d
+
+
+    def test_reversed(self):
+        """
+        L{search.MergedSearch.reversed} returns a search of the same
+        providers sorted the other way, counted if the original was, which
+        retrieves its own results from the front of each provider's.
+        """
+        d = self.results.count()
+        def counted(ign):
+            backwards = self.results.reversed()
+            self.assertFalse(backwards.sortAscending)
+            self.assertEquals(backwards.pageSize, 2)
+            self.assertEquals(len(backwards), 7)
+            return self._sortKeys(backwards.slice(0, 2))
+        d.addCallback(counted)
+        d.addCallback(self.assertEquals, [7, 6])
+        d.addCallback(lambda ign: self.assertEquals(
+                (self.first.searches, self.second.searches),
+                ([(2, 0)], [(2, 0)])))
+        return d
+
+
+    def test_mergedSearch(self):
+        """
+        L{search.SearchAggregator.mergedSearch} returns a counted
+        L{search.MergedSearch} of every provider.
+        """
+        s = Store()
+        s.inMemoryPowerUp(self.first, ixmantissa.ISearchProvider)
+        agg = search.SearchAggregator(store=s)
+        d = agg.mergedSearch(u'term', sortAscending=False)
+        def searched(results):
+            self.assertIsInstance(results, search.MergedSearch)
+            self.assertEquals(results.total, 4)
+            self.assertFalse(results.sortAscending)
+            self.assertEquals(agg.searches, 1)
+            return self._sortKeys(results.slice())
+        d.addCallback(searched)
+        d.addCallback(self.assertEquals, [7, 5, 4, 1])
+        return d
+
+
+
+class GenerationalSearchProvider(FakeSearchProvider):
+    """
+    A L{FakeSearchProvider} which reports the generation of its documents,
+    and can be made to fail.
+
+    @ivar currentGeneration: the generation to report.
+
+    @ivar fail: whether searching and counting should fail.
+    """
+    currentGeneration = 0
+    fail = False
+
+    def generation(self):
+        return self.currentGeneration
+
+
+    def count(self, term, keywords=None):
+        if self.fail:
+            return defer.fail(RuntimeError())
+        return FakeSearchProvider.count(self, term, keywords)
+
+
+    def search(self, *a, **kw):
+        if self.fail:
+            self.searches.append(None)
+            return defer.fail(RuntimeError())
+        return FakeSearchProvider.search(self, *a, **kw)
+
+
+
+class SearchCacheTests(unittest.TestCase):
+    """
+    Tests for the caching of search results by L{search.SearchAggregator}.
+    """
+    def setUp(self):
+        self.store = Store()
+        self.provider = GenerationalSearchProvider([1, 2, 3])
+        self.store.inMemoryPowerUp(self.provider, ixmantissa.ISearchProvider)
+        self.aggregator = search.SearchAggregator(store=self.store)
+        self.cache = self.aggregator._cache
+
+
+    def _searchTwice(self, *a, **kw):
+        """
+        Search twice with the same arguments and return a L{Deferred} which
+        fires with both results.
+        """
+        return defer.gatherResults([self.aggregator.search(*a, **kw),
+                                    self.aggregator.search(*a, **kw)])
+
+
+    def test_searchCached(self):
+        """
+        Searching again with the same arguments returns the same results
+        without searching the providers again, while searching with different
+        arguments does.
+        """
+        d = self._searchTwice(u'term', None, count=2)
+        def searched((first, second)):
+            self.assertEquals(first, second)
+            self.assertEquals(self.provider.searches, [(2, 0)])
+            return self.aggregator.search(u'term', None, count=2, offset=1)
+        d.addCallback(searched)
+        d.addCallback(lambda ign: self.assertEquals(
+                self.provider.searches, [(2, 0), (2, 1)]))
+        return d
+
+
+    def test_countCached(self):
+        """
+        L{search.SearchAggregator.count} is cached too.
+        """
+        calls = []
+        self.provider.count = (
+            lambda term: calls.append(term) or defer.succeed(3))
+        d = defer.gatherResults([self.aggregator.count(u'term'),
+                                 self.aggregator.count(u'term')])
+        d.addCallback(self.assertEquals, [3, 3])
+        d.addCallback(lambda ign: self.assertEquals(calls, [u'term']))
+        return d
+
+
+    def test_generationChanged(self):
+        """
+        Cached results are not used once the generation of the providers has
+        changed.
+        """
+        d = self.aggregator.search(u'term')
+        def searched(ign):
+            self.provider.currentGeneration += 1
+            return self.aggregator.search(u'term')
+        d.addCallback(searched)
+        d.addCallback(lambda ign: self.assertEquals(
+                self.provider.searches, [(None, 0), (None, 0)]))
+        return d
+
+
+    def test_withoutGeneration(self):
+        """
+        Searches of providers which do not report a generation are not
+        cached.
+        """
+        provider = FakeSearchProvider([1])
+        self.store.inMemoryPowerUp(provider, ixmantissa.ISearchProvider)
+        d = self._searchTwice(u'term')
+        d.addCallback(lambda ign: self.assertEquals(
+                provider.searches, [(None, 0), (None, 0)]))
+        d.addCallback(lambda ign: self.assertEquals(
+                (self.cache.hits, self.cache.misses), (0, 0)))
+        return d
+
+
+    def test_failureNotCached(self):
+        """
+        Searches during which a provider failed are not cached.
+        """
+        self.provider.fail = True
+        d = self._searchTwice(u'term')
+        d.addCallback(lambda ign: self.assertEquals(
+                self.provider.searches, [None, None]))
+        d.addCallback(lambda ign: self.assertEquals(
+                len(self.flushLoggedErrors(RuntimeError)), 2))
+        return d
+
+
+    def test_leastRecentlyUsedEvicted(self):
+        """
+        When the cache is full, the result which was used the longest time
+        ago is dropped.
+        """
+        self.cache.maximumSize = 2
+        d = defer.succeed(None)
+        for term in [u'a', u'b', u'a', u'c', u'a', u'b']:
+            d.addCallback(lambda ign, term=term: self.aggregator.search(term))
+        d.addCallback(lambda ign: self.assertEquals(
+                (self.cache.hits, self.cache.misses), (2, 4)))
+        return d
+
+
+    def test_stats(self):
+        """
+        Cache hits and misses are logged as L{IStatEvent}s.
+        """
+        events = []
+        log.addObserver(events.append)
+        self.addCleanup(log.removeObserver, events.append)
+        d = self._searchTwice(u'term')
+        def searched(ign):
+            stats = [(key, value)
+                     for event in events
+                     if event.get('interface') is IStatEvent
+                     for (key, value) in event.items()
+                     if key.startswith('stat_search_cache')]
+            self.assertEquals(stats, [('stat_search_cache_misses', 1),
+                                      ('stat_search_cache_hits', 1)])
+        return d.addCallback(searched)
+
+
+    def test_mergedSearchCached(self):
+        """
+        L{search.SearchAggregator.mergedSearch} returns the same
+        L{search.MergedSearch} for the same search, unless a provider has
+        failed during it.
+        """
+        d = defer.gatherResults([self.aggregator.mergedSearch(u'term'),
+                                 self.aggregator.mergedSearch(u'term')])
+        def searched((first, second)):
+            self.assertIdentical(first, second)
+            first.failed = True
+            return self.aggregator.mergedSearch(u'term')
+        d.addCallback(searched)
+        d.addCallback(lambda third: self.assertFalse(third.failed))
+        return d
@@ -3,6 +3,11 @@
 Unit tests for the L{xmantissa.sharing} module.
 """
 
+import gc
+import sys
+import weakref
+from StringIO import StringIO
+
 from zope.interface import Interface, implements
 
 from epsilon.hotfix import require
@@ -16,12 +21,16 @@ from twisted.python.components import registerAdapter
 from twisted.protocols.amp import Command, Box, parseString
 
 from axiom.store import Store
+from axiom.iaxiom import IQuery
 from axiom.item import Item
 from axiom.attributes import integer, boolean
-from axiom.test.util import QueryCounter
+from axiom.test.util import QueryCounter, CommandStub
 from axiom.userbase import LoginMethod, LoginAccount
 
+from axiom.plugins.sharingcmd import RebuildRoles
+
 from xmantissa import sharing
+from xmantissa._storechange import storeChangeToken
 
 class IPrivateThing(Interface):
     def mutateSomeState():
@@ -706,8 +715,72 @@ class AccessibilityQuery(unittest.TestCase):
 
         after = zomg.measure(checkit)
         self.assertEquals(before, after)
-    test_limitEfficiency.todo = (
-        'currently gets too many results because we should be using paginate')
+
+
+    def test_providesQuery(self):
+        """
+        L{Role.asAccessibleTo} returns an L{IQuery} provider with the limit and
+        store of the query it was given.
+        """
+        query = self.store.query(PrivateThing, limit=3)
+        accessible = self.bob.asAccessibleTo(query)
+        self.assertTrue(IQuery.providedBy(accessible))
+        self.assertIdentical(accessible.store, self.store)
+        self.assertEquals(accessible.limit, 3)
+
+
+    def test_count(self):
+        """
+        The C{count} method of the query returned by L{Role.asAccessibleTo}
+        counts only the items accessible to the role, up to the limit.
+        """
+        for i in range(5):
+            self.addSomeThings()
+        PrivateThing(store=self.store, publicData=1000)
+        query = self.store.query(PrivateThing)
+        self.assertEquals(self.bob.asAccessibleTo(query).count(), 5)
+        self.assertEquals(
+            self.bob.asAccessibleTo(query.cloneQuery(limit=2)).count(), 2)
+        self.assertEquals(
+            self.bob.asAccessibleTo(
+                self.store.query(PrivateThing,
+                                 PrivateThing.publicData > -3)).count(),
+            3)
+
+
+    def test_offset(self):
+        """
+        The offset of the query passed to L{Role.asAccessibleTo} skips
+        accessible items, not items which have not been shared.
+        """
+        for i in range(3):
+            PrivateThing(store=self.store, publicData=100 + i)
+            self.addSomeThings()
+        query = self.store.query(PrivateThing, offset=1, limit=1,
+                                 sort=PrivateThing.publicData.descending)
+        self.assertEquals(
+            map(sharing.itemFromProxy, self.bob.asAccessibleTo(query)),
+            [self.things[1]])
+        self.assertEquals(self.bob.asAccessibleTo(query).count(), 1)
+        self.assertEquals(
+            self.bob.asAccessibleTo(
+                self.store.query(PrivateThing, offset=2, limit=5)).count(),
+            1)
+
+
+    def test_cloneQuery(self):
+        """
+        The C{cloneQuery} method of the query returned by
+        L{Role.asAccessibleTo} changes the limit and sort of the query it
+        wraps.
+        """
+        for i in range(4):
+            self.addSomeThings()
+        accessible = self.bob.asAccessibleTo(self.store.query(PrivateThing))
+        clone = accessible.cloneQuery(
+            limit=2, sort=PrivateThing.publicData.ascending)
+        self.assertEquals(clone.limit, 2)
+        self.assertEquals([p.retrieveSomeState() for p in clone], [-3, -2])
 
 
 class HeuristicTestCases(unittest.TestCase):
@@ -809,6 +882,353 @@ class HeuristicTestCases(unittest.TestCase):
 
 
 
+class RoleMembershipTests(unittest.TestCase):
+    """
+    Tests for L{sharing.RoleMembership}, the transitive closure of
+    L{sharing.RoleRelationship} which answers L{sharing.Role.allRoles}.
+    """
+
+    def setUp(self):
+        """
+        Create a store with a chain of nested roles.
+        """
+        self.store = Store()
+        self.user = sharing.Role(store=self.store, externalID=u'user@example.com')
+        self.team = sharing.Role(store=self.store, externalID=u'team')
+        self.department = sharing.Role(store=self.store,
+                                       externalID=u'department')
+        self.company = sharing.Role(store=self.store, externalID=u'company')
+
+
+    def test_newRoleActsAsItself(self):
+        """
+        A newly created L{sharing.Role} is recorded as a member of itself.
+        """
+        self.assertEquals(list(self.user.allRoles()), [self.user])
+        self.assertEquals(
+            self.store.query(sharing.RoleMembership,
+                             sharing.RoleMembership.member == self.user).count(),
+            1)
+
+
+    def test_transitiveMembership(self):
+        """
+        L{sharing.Role.allRoles} includes every group reachable via
+        L{sharing.Role.becomeMemberOf}, nearest first, regardless of the order
+        in which the relationships were created.
+        """
+        self.department.becomeMemberOf(self.company)
+        self.user.becomeMemberOf(self.team)
+        self.team.becomeMemberOf(self.department)
+        self.assertEquals(
+            list(self.user.allRoles()),
+            [self.user, self.team, self.department, self.company])
+        self.assertEquals(
+            list(self.team.allRoles()),
+            [self.team, self.department, self.company])
+
+
+    def test_allRolesSingleQuery(self):
+        """
+        L{sharing.Role.allRoles} does the same amount of work no matter how
+        deeply nested the roles are.
+        """
+        counter = QueryCounter(self.store)
+        self.user.becomeMemberOf(self.team)
+        shallow = counter.measure(lambda: list(self.user.allRoles()))
+        self.team.becomeMemberOf(self.department)
+        self.department.becomeMemberOf(self.company)
+        deep = counter.measure(lambda: list(self.user.allRoles()))
+        # The result set is larger, so allow for per-row work, but not for a
+        # query per role.
+        self.assertTrue(deep < shallow * 2, (shallow, deep))
+
+
+    def test_cycle(self):
+        """
+        Roles which are members of each other can act as each other, and
+        L{sharing.Role.allRoles} reports each of them only once.
+        """
+        self.user.becomeMemberOf(self.team)
+        self.team.becomeMemberOf(self.user)
+        self.assertEquals(list(self.user.allRoles()), [self.user, self.team])
+        self.assertEquals(list(self.team.allRoles()), [self.team, self.user])
+
+
+    def test_deleteIntermediateRole(self):
+        """
+        Deleting a group role removes the memberships which depended on it,
+        but not those which are reachable by another path.
+        """
+        self.user.becomeMemberOf(self.team)
+        self.team.becomeMemberOf(self.department)
+        self.department.becomeMemberOf(self.company)
+        self.user.becomeMemberOf(self.company)
+        self.team.deleteFromStore()
+        self.assertEquals(list(self.user.allRoles()),
+                          [self.user, self.company])
+        self.assertEquals(
+            list(self.store.query(sharing.RoleRelationship,
+                                  sharing.RoleRelationship.group == None)),
+            [])
+
+
+    def test_legacyRoles(self):
+        """
+        Roles with no L{sharing.RoleMembership}s, such as those created before
+        it existed, still report all of their roles, and have their
+        memberships computed when they become members of another role.
+        """
+        self.user.becomeMemberOf(self.team)
+        self.team.becomeMemberOf(self.department)
+        self.store.query(sharing.RoleMembership).deleteFromStore()
+        self.assertEquals(list(self.user.allRoles()),
+                          [self.user, self.team, self.department])
+        self.department.becomeMemberOf(self.company)
+        self.assertEquals(list(self.department.allRoles()),
+                          [self.department, self.company])
+        self.assertEquals(list(self.user.allRoles()),
+                          [self.user, self.team, self.department,
+                           self.company])
+
+
+    def test_rebuildRoleMemberships(self):
+        """
+        L{sharing.rebuildRoleMemberships} recomputes the memberships of every
+        role in a store from its L{sharing.RoleRelationship}s.
+        """
+        self.user.becomeMemberOf(self.team)
+        self.team.becomeMemberOf(self.department)
+        before = sorted(
+            (m.member.storeID, m.group.storeID, m.depth)
+            for m in self.store.query(sharing.RoleMembership))
+        self.store.query(sharing.RoleMembership).deleteFromStore()
+        self.assertEquals(sharing.rebuildRoleMemberships(self.store), 4)
+        after = sorted(
+            (m.member.storeID, m.group.storeID, m.depth)
+            for m in self.store.query(sharing.RoleMembership))
+        self.assertEquals(before, after)
+
+
+    def test_rebuildCommand(self):
+        """
+        I{axiomatic sharing rebuild-roles} rebuilds the memberships of the
+        roles in the store it is run against.
+        """
+        self.user.becomeMemberOf(self.team)
+        self.store.query(sharing.RoleMembership).deleteFromStore()
+        command = RebuildRoles()
+        command.parent = CommandStub(self.store, 'rebuild-roles')
+        output = StringIO()
+        self.patch(sys, 'stdout', output)
+        command.parseOptions([])
+        self.assertEquals(output.getvalue(),
+                          'Rebuilt memberships for 4 roles.\n')
+        self.assertEquals(
+            self.store.query(sharing.RoleMembership,
+                             sharing.RoleMembership.member == self.user).count(),
+            2)
+
+
+
+class ShareCacheTests(unittest.TestCase):
+    """
+    Tests for the cache of resolved shares used by L{sharing.Role.getShare}.
+    """
+
+    def setUp(self):
+        """
+        Create a store with a role and a shared item.
+        """
+        self.store = Store()
+        self.role = sharing.Role(store=self.store, externalID=u'bob@example.com')
+        self.group = sharing.Role(store=self.store, externalID=u'group')
+        self.thing = PrivateThing(store=self.store, publicData=1)
+        self.role.shareItem(self.thing, shareID=u'thing',
+                            interfaces=[IReadOnly])
+
+
+    def test_cached(self):
+        """
+        Retrieving the same share again while the store has not changed does
+        not look it up again; only the store's change token is asked for.
+        """
+        self.role.getShare(u'thing')
+        counter = QueryCounter(self.store)
+        self.assertEquals(
+            counter.measure(self.role.getShare, u'thing'),
+            counter.measure(storeChangeToken, self.store))
+        self.assertEquals(
+            self.role.getShare(u'thing').retrieveSomeState(), 1)
+
+
+    def test_itemsNotKept(self):
+        """
+        The cache remembers shared items by storeID, and so does not keep them,
+        or their store, in memory.
+        """
+        store = Store()
+        role = sharing.Role(store=store, externalID=u'bob@example.com')
+        role.shareItem(PrivateThing(store=store, publicData=1),
+                       shareID=u'thing', interfaces=[IReadOnly])
+        role.getShare(u'thing')
+        storeRef = weakref.ref(store)
+        del store, role
+        gc.collect()
+        self.assertIdentical(storeRef(), None)
+
+
+    def test_invalidatedByNewShare(self):
+        """
+        Sharing an item invalidates previously resolved shares, including
+        missing ones.
+        """
+        self.assertRaises(sharing.NoSuchShare, self.role.getShare, u'other')
+        other = PrivateThing(store=self.store, publicData=2)
+        self.role.shareItem(other, shareID=u'other', interfaces=[IReadOnly])
+        self.assertIdentical(
+            sharing.itemFromProxy(self.role.getShare(u'other')), other)
+        self.role.shareItem(self.thing, shareID=u'thing',
+                            interfaces=[IPrivateThing])
+        self.assertEquals(
+            set(self.role.getShare(u'thing').sharedInterfaces),
+            set([IReadOnly, IPrivateThing]))
+
+
+    def test_invalidatedByUnShare(self):
+        """
+        L{sharing.unShare} invalidates previously resolved shares.
+        """
+        self.role.getShare(u'thing')
+        sharing.unShare(self.thing)
+        self.assertRaises(sharing.NoSuchShare, self.role.getShare, u'thing')
+
+
+    def test_invalidatedByDeletion(self):
+        """
+        Deleting a shared item invalidates previously resolved shares.
+        """
+        self.role.getShare(u'thing')
+        self.thing.deleteFromStore()
+        self.assertRaises(sharing.NoSuchShare, self.role.getShare, u'thing')
+
+
+    def test_invalidatedByShareChange(self):
+        """
+        Changing the attributes of a L{sharing.Share} directly invalidates
+        previously resolved shares.
+        """
+        self.role.getShare(u'thing')
+        share = self.store.findUnique(sharing.Share)
+        share.shareID = u'renamed'
+        self.assertRaises(sharing.NoSuchShare, self.role.getShare, u'thing')
+        self.role.getShare(u'renamed')
+        share.sharedTo = self.group
+        self.assertRaises(sharing.NoSuchShare, self.role.getShare, u'renamed')
+        self.group.getShare(u'renamed')
+        other = PrivateThing(store=self.store, publicData=2)
+        share.sharedItem = other
+        self.assertIdentical(
+            sharing.itemFromProxy(self.group.getShare(u'renamed')), other)
+
+
+    def test_invalidatedByOtherConnection(self):
+        """
+        Shares removed by another connection to the same database are not
+        resolved from the cache.
+        """
+        dbdir = self.mktemp()
+        store = Store(dbdir)
+        role = sharing.Role(store=store, externalID=u'bob@example.com')
+        role.shareItem(PrivateThing(store=store, publicData=1),
+                       shareID=u'thing', interfaces=[IReadOnly])
+        role.getShare(u'thing')
+        other = Store(dbdir)
+        other.query(sharing.Share).deleteFromStore()
+        other.close()
+        self.assertRaises(sharing.NoSuchShare, role.getShare, u'thing')
+
+
+    def test_invalidatedByMembership(self):
+        """
+        Becoming a member of a group invalidates previously resolved shares,
+        as does deleting that group.
+        """
+        other = PrivateThing(store=self.store, publicData=2)
+        self.group.shareItem(other, shareID=u'other', interfaces=[IReadOnly])
+        self.assertRaises(sharing.NoSuchShare, self.role.getShare, u'other')
+        self.role.becomeMemberOf(self.group)
+        self.assertIdentical(
+            sharing.itemFromProxy(self.role.getShare(u'other')), other)
+        self.group.deleteFromStore()
+        self.assertRaises(sharing.NoSuchShare, self.role.getShare, u'other')
+
+
+    def test_notCachedInTransaction(self):
+        """
+        Shares resolved inside a transaction which is reverted are not
+        remembered.
+        """
+        other = PrivateThing(store=self.store, publicData=2)
+        def tx():
+            self.role.shareItem(other, shareID=u'other')
+            self.role.getShare(u'other')
+            raise ValueError()
+        self.assertRaises(ValueError, self.store.transact, tx)
+        self.assertRaises(sharing.NoSuchShare, self.role.getShare, u'other')
+
+
+    def test_uniqueInterfaces(self):
+        """
+        L{sharing._uniqueInterfaces} drops duplicate interfaces and interfaces
+        extended by others, preserving order, and remembers its result.
+        """
+        unique = sharing._uniqueInterfaces(
+            [IExternal, IReadOnly, IExtraExternal, IReadOnly])
+        self.assertEquals(unique, (IReadOnly, IExtraExternal))
+        self.assertIdentical(
+            sharing._uniqueInterfaces(
+                (IExternal, IReadOnly, IExtraExternal, IReadOnly)),
+            unique)
+
+
+
+class SharedProxyAttributeTests(unittest.TestCase):
+    """
+    Tests for the dispatch of attribute access on a L{sharing.SharedProxy} to
+    the interfaces it is shared with.
+    """
+
+    def test_attributeDispatch(self):
+        """
+        L{sharing._attributeDispatch} maps each name declared by a sequence of
+        interfaces, including inherited names, to the first interface which
+        declares it, and remembers its result.
+        """
+        dispatch = sharing._attributeDispatch((IReadOnly, IExtraExternal))
+        self.assertEquals(dispatch, {'retrieveSomeState': IReadOnly,
+                                     'doExternal': IExtraExternal,
+                                     'doExternalExtra': IExtraExternal})
+        self.assertIdentical(
+            sharing._attributeDispatch((IReadOnly, IExtraExternal)), dispatch)
+
+
+    def test_proxyAttributes(self):
+        """
+        Attributes of a L{sharing.SharedProxy} are looked up on the shared
+        item, or its adapter, for the interface which declares them, and other
+        attributes of the item are not exposed.
+        """
+        thing = PrivateThing(store=Store(), publicData=3)
+        proxy = sharing.SharedProxy(thing, (IReadOnly, IExternal), u'thing')
+        self.assertEquals(proxy.retrieveSomeState(), 3)
+        self.assertEquals(proxy.doExternal(), "external")
+        self.assertTrue(thing.externalized)
+        self.assertRaises(AttributeError, getattr, proxy, 'mutateSomeState')
+        self.assertRaises(AttributeError, getattr, proxy, 'publicData')
+
+
+
 class CommandWithIdentifier(Command):
     """
     This command has an Identifier as one of its arguments.
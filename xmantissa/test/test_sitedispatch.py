@@ -0,0 +1,312 @@
+
+"""
+Tests for L{xmantissa._sitedispatch}.
+"""
+
+from zope.interface import implements
+
+from twisted.trial.unittest import TestCase
+
+from axiom.store import Store
+from axiom.item import Item
+from axiom.attributes import boolean, text
+from axiom.test.util import QueryCounter
+
+from nevow.testutil import FakeRequest
+
+from xmantissa.ixmantissa import ISiteRootPlugin, ISessionlessSiteRootPlugin
+from xmantissa.website import PrefixURLMixin
+from xmantissa.web import UnguardedWrapper
+from xmantissa._webutil import SiteRootMixin
+from xmantissa._sitedispatch import SiteRootPlugins, siteRootPlugins
+from xmantissa._storechange import storeChangeToken
+
+
+
+produced = []
+
+class PrefixPlugin(PrefixURLMixin, Item):
+    """
+    A site root plugin which responds to the URLs beneath its C{prefixURL},
+    and records when it is asked for a resource.
+    """
+    implements(ISiteRootPlugin, ISessionlessSiteRootPlugin)
+
+    prefixURL = text()
+    sessioned = boolean(default=True)
+    sessionless = boolean(default=True)
+
+    def createResource(self):
+        produced.append(self)
+        return self
+
+
+
+class OverridingPrefixPlugin(PrefixURLMixin, Item):
+    """
+    A site root plugin which has a C{prefixURL} but also responds to the root
+    URL, and so does not declare a prefix for L{ISiteRootPlugin}.
+    """
+    implements(ISiteRootPlugin)
+
+    prefixURL = text()
+    sessioned = boolean(default=True)
+
+    def createResource(self):
+        produced.append(self)
+        return self
+
+
+    def produceResource(self, request, segments, webViewer):
+        if segments == ('',):
+            produced.append(self)
+            return self, segments
+        return super(OverridingPrefixPlugin, self).produceResource(
+            request, segments, webViewer)
+
+
+
+class DynamicPlugin(Item):
+    """
+    A site root plugin which does not declare a prefix, and so is asked for a
+    resource for every URL.
+    """
+    implements(ISiteRootPlugin)
+    powerupInterfaces = (ISiteRootPlugin,)
+
+    name = text()
+
+    def produceResource(self, request, segments, webViewer):
+        produced.append(self)
+        return None
+
+
+
+class FakeSite(SiteRootMixin):
+    """
+    A L{SiteRootMixin} for a store.
+    """
+    def __init__(self, store):
+        self.store = store
+
+
+
+class PrefixSegmentsTests(TestCase):
+    """
+    Tests for L{PrefixURLMixin.prefixSegmentsFor}.
+    """
+    def test_prefixSegments(self):
+        """
+        L{PrefixURLMixin.prefixSegmentsFor} returns the segments of
+        C{prefixURL}, for both site root plugin interfaces.
+        """
+        plugin = PrefixPlugin(prefixURL=u'foo/bar')
+        for interface in ISiteRootPlugin, ISessionlessSiteRootPlugin:
+            self.assertEqual(
+                plugin.prefixSegmentsFor(interface), (u'foo', u'bar'))
+
+
+    def test_rootPrefixSegments(self):
+        """
+        L{PrefixURLMixin.prefixSegmentsFor} returns no segments for a plugin
+        at the root.
+        """
+        self.assertEqual(
+            PrefixPlugin(prefixURL=u'').prefixSegmentsFor(ISiteRootPlugin), ())
+
+
+    def test_overridden(self):
+        """
+        L{PrefixURLMixin.prefixSegmentsFor} returns C{None} for an interface
+        whose resource-producing method has been overridden.
+        """
+        plugin = OverridingPrefixPlugin(prefixURL=u'foo')
+        self.assertIdentical(plugin.prefixSegmentsFor(ISiteRootPlugin), None)
+        self.assertEqual(
+            plugin.prefixSegmentsFor(ISessionlessSiteRootPlugin), (u'foo',))
+
+
+    def test_otherInterface(self):
+        """
+        L{PrefixURLMixin.prefixSegmentsFor} returns C{None} for interfaces
+        other than the site root plugin interfaces.
+        """
+        self.assertIdentical(
+            PrefixPlugin(prefixURL=u'foo').prefixSegmentsFor(object), None)
+
+
+
+class SiteRootPluginsTests(TestCase):
+    """
+    Tests for L{SiteRootPlugins}.
+    """
+    def setUp(self):
+        del produced[:]
+        self.store = Store()
+        self.plugins = siteRootPlugins(self.store, ISiteRootPlugin)
+
+
+    def install(self, plugin):
+        """
+        Install a plugin as a powerup on C{self.store}.
+        """
+        self.store.powerUp(plugin)
+        return plugin
+
+
+    def test_siteRootPlugins(self):
+        """
+        L{siteRootPlugins} returns the same L{SiteRootPlugins} every time it is
+        called with the same store and interface.
+        """
+        self.assertIsInstance(self.plugins, SiteRootPlugins)
+        self.assertIdentical(self.plugins.store, self.store)
+        self.assertIdentical(self.plugins.interface, ISiteRootPlugin)
+        self.assertIdentical(
+            siteRootPlugins(self.store, ISiteRootPlugin), self.plugins)
+        self.assertNotIdentical(
+            siteRootPlugins(self.store, ISessionlessSiteRootPlugin),
+            self.plugins)
+        self.assertNotIdentical(
+            siteRootPlugins(Store(), ISiteRootPlugin), self.plugins)
+
+
+    def test_matchingPrefixes(self):
+        """
+        L{SiteRootPlugins.pluginsFor} returns the plugins whose prefixes match
+        the segments, and those which do not declare a prefix, in the order
+        of their powerup priorities.
+        """
+        root = self.install(PrefixPlugin(store=self.store, prefixURL=u''))
+        foo = self.install(PrefixPlugin(store=self.store, prefixURL=u'foo'))
+        fooBar = self.install(
+            PrefixPlugin(store=self.store, prefixURL=u'foo/bar'))
+        baz = self.install(PrefixPlugin(store=self.store, prefixURL=u'baz'))
+        dynamic = self.install(DynamicPlugin(store=self.store))
+
+        self.assertEqual(
+            self.plugins.pluginsFor(('foo', 'bar', 'quux')),
+            [dynamic, fooBar, foo, root])
+        self.assertEqual(
+            self.plugins.pluginsFor(('foo', 'baz')), [dynamic, foo, root])
+        self.assertEqual(self.plugins.pluginsFor(('baz',)),
+                         [dynamic, baz, root])
+        self.assertEqual(self.plugins.pluginsFor(('',)), [dynamic, root])
+
+
+    def test_overridden(self):
+        """
+        Plugins which do not declare a prefix for the interface are returned
+        for any segments.
+        """
+        plugin = self.install(
+            OverridingPrefixPlugin(store=self.store, prefixURL=u'foo'))
+        self.assertEqual(self.plugins.pluginsFor(('',)), [plugin])
+        self.assertEqual(self.plugins.pluginsFor(('bar',)), [plugin])
+
+
+    def test_cached(self):
+        """
+        The powerups are not queried again while the store has not changed.
+        """
+        foo = self.install(PrefixPlugin(store=self.store, prefixURL=u'foo'))
+        self.plugins.pluginsFor(('foo',))
+        counter = QueryCounter(self.store)
+        self.assertEqual(
+            counter.measure(self.plugins.pluginsFor, ('foo',)),
+            counter.measure(storeChangeToken, self.store))
+        self.assertEqual(self.plugins.pluginsFor(('foo',)), [foo])
+        self.assertEqual(self.plugins.rebuilds, 1)
+
+
+    def test_unrelatedChange(self):
+        """
+        The plugins are not arranged again when something in the store other
+        than the powerups changes.
+        """
+        foo = self.install(PrefixPlugin(store=self.store, prefixURL=u'foo'))
+        self.plugins.pluginsFor(('foo',))
+        DynamicPlugin(store=self.store)
+        self.assertEqual(self.plugins.pluginsFor(('foo',)), [foo])
+        self.assertEqual(self.plugins.rebuilds, 1)
+
+
+    def test_powerupInstalled(self):
+        """
+        A plugin installed after the plugins were arranged is returned.
+        """
+        self.plugins.pluginsFor(('foo',))
+        foo = self.install(PrefixPlugin(store=self.store, prefixURL=u'foo'))
+        self.assertEqual(self.plugins.pluginsFor(('foo',)), [foo])
+
+
+    def test_powerupUninstalled(self):
+        """
+        A plugin uninstalled after the plugins were arranged is not returned.
+        """
+        foo = self.install(PrefixPlugin(store=self.store, prefixURL=u'foo'))
+        self.plugins.pluginsFor(('foo',))
+        self.store.powerDown(foo)
+        self.assertEqual(self.plugins.pluginsFor(('foo',)), [])
+
+
+    def test_prefixChanged(self):
+        """
+        A plugin whose prefix changes is returned for its new prefix.
+        """
+        foo = self.install(PrefixPlugin(store=self.store, prefixURL=u'foo'))
+        self.plugins.pluginsFor(('foo',))
+        foo.prefixURL = u'bar'
+        self.assertEqual(self.plugins.pluginsFor(('foo',)), [])
+        self.assertEqual(self.plugins.pluginsFor(('bar',)), [foo])
+
+
+    def test_inMemoryPowerup(self):
+        """
+        A plugin installed in memory is returned first.
+        """
+        dynamic = self.install(DynamicPlugin(store=self.store))
+        self.plugins.pluginsFor(('foo',))
+        plugin = PrefixPlugin(prefixURL=u'foo')
+        self.store.inMemoryPowerUp(plugin, ISiteRootPlugin)
+        self.assertEqual(
+            self.plugins.pluginsFor(('foo',)), [plugin, dynamic])
+
+
+    def test_invalidate(self):
+        """
+        L{SiteRootPlugins.invalidate} makes the next call to C{pluginsFor}
+        find the powerups again.
+        """
+        self.plugins.pluginsFor(('foo',))
+        self.plugins.invalidate()
+        self.plugins.pluginsFor(('foo',))
+        self.assertEqual(self.plugins.rebuilds, 2)
+
+
+    def test_siteProduceResource(self):
+        """
+        L{SiteRootMixin.siteProduceResource} only asks the plugins whose
+        prefixes match the request, and those without a prefix, for a
+        resource.
+        """
+        dynamic = self.install(DynamicPlugin(store=self.store))
+        self.install(PrefixPlugin(store=self.store, prefixURL=u'foo'))
+        bar = self.install(PrefixPlugin(store=self.store, prefixURL=u'bar'))
+        result = FakeSite(self.store).siteProduceResource(
+            FakeRequest(), ('bar', 'baz'), None)
+        self.assertEqual(result, (bar, ('baz',)))
+        self.assertEqual(produced, [dynamic, bar])
+
+
+    def test_unguardedWrapper(self):
+        """
+        L{UnguardedWrapper.locateChild} only asks the sessionless plugins
+        whose prefixes match the request for a resource.
+        """
+        self.install(PrefixPlugin(store=self.store, prefixURL=u'foo'))
+        bar = self.install(PrefixPlugin(store=self.store, prefixURL=u'bar'))
+        wrapper = UnguardedWrapper(self.store, None)
+        result = wrapper.locateChild(FakeRequest(), ('bar', 'baz'))
+        self.assertEqual(result, (bar, ('baz',)))
+        self.assertEqual(produced, [bar])
@@ -0,0 +1,134 @@
+
+"""
+Tests for L{xmantissa._storechange}.
+"""
+
+from twisted.trial.unittest import TestCase
+
+from zope.interface import Interface
+
+from axiom.store import Store
+from axiom.item import Item
+from axiom.attributes import integer
+
+from xmantissa._storechange import (
+    storeChangeToken, powerupsToken, inMemoryPowerup)
+
+
+
+class IChanging(Interface):
+    """
+    An interface to install L{ChangingThing}s as powerups for.
+    """
+
+
+
+class ChangingThing(Item):
+    """
+    An item to change a store with.
+    """
+    value = integer()
+
+
+
+class StoreChangeTokenTests(TestCase):
+    """
+    Tests for L{storeChangeToken}.
+    """
+    def setUp(self):
+        self.dbdir = self.mktemp()
+        self.store = Store(self.dbdir)
+        self.thing = ChangingThing(store=self.store, value=0)
+
+
+    def test_unchanged(self):
+        """
+        L{storeChangeToken} returns the same value while nothing is written to
+        the store.
+        """
+        token = storeChangeToken(self.store)
+        list(self.store.query(ChangingThing))
+        self.assertEqual(storeChangeToken(self.store), token)
+
+
+    def test_changed(self):
+        """
+        L{storeChangeToken} returns a different value after an item in the
+        store is changed.
+        """
+        token = storeChangeToken(self.store)
+        self.thing.value = 1
+        self.assertNotEqual(storeChangeToken(self.store), token)
+
+
+    def test_changedElsewhere(self):
+        """
+        L{storeChangeToken} returns a different value after another connection
+        to the same database writes to it.
+        """
+        token = storeChangeToken(self.store)
+        other = Store(self.dbdir)
+        ChangingThing(store=other, value=1)
+        other.close()
+        self.assertNotEqual(storeChangeToken(self.store), token)
+
+
+
+class PowerupsTokenTests(TestCase):
+    """
+    Tests for L{powerupsToken} and L{inMemoryPowerup}.
+    """
+    def setUp(self):
+        self.store = Store()
+        self.thing = ChangingThing(store=self.store, value=0)
+        self.store.powerUp(self.thing, IChanging)
+
+
+    def test_unchanged(self):
+        """
+        L{powerupsToken} returns the same value while the powerups for the
+        interface stay the same, even if other items change.
+        """
+        token = powerupsToken(self.store, IChanging)
+        self.thing.value = 1
+        ChangingThing(store=self.store, value=2)
+        self.assertEqual(powerupsToken(self.store, IChanging), token)
+
+
+    def test_powerupInstalled(self):
+        """
+        L{powerupsToken} returns a different value after a powerup is
+        installed for the interface, and the first value again once it is
+        uninstalled.
+        """
+        token = powerupsToken(self.store, IChanging)
+        other = ChangingThing(store=self.store, value=1)
+        self.store.powerUp(other, IChanging)
+        self.assertNotEqual(powerupsToken(self.store, IChanging), token)
+        self.store.powerDown(other, IChanging)
+        self.assertEqual(powerupsToken(self.store, IChanging), token)
+
+
+    def test_priorityChanged(self):
+        """
+        L{powerupsToken} returns a different value after the order of the
+        powerups changes.
+        """
+        other = ChangingThing(store=self.store, value=1)
+        self.store.powerUp(other, IChanging, priority=-1)
+        token = powerupsToken(self.store, IChanging)
+        self.store.powerUp(other, IChanging, priority=1)
+        self.assertNotEqual(powerupsToken(self.store, IChanging), token)
+
+
+    def test_inMemoryPowerup(self):
+        """
+        L{inMemoryPowerup} returns the powerup installed in memory for the
+        interface, and L{powerupsToken} changes when it is installed.
+        """
+        self.assertIdentical(inMemoryPowerup(self.store, IChanging), None)
+        token = powerupsToken(self.store, IChanging)
+        powerup = object()
+        self.store.inMemoryPowerUp(powerup, IChanging)
+        self.assertIdentical(inMemoryPowerup(self.store, IChanging), powerup)
+        self.assertNotEqual(powerupsToken(self.store, IChanging), token)
@@ -5,10 +5,13 @@ require("twisted", "trial_assertwarns")
 
 from axiom.store import Store
 from axiom.item import Item
-from axiom.attributes import integer, text, AND
+from axiom.attributes import integer, text, timestamp, AND
 from twisted.trial import unittest
 
+from epsilon.extime import Time
+
 from xmantissa import tdb, scrolltable
+from xmantissa.test.queryutil import StatementCounter
 
 class X(Item):
     typeName = 'test_tdb_model_dummy'
@@ -34,6 +37,14 @@ def breakdown(x):
         yield digits[int(c)]
 
 
+class Y(Item):
+    """
+    An item with a timestamp, to page through in order of it.
+    """
+    when = timestamp()
+
+
+
 class UnsortableColumn(scrolltable.AttributeColumn):
     def sortAttribute(self):
         return None
@@ -423,3 +434,79 @@ class ModelTest(unittest.TestCase):
         # check to see if the last valid state remains
         self.assertNumbersAre(tdm, range(15))
 
+
+    def test_pagingDoesNotCount(self):
+        """
+        Moving between pages of a store which has not changed does not count
+        any items; the position of the new page is worked out from the
+        position of the old one.
+        """
+        tdm = tdb.TabularDataModel(self.store, X, [X.number], itemsPerPage=15)
+        def page():
+            tdm.nextPage()
+            tdm.nextPage()
+            tdm.prevPage()
+            tdm.lastPage()
+            tdm.prevPage()
+            tdm.firstPage()
+            tdm.currentPage()
+        counter = StatementCounter(self.store)
+        counter.measure(page)
+        self.assertEquals(
+            [sql for (sql, args) in counter.statements
+             if 'COUNT' in sql.upper()],
+            [])
+        self.assertEquals(tdm.pageNumber, 1)
+        tdm.lastPage()
+        tdm.prevPage()
+        self.assertEquals((tdm.firstItem, tdm.lastItem, tdm.pageNumber),
+                          (78, 92, 7))
+
+
+    def test_positionAfterChange(self):
+        """
+        After the store changes, the position of the next page is counted
+        again.
+        """
+        tdm = tdb.TabularDataModel(self.store, X, [X.number], itemsPerPage=15)
+        tdm.nextPage()
+        self.store.findUnique(X, X.number == 0).deleteFromStore()
+        tdm.nextPage()
+        self.assertNumbersAre(tdm, range(30, 45))
+        self.assertEquals((tdm.firstItem, tdm.totalItems), (30, 106))
+
+
+    def test_hasNextPageDoesNotBuildRows(self):
+        """
+        L{TabularDataModel.hasNextPage} and L{TabularDataModel.hasPrevPage}
+        do not extract the values of any columns.
+        """
+        tdm = tdb.TabularDataModel(self.store, X, [X.number], itemsPerPage=15)
+        tdm.nextPage()
+        column = tdm.columns['number']
+        extracted = []
+        def extractValue(model, item):
+            extracted.append(item)
+            return X.number.__get__(item)
+        column.extractValue = extractValue
+        self.failUnless(tdm.hasNextPage())
+        self.failUnless(tdm.hasPrevPage())
+        self.assertEquals(extracted, [])
+
+
+    def test_timestampSortColumn(self):
+        """
+        Pages can be found from a column whose values are not those of its
+        sort attribute.
+        """
+        for i in range(5):
+            Y(store=self.store, when=Time.fromPOSIXTimestamp(i))
+        tdm = tdb.TabularDataModel(
+            self.store, Y, [scrolltable.TimestampAttributeColumn(Y.when)],
+            itemsPerPage=2)
+        tdm.nextPage()
+        self.assertEquals([row['when'] for row in tdm.currentPage()],
+                          [2, 3])
+        tdm.prevPage()
+        self.assertEquals([row['when'] for row in tdm.currentPage()],
+                          [0, 1])
@@ -0,0 +1,200 @@
+
+"""
+Tests for L{xmantissa._userstores}.
+"""
+
+from twisted.python import log
+from twisted.trial.unittest import TestCase
+
+from axiom.store import Store
+from axiom.iaxiom import IStatEvent
+from axiom.userbase import LoginSystem, LoginMethod
+from axiom.dependency import installOn
+from axiom.errors import DuplicateUniqueItem
+
+from xmantissa._userstores import UserStoreCache, userStoreCache
+
+
+
+class UserStoreCacheTests(TestCase):
+    """
+    Tests for L{UserStoreCache}.
+    """
+    def setUp(self):
+        """
+        Create a site store with a couple of accounts and a cache of their
+        stores with a fake clock.
+        """
+        self.siteStore = Store()
+        self.loginSystem = LoginSystem(store=self.siteStore)
+        installOn(self.loginSystem, self.siteStore)
+        self.alice = self.loginSystem.addAccount(
+            u'alice', u'example.com', u'password', internal=True)
+        self.bob = self.loginSystem.addAccount(
+            u'bob', u'example.com', u'password', internal=True)
+        self.time = 0
+        self.cache = UserStoreCache(self.siteStore, now=lambda: self.time)
+
+
+    def test_open(self):
+        """
+        L{UserStoreCache.open} returns the store of the account with the given
+        username, or C{None} if there is no such account.
+        """
+        self.assertIdentical(self.cache.open(u'alice', u'example.com'),
+                             self.alice.avatars.open())
+        self.assertIdentical(self.cache.open(u'bob'), self.bob.avatars.open())
+        self.assertIdentical(self.cache.open(u'carol', u'example.com'), None)
+        self.assertIdentical(self.cache.open(u'alice', u'example.net'), None)
+
+
+    def test_hitsAndMisses(self):
+        """
+        Looking up a username a second time is answered from the cache, and
+        both kinds of lookup are counted and logged as L{IStatEvent}s.
+        """
+        events = []
+        log.addObserver(events.append)
+        self.addCleanup(log.removeObserver, events.append)
+        self.cache.open(u'alice', u'example.com')
+        self.cache.open(u'alice', u'example.com')
+        self.cache.open(u'bob', u'example.com')
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 2))
+        stats = [(key, value)
+                 for event in events if event.get('interface') is IStatEvent
+                 for (key, value) in event.items()
+                 if key.startswith('stat_user_store_cache')]
+        self.assertEqual(stats, [('stat_user_store_cache_misses', 1),
+                                 ('stat_user_store_cache_hits', 1),
+                                 ('stat_user_store_cache_misses', 1)])
+
+
+    def test_storeKeptOpen(self):
+        """
+        A cached user store is not opened again when it is looked up, even if
+        nothing else refers to it.
+        """
+        store = self.cache.open(u'alice', u'example.com')
+        storeID = id(store)
+        del store
+        self.assertEqual(id(self.cache.open(u'alice', u'example.com')),
+                         storeID)
+
+
+    def test_leastRecentlyUsedEvicted(self):
+        """
+        When the cache is full, the user store which was used the longest time
+        ago is dropped.
+        """
+        self.cache.maximumSize = 1
+        self.cache.open(u'alice', u'example.com')
+        self.cache.open(u'bob', u'example.com')
+        self.cache.open(u'bob', u'example.com')
+        self.cache.open(u'alice', u'example.com')
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 3))
+
+
+    def test_idleEvicted(self):
+        """
+        A user store which has not been used for C{idleTimeout} seconds is
+        dropped.
+        """
+        self.cache.idleTimeout = 10
+        self.cache.open(u'alice', u'example.com')
+        self.time = 9
+        self.cache.open(u'alice', u'example.com')
+        self.time = 19
+        self.cache.open(u'alice', u'example.com')
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 2))
+
+
+    def test_loginMethodChanged(self):
+        """
+        A username is looked up again if the L{LoginMethod} it was found
+        through no longer has that username.
+        """
+        self.cache.open(u'alice', u'example.com')
+        loginMethod = self.siteStore.findUnique(
+            LoginMethod, LoginMethod.localpart == u'alice')
+        loginMethod.localpart = u'alicia'
+        self.assertIdentical(self.cache.open(u'alice', u'example.com'), None)
+        self.assertIdentical(self.cache.open(u'alicia', u'example.com'),
+                             self.alice.avatars.open())
+
+
+    def test_loginMethodDeleted(self):
+        """
+        A username is looked up again if the L{LoginMethod} it was found
+        through has been deleted.
+        """
+        self.cache.open(u'alice', u'example.com')
+        self.siteStore.findUnique(
+            LoginMethod, LoginMethod.localpart == u'alice').deleteFromStore()
+        self.assertIdentical(self.cache.open(u'alice', u'example.com'), None)
+
+
+    def test_accountDeleted(self):
+        """
+        A username is looked up again if the account it was found for has
+        been deleted.
+        """
+        self.cache.open(u'alice', u'example.com')
+        self.alice.deleteFromStore()
+        self.assertIdentical(self.cache.open(u'alice', u'example.com'), None)
+
+
+    def test_accountDisabled(self):
+        """
+        A username is looked up again if the account it was found for has
+        been disabled, and disabled accounts are not found.
+        """
+        self.cache.open(u'alice', u'example.com')
+        self.alice.disabled = True
+        self.assertIdentical(self.cache.open(u'alice', u'example.com'), None)
+        self.assertEqual(self.cache.hits, 0)
+
+
+    def test_internalDisabled(self):
+        """
+        Looking up a username without a domain finds the internal
+        L{LoginMethod} for it even if its account is disabled, and keeps
+        finding it from the cache after the account is disabled.
+        """
+        store = self.cache.open(u'alice')
+        self.alice.disabled = True
+        self.assertIdentical(self.cache.open(u'alice'), store)
+        self.assertEqual(self.cache.hits, 1)
+        self.cache.invalidate()
+        self.assertIdentical(self.cache.open(u'alice'), store)
+
+
+    def test_internalDuplicate(self):
+        """
+        Looking up a username without a domain raises
+        L{DuplicateUniqueItem} if more than one internal L{LoginMethod} has
+        its localpart.
+        """
+        self.loginSystem.addAccount(
+            u'alice', u'example.net', u'password', internal=True)
+        self.assertRaises(DuplicateUniqueItem, self.cache.open, u'alice')
+
+
+    def test_invalidate(self):
+        """
+        L{UserStoreCache.invalidate} drops every user store in the cache.
+        """
+        self.cache.open(u'alice', u'example.com')
+        self.cache.invalidate()
+        self.cache.open(u'alice', u'example.com')
+        self.assertEqual((self.cache.hits, self.cache.misses), (0, 2))
+
+
+    def test_userStoreCache(self):
+        """
+        L{userStoreCache} returns the same L{UserStoreCache} for a site store
+        every time.
+        """
+        cache = userStoreCache(self.siteStore)
+        self.assertIsInstance(cache, UserStoreCache)
+        self.assertIdentical(cache.siteStore, self.siteStore)
+        self.assertIdentical(userStoreCache(self.siteStore), cache)
@@ -17,6 +17,7 @@ from nevow.athena import LiveElement
 from nevow import rend
 from nevow.rend import WovenContext
 from nevow.testutil import FakeRequest
+from nevow.url import URL
 from nevow.inevow import IRequest, IResource
 
 from xmantissa.ixmantissa import (
@@ -24,7 +25,7 @@ from xmantissa.ixmantissa import (
 
 from xmantissa.offering import InstalledOffering
 from xmantissa.webtheme import theThemeCache
-from xmantissa.webnav import Tab
+from xmantissa.webnav import Tab, navigationCache
 from xmantissa.sharing import (getSelfRole, getAuthenticatedRole,
                                getPrimaryRole)
 
@@ -358,6 +359,31 @@ class PrivateApplicationTestCase(TestCase):
         self.webViewer = IWebViewer(self.userStore)
 
 
+    def test_pageComponentsNavigation(self):
+        """
+        L{PrivateApplication.getPageComponents} gets the navigation of the
+        user store and a L{SelectedTabIndex} for it from the store's
+        navigation cache, so the same tabs are used for every page.
+        """
+        item = FakeModelItem(store=self.userStore)
+        class TabThingy(object):
+            implements(INavigableElement)
+            def getTabs(self):
+                return [Tab("supertab", item.storeID, 1.0)]
+        self.userStore.inMemoryPowerUp(TabThingy(), INavigableElement)
+        components = self.privapp.getPageComponents()
+        [tab] = components.navigation
+        self.assertEqual(tab.linkURL, self.privapp.linkTo(item.storeID))
+        self.assertIdentical(
+            components.selectedTabIndex.select(URL.fromString(tab.linkURL)),
+            tab)
+        self.assertEqual(
+            (components.navigation, components.selectedTabIndex),
+            navigationCache(self.userStore).getNavigation(self.privapp))
+        self.assertIdentical(
+            self.privapp.getPageComponents().navigation, components.navigation)
+
+
     def test_createResourceUsername(self):
         """
         L{PrivateApplication.createResourceWith} should figure out the
@@ -5,19 +5,30 @@
 Tests for L{xmantissa.webnav}.
 """
 
+from zope.interface import implements
+
 from twisted.trial import unittest
+from twisted.python.reflect import qual
 
 from epsilon.structlike import record
 
 from axiom.store import Store
+from axiom.item import Item
+from axiom.attributes import integer
 from axiom.dependency import installOn
+from axiom.test.util import QueryCounter
 
 from nevow.url import URL
 from nevow import tags, context
 from nevow.testutil import FakeRequest
 
 from xmantissa import webnav
+from xmantissa.ixmantissa import INavigableElement
 from xmantissa.webapp import PrivateApplication
+from xmantissa.product import Product, Installation
+from xmantissa.suspension import (
+    SuspendedNavigableElement, suspendJustTabProviders, unsuspendTabProviders)
+from xmantissa._storechange import powerupsToken
 
 
 
@@ -26,6 +37,36 @@ class FakeNavigator(record('tabs')):
         return self.tabs
 
 
+class NavigableThing(Item):
+    """
+    An L{INavigableElement} powerup with a tab and a subtab.
+    """
+    implements(INavigableElement)
+    powerupInterfaces = (INavigableElement,)
+
+    priority = integer(default=0)
+
+    def getTabs(self):
+        return [webnav.Tab('Thing', self.storeID, 0.5,
+                           [webnav.Tab('Subthing', self.storeID, 0.6)],
+                           authoritative=False)]
+
+
+
+class OtherNavigableThing(Item):
+    """
+    Another L{INavigableElement} powerup.
+    """
+    implements(INavigableElement)
+    powerupInterfaces = (INavigableElement,)
+
+    priority = integer(default=0)
+
+    def getTabs(self):
+        return [webnav.Tab('Other', self.storeID, 0.1)]
+
+
+
 class NavConfigTests(unittest.TestCase):
     """
     Tests for free functions in L{xmantissa.webnav}.
@@ -153,6 +194,196 @@ class NavConfigTests(unittest.TestCase):
         assertSelected(t)
 
 
+    def test_getSelectedTabChildren(self):
+        """
+        L{webnav.getSelectedTab} considers the children of the tabs it is
+        passed as well as the tabs themselves, and prefers a longer C{linkURL}
+        to a shorter one, and an earlier tab to a later one.
+        """
+        child = webnav.Tab('child', None, 0, linkURL='/a/b/')
+        tabs = [webnav.Tab('parent', None, 0, linkURL='/a', children=[child]),
+                webnav.Tab('other', None, 0, linkURL='/a/b')]
+        self.assertIdentical(
+            webnav.getSelectedTab(tabs, URL.fromString('/a/b/c')), child)
+        self.assertIdentical(
+            webnav.getSelectedTab(tabs, URL.fromString('/a/b')), tabs[1])
+        self.assertIdentical(
+            webnav.getSelectedTab(tabs, URL.fromString('/a/c')), tabs[0])
+        tabs.append(webnav.Tab('later', None, 0, linkURL='/a'))
+        self.assertIdentical(
+            webnav.getSelectedTab(tabs, URL.fromString('/a')), tabs[0])
+        self.assertIdentical(
+            webnav.getSelectedTab(tabs, URL.fromString('/a/c')), tabs[0])
+
+
+    def test_selectedTabIndex(self):
+        """
+        L{webnav.SelectedTabIndex.select} finds the same tab as
+        L{webnav.getSelectedTab} every time it is called.
+        """
+        tabs = [webnav.Tab('thing1', None, 0, linkURL='/a/b/c/d'),
+                webnav.Tab('thing2', None, 0, linkURL='/a/b/c'),
+                webnav.Tab('thing3', None, 0, linkURL='/x/',
+                           children=[webnav.Tab('thing4', None, 0,
+                                                linkURL='/x/y')])]
+        index = webnav.SelectedTabIndex(tabs)
+        for path in ['/a/b/c/d/e', '/a/b/c', '/a/b/c/x', '/a/b', '/x',
+                     '/x/', '/x/z', '/x/y/z', '/XYZ']:
+            forURL = URL.fromString(path)
+            for i in range(2):
+                self.assertIdentical(index.select(forURL),
+                                     webnav.getSelectedTab(tabs, forURL))
+
+
+
+class NavigationCacheTests(unittest.TestCase):
+    """
+    Tests for L{webnav._NavigationCache}.
+    """
+    def setUp(self):
+        """
+        Create a store with a L{PrivateApplication} and an L{Installation} of
+        a L{NavigableThing}.
+        """
+        self.store = Store()
+        self.privapp = PrivateApplication(store=self.store)
+        installOn(self.privapp, self.store)
+        self.product = Product(store=self.store)
+        self.product.types = [qual(NavigableThing).decode('ascii')]
+        self.product.installProductOn(self.store)
+        self.installation = self.store.findUnique(Installation)
+        self.thing = self.store.findUnique(NavigableThing)
+        self.cache = webnav.navigationCache(self.store)
+
+
+    def getNavigation(self):
+        """
+        Get the navigation of C{self.store} from C{self.cache}.
+        """
+        return self.cache.getNavigation(self.privapp)
+
+
+    def tabNames(self):
+        """
+        Get the names of the tabs in the navigation of C{self.store}, and of
+        their children, along with the storeIDs they link to.
+        """
+        tabs, index = self.getNavigation()
+        return [(tab.name, tab.storeID,
+                 [(child.name, child.storeID) for child in tab.children])
+                for tab in tabs]
+
+
+    def test_navigationCache(self):
+        """
+        L{webnav.navigationCache} returns the same L{webnav._NavigationCache}
+        every time it is called with the same store.
+        """
+        self.assertIsInstance(self.cache, webnav._NavigationCache)
+        self.assertIdentical(webnav.navigationCache(self.store), self.cache)
+        self.assertNotIdentical(webnav.navigationCache(Store()), self.cache)
+
+
+    def test_navigation(self):
+        """
+        L{webnav._NavigationCache.getNavigation} returns the merged tabs of
+        the store's L{INavigableElement} powerups, with their URLs set, and a
+        L{webnav.SelectedTabIndex} for them.
+        """
+        tabs, index = self.getNavigation()
+        self.assertEqual(self.tabNames(), [
+                ('Thing', self.thing.storeID,
+                 [('Subthing', self.thing.storeID)])])
+        self.assertEqual(tabs[0].linkURL, self.privapp.linkTo(self.thing.storeID))
+        self.assertIsInstance(index, webnav.SelectedTabIndex)
+        self.assertIdentical(
+            index.select(URL.fromString(tabs[0].linkURL)), tabs[0])
+
+
+    def test_cached(self):
+        """
+        L{webnav._NavigationCache.getNavigation} returns the same tabs again
+        while the powerups have not changed, costing no more than asking for
+        the powerups' token.
+        """
+        navigation = self.getNavigation()
+        counter = QueryCounter(self.store)
+        self.assertEqual(
+            counter.measure(self.getNavigation),
+            counter.measure(powerupsToken, self.store, INavigableElement))
+        self.assertIdentical(self.getNavigation(), navigation)
+        self.assertEqual((self.cache.hits, self.cache.misses), (2, 1))
+
+        self.thing.priority = 1
+        self.assertIdentical(self.getNavigation(), navigation)
+
+
+    def test_powerupInstalled(self):
+        """
+        The navigation is merged again after a navigation powerup is
+        installed.
+        """
+        self.getNavigation()
+        other = OtherNavigableThing(store=self.store)
+        installOn(other, self.store)
+        self.assertEqual(self.tabNames(), [
+                ('Thing', self.thing.storeID,
+                 [('Subthing', self.thing.storeID)]),
+                ('Other', other.storeID, [])])
+
+
+    def test_powerupUninstalled(self):
+        """
+        The navigation is merged again after a navigation powerup is
+        uninstalled.
+        """
+        self.getNavigation()
+        self.product.removeProductFrom(self.store)
+        self.assertEqual(self.tabNames(), [])
+
+
+    def test_inMemoryPowerup(self):
+        """
+        The navigation is merged again after a navigation powerup is
+        installed in memory.
+        """
+        self.getNavigation()
+        self.store.inMemoryPowerUp(
+            FakeNavigator([webnav.Tab('Memory', 123, 1.0)]),
+            INavigableElement)
+        self.assertEqual(self.tabNames()[0], ('Memory', 123, []))
+
+
+    def test_suspendAndResume(self):
+        """
+        The navigation is merged again after an L{Installation} is suspended,
+        so that its tabs lead to the suspension page, and again after it is
+        resumed.
+        """
+        self.getNavigation()
+        suspendJustTabProviders(self.installation)
+        suspended = self.store.findUnique(SuspendedNavigableElement)
+        self.assertEqual(self.tabNames(), [
+                ('Thing', suspended.storeID,
+                 [('Subthing', suspended.storeID)])])
+        unsuspendTabProviders(self.installation)
+        self.assertEqual(self.tabNames(), [
+                ('Thing', self.thing.storeID,
+                 [('Subthing', self.thing.storeID)])])
+
+
+    def test_invalidate(self):
+        """
+        L{webnav._NavigationCache.invalidate} makes the next call to
+        C{getNavigation} merge the navigation again.
+        """
+        navigation = self.getNavigation()
+        self.cache.invalidate()
+        self.assertNotIdentical(self.getNavigation(), navigation)
+        self.assertEqual(self.cache.misses, 2)
+
+
+
 
 class FakeTranslator(object):
     """
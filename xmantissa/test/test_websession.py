@@ -6,11 +6,16 @@ Tests for L{xmantissa.websession}.
 """
 from datetime import timedelta
 
+from epsilon import extime
+
 from axiom.store import Store
+from axiom.iaxiom import IStatEvent
+from axiom.test.util import QueryCounter
 from twisted.cred.checkers import AllowAnonymousAccess
 from twisted.cred.portal import IRealm, Portal
 from twisted.cred.credentials import Anonymous, IAnonymous
 from twisted.internet.task import Clock
+from twisted.python import log
 from twisted.trial.unittest import SynchronousTestCase
 from nevow.guard import GuardSession
 from nevow.inevow import IResource
@@ -19,7 +24,10 @@ from zope.interface import implementer
 
 from xmantissa.websession import (
     PersistentSession, PersistentSessionWrapper, usernameFromRequest,
-    PERSISTENT_SESSION_LIFETIME, SESSION_CLEAN_FREQUENCY, DBPassthrough)
+    PERSISTENT_SESSION_LIFETIME, SESSION_CLEAN_FREQUENCY, DBPassthrough,
+    SESSION_RENEWAL_INTERVAL, SESSION_RENEWAL_DELAY,
+    TransientSession, TransientSessionStore, TRANSIENT_SESSION_LIFETIME)
+from xmantissa._storechange import storeChangeToken
 
 
 @implementer(IRealm)
@@ -276,6 +284,7 @@ class TestPersistentSessionWrapper(SynchronousTestCase):
         ps.lastUsed -= timedelta(seconds=PERSISTENT_SESSION_LIFETIME + 1)
         clock.advance(SESSION_CLEAN_FREQUENCY + 1)
         resource.login(request, session, Anonymous(), ())
+        clock.advance(0)
         self.assertEqual(
             list(store.query(PersistentSession).getColumn('sessionKey')),
             [b'key2'])
@@ -286,6 +295,7 @@ class TestPersistentSessionWrapper(SynchronousTestCase):
         ps2.lastUsed -= timedelta(seconds=PERSISTENT_SESSION_LIFETIME + 1)
         clock.advance(SESSION_CLEAN_FREQUENCY + 1)
         resource.login(request, session, Anonymous(), ())
+        clock.advance(0)
         self.assertEqual(store.query(PersistentSession).count(), 0)
 
 
@@ -306,20 +316,544 @@ class TestPersistentSessionWrapper(SynchronousTestCase):
 
     def test_cleanOnStart(self):
         """
-        L{PersistentSessionWrapper} immediately cleans expired sessions on
+        L{PersistentSessionWrapper} starts cleaning expired sessions on
         instantiation.
         """
+        clock = Clock()
         store = Store()
         resource = PersistentSessionWrapper(store, None)
         resource.createSessionForKey(b'key', b'username@domain')
         ps = store.findUnique(PersistentSession)
         ps.lastUsed -= timedelta(seconds=PERSISTENT_SESSION_LIFETIME + 1)
 
-        PersistentSessionWrapper(store, None)
+        PersistentSessionWrapper(store, None, clock=clock)
+        clock.advance(0)
         self.assertEqual(store.query(PersistentSession).count(), 0)
 
 
 
+class SessionCleaningTests(SynchronousTestCase):
+    """
+    Tests for the removal of expired persistent sessions by
+    L{PersistentSessionWrapper}.
+    """
+    def setUp(self):
+        self.clock = Clock()
+        self.store = Store()
+        self.resource = PersistentSessionWrapper(
+            self.store, None, clock=self.clock, sessionCleanChunkSize=2)
+
+
+    def createSession(self, key, expired=True):
+        """
+        Create a persistent session, which has expired if C{expired} is
+        true.
+        """
+        session = PersistentSession(
+            store=self.store, sessionKey=key,
+            authenticatedAs=b'username@domain')
+        if expired:
+            session.lastUsed -= timedelta(
+                seconds=PERSISTENT_SESSION_LIFETIME + 1)
+        return session
+
+
+    def sessionKeys(self):
+        """
+        Get the keys of the persistent sessions in the database.
+        """
+        return sorted(self.store.query(PersistentSession).getColumn(
+                'sessionKey'))
+
+
+    def afterTransactions(self, f):
+        """
+        Call C{f} after each outermost transaction run by C{self.store}.
+        """
+        transact = self.store.transact
+        depth = [0]
+        def notifyingTransact(*a, **kw):
+            depth[0] += 1
+            try:
+                result = transact(*a, **kw)
+            finally:
+                depth[0] -= 1
+            if not depth[0]:
+                f()
+            return result
+        self.store.transact = notifyingTransact
+        self.addCleanup(delattr, self.store, 'transact')
+
+
+    def test_chunks(self):
+        """
+        Expired sessions are removed C{sessionCleanChunkSize} at a time, each
+        chunk in its own transaction, with nothing removed until the reactor
+        runs the scheduled call.
+        """
+        for key in [b'a', b'b', b'c', b'd', b'e']:
+            self.createSession(key)
+        self.createSession(b'f', expired=False)
+        remaining = []
+        self.afterTransactions(
+            lambda: remaining.append(len(self.sessionKeys())))
+        self.resource._cleanSessions()
+        self.assertEqual(len(self.sessionKeys()), 6)
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+        self.clock.advance(0)
+        self.assertEqual(remaining, [4, 2, 1])
+        self.assertEqual(self.sessionKeys(), [b'f'])
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+    def test_purgedStatistic(self):
+        """
+        When it is finished, a cleaning run logs an L{IStatEvent} reporting
+        how many sessions it removed.
+        """
+        events = []
+        log.addObserver(events.append)
+        self.addCleanup(log.removeObserver, events.append)
+        for key in [b'a', b'b', b'c']:
+            self.createSession(key)
+        self.resource._cleanSessions()
+        self.clock.advance(0)
+        self.clock.advance(0)
+        [event] = [e for e in events
+                   if e.get('interface') is IStatEvent and
+                   'stat_persistent_sessions_purged' in e]
+        self.assertEqual(event['stat_persistent_sessions_purged'], 3)
+
+
+    def test_nothingExpired(self):
+        """
+        Nothing is scheduled if there are no expired sessions.
+        """
+        self.createSession(b'a', expired=False)
+        self.resource._cleanSessions()
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+    def test_oneRunAtATime(self):
+        """
+        Starting to clean sessions while a cleaning run is in progress does
+        not start another.
+        """
+        for key in [b'a', b'b', b'c']:
+            self.createSession(key)
+        self.resource._cleanSessions()
+        self.resource._cleanSessions()
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+        self.clock.advance(0)
+        self.assertEqual(self.sessionKeys(), [])
+
+
+    def test_usedSessionKept(self):
+        """
+        A session which is used while a cleaning run is in progress is not
+        removed, even though its renewal has not been written yet.
+        """
+        self.resource.sessionCleanChunkSize = 1
+        for key in [b'a', b'b']:
+            self.createSession(key)
+        used = []
+        def useSession():
+            if not used:
+                [key] = self.sessionKeys()
+                used.append(key)
+                self.resource.authenticatedUserForKey(key)
+        self.afterTransactions(useSession)
+        self.resource._cleanSessions()
+        self.clock.advance(0)
+        self.assertEqual(self.sessionKeys(), used)
+
+
+class PersistentSessionCacheTests(SynchronousTestCase):
+    """
+    Tests for the caching of persistent sessions, and the delayed renewal of
+    their C{lastUsed} times, by L{PersistentSessionWrapper}.
+    """
+    def setUp(self):
+        self.clock = Clock()
+        self.store = Store()
+        self.resource = PersistentSessionWrapper(
+            self.store, None, clock=self.clock)
+
+
+    def assertCostsChangeToken(self, f, *a):
+        """
+        Assert that calling C{f} with C{a} costs SQLite no more work than
+        asking for the store's change token, and return its result.
+        """
+        counter = QueryCounter(self.store)
+        result = []
+        self.assertEqual(
+            counter.measure(lambda: result.append(f(*a))),
+            counter.measure(storeChangeToken, self.store))
+        return result[0]
+
+
+    def createOldSession(self, key, age=SESSION_RENEWAL_INTERVAL + 1):
+        """
+        Create a persistent session which was last used C{age} seconds ago,
+        with a different L{PersistentSessionWrapper}, so that
+        C{self.resource} has not cached it.
+        """
+        PersistentSessionWrapper(self.store, None).createSessionForKey(
+            key, b'username@domain')
+        session = self.store.findUnique(
+            PersistentSession, PersistentSession.sessionKey == key)
+        session.lastUsed -= timedelta(seconds=age)
+        return session
+
+
+    def test_cached(self):
+        """
+        L{PersistentSessionWrapper.authenticatedUserForKey} does not look up a
+        session it has found recently again while the store has not changed;
+        it only asks for the store's change token.
+        """
+        self.createOldSession(b'key', 0)
+        self.assertEqual(
+            self.resource.authenticatedUserForKey(b'key'), b'username@domain')
+        self.assertEqual(
+            self.assertCostsChangeToken(
+                self.resource.authenticatedUserForKey, b'key'),
+            b'username@domain')
+
+
+    def test_createdSessionCached(self):
+        """
+        L{PersistentSessionWrapper.authenticatedUserForKey} does not look up a
+        session created by L{PersistentSessionWrapper.createSessionForKey}.
+        """
+        self.resource.createSessionForKey(b'key', b'username@domain')
+        self.assertEqual(
+            self.assertCostsChangeToken(
+                self.resource.authenticatedUserForKey, b'key'),
+            b'username@domain')
+
+
+    def test_revokedSession(self):
+        """
+        A cached session which is deleted from the database, the way
+        L{xmantissa.signup.PasswordResetResource.resetPassword} deletes them,
+        stops authenticating immediately.
+        """
+        self.resource.createSessionForKey(b'key', b'username@domain')
+        self.store.query(
+            PersistentSession,
+            PersistentSession.authenticatedAs == b'username@domain'
+            ).deleteFromStore()
+        self.assertIdentical(
+            self.resource.authenticatedUserForKey(b'key'), None)
+        self.assertNotIn(b'key', self.resource._sessionCache)
+
+
+    def test_revokedElsewhere(self):
+        """
+        A cached session which is deleted by another connection to the
+        database stops authenticating immediately.
+        """
+        dbdir = self.mktemp()
+        store = Store(dbdir)
+        resource = PersistentSessionWrapper(store, None, clock=self.clock)
+        resource.createSessionForKey(b'key', b'username@domain')
+        other = Store(dbdir)
+        other.query(PersistentSession).deleteFromStore()
+        other.close()
+        self.assertIdentical(resource.authenticatedUserForKey(b'key'), None)
+
+
+    def test_unrelatedChange(self):
+        """
+        A cached session is still found after the store changes, as long as it
+        has not been deleted, and is not looked up again until the store
+        changes again.
+        """
+        self.resource.createSessionForKey(b'key', b'username@domain')
+        self.createOldSession(b'other', 0)
+        self.assertEqual(
+            self.resource.authenticatedUserForKey(b'key'), b'username@domain')
+        self.assertEqual(
+            self.assertCostsChangeToken(
+                self.resource.authenticatedUserForKey, b'key'),
+            b'username@domain')
+
+
+    def test_nonexistentSessionNotCached(self):
+        """
+        The absence of a session is not remembered.
+        """
+        self.assertIdentical(
+            self.resource.authenticatedUserForKey(b'key'), None)
+        self.createOldSession(b'key', 0)
+        self.assertEqual(
+            self.resource.authenticatedUserForKey(b'key'), b'username@domain')
+
+
+    def test_removeSession(self):
+        """
+        L{PersistentSessionWrapper.removeSessionWithKey} forgets the session as
+        well as removing it from the database.
+        """
+        self.resource.createSessionForKey(b'key', b'username@domain')
+        self.resource.removeSessionWithKey(b'key')
+        self.assertIdentical(
+            self.resource.authenticatedUserForKey(b'key'), None)
+
+
+    def test_recentlyUsedNotRenewed(self):
+        """
+        Looking up a session which was last used less than
+        C{sessionRenewalInterval} seconds ago does not arrange for it to be
+        renewed.
+        """
+        session = self.createOldSession(b'key', SESSION_RENEWAL_INTERVAL - 60)
+        lastUsed = session.lastUsed
+        self.resource.authenticatedUserForKey(b'key')
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        self.assertEqual(session.lastUsed, lastUsed)
+
+
+    def test_renewalDelayed(self):
+        """
+        Looking up a session which was last used more than
+        C{sessionRenewalInterval} seconds ago sets its C{lastUsed} time to
+        the time of the lookup, C{sessionRenewalDelay} seconds later.
+        """
+        session = self.createOldSession(b'key')
+        lastUsed = session.lastUsed
+        before = extime.Time()
+        self.resource.authenticatedUserForKey(b'key')
+        after = extime.Time()
+        self.assertEqual(session.lastUsed, lastUsed)
+        self.clock.advance(SESSION_RENEWAL_DELAY)
+        self.assertTrue(before <= session.lastUsed <= after)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+    def test_renewalsBatched(self):
+        """
+        The sessions looked up within C{sessionRenewalDelay} seconds of each
+        other are renewed together, in one transaction.
+        """
+        sessions = [self.createOldSession(key) for key in [b'a', b'b', b'c']]
+        self.resource.authenticatedUserForKey(b'a')
+        self.clock.advance(SESSION_RENEWAL_DELAY - 1)
+        self.resource.authenticatedUserForKey(b'b')
+        self.resource.authenticatedUserForKey(b'b')
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+
+        transactions = []
+        transact = self.store.transact
+        def countingTransact(f, *a, **kw):
+            transactions.append(f)
+            return transact(f, *a, **kw)
+        self.store.transact = countingTransact
+        try:
+            self.clock.advance(1)
+        finally:
+            del self.store.transact
+        self.assertEqual(len(transactions), 1)
+        tooOld = extime.Time() - timedelta(seconds=SESSION_RENEWAL_INTERVAL)
+        self.assertEqual(
+            [session.lastUsed > tooOld for session in sessions],
+            [True, True, False])
+
+
+    def test_cachedSessionRenewed(self):
+        """
+        A session which stays cached is renewed again once
+        C{sessionRenewalInterval} seconds have passed since it was last
+        renewed.
+        """
+        resource = PersistentSessionWrapper(
+            self.store, None, clock=self.clock,
+            sessionCacheLifetime=SESSION_RENEWAL_INTERVAL * 2)
+        resource.createSessionForKey(b'key', b'username@domain')
+        self.clock.advance(SESSION_RENEWAL_INTERVAL - 1)
+        resource.authenticatedUserForKey(b'key')
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        self.clock.advance(1)
+        resource.authenticatedUserForKey(b'key')
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+        resource.authenticatedUserForKey(b'key')
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+
+
+    def test_removedSessionNotRenewed(self):
+        """
+        A session removed with L{PersistentSessionWrapper.removeSessionWithKey}
+        while its renewal is pending is not renewed.
+        """
+        self.createOldSession(b'key')
+        self.resource.authenticatedUserForKey(b'key')
+        self.resource.removeSessionWithKey(b'key')
+        self.clock.advance(SESSION_RENEWAL_DELAY)
+        self.assertEqual(self.store.query(PersistentSession).count(), 0)
+
+
+    def test_renewedBeforeCleaning(self):
+        """
+        Pending renewals are written before expired sessions are cleaned, so
+        that a session which has just been used is not removed.
+        """
+        self.createOldSession(b'key', PERSISTENT_SESSION_LIFETIME + 1)
+        self.resource.authenticatedUserForKey(b'key')
+        self.clock.advance(SESSION_CLEAN_FREQUENCY + 1)
+        self.resource._maybeCleanSessions()
+        self.assertEqual(self.store.query(PersistentSession).count(), 1)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+
+class TransientSessionStoreTests(SynchronousTestCase):
+    """
+    Tests for L{TransientSessionStore}, as used by L{PersistentSessionWrapper}
+    to keep its transient sessions.
+    """
+    def setUp(self):
+        self.clock = Clock()
+        self.store = Store()
+        self.resource = PersistentSessionWrapper(
+            self.store, None, clock=self.clock, maximumTransientSessions=3,
+            transientSessionExpiryInterval=10)
+        self.sessions = self.resource.sessions._transientSessions
+        self.expired = []
+
+
+    def createSession(self, key):
+        """
+        Create a transient session, as guard does, and keep track of when it
+        expires.
+        """
+        session = self.resource.sessionFactory(self.resource, key)
+        session.notifyOnExpire(lambda: self.expired.append(key))
+        self.resource.sessions[key] = session
+        session.setLifetime(TRANSIENT_SESSION_LIFETIME)
+        session.checkExpired()
+        return session
+
+
+    def test_sessionFactory(self):
+        """
+        L{PersistentSessionWrapper} creates L{TransientSession}s and keeps them
+        in a L{TransientSessionStore}.
+        """
+        self.assertIdentical(self.resource.sessionFactory, TransientSession)
+        self.assertIsInstance(self.sessions, TransientSessionStore)
+        self.assertEqual(self.sessions.maximumSize, 3)
+        self.assertEqual(self.sessions.expiryInterval, 10)
+
+
+    def test_mapping(self):
+        """
+        L{TransientSessionStore} maps session identifiers to sessions.
+        """
+        session = self.createSession(b'a')
+        self.assertIdentical(self.resource.sessions[b'a'], session)
+        self.assertIn(b'a', self.sessions)
+        self.assertEqual(len(self.sessions), 1)
+        self.assertIn(b'a', repr(self.sessions))
+        del self.resource.sessions[b'a']
+        self.assertNotIn(b'a', self.sessions)
+        self.assertRaises(KeyError, self.sessions.__getitem__, b'a')
+        self.assertEqual(len(self.sessions), 0)
+
+
+    def test_singleTimer(self):
+        """
+        However many sessions there are, there is only one timer, and it is
+        stopped when there are no sessions left.
+        """
+        for key in [b'a', b'b', b'c']:
+            self.createSession(key)
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+        for key in [b'a', b'b', b'c']:
+            del self.resource.sessions[key]
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+    def test_expiry(self):
+        """
+        Sessions which have not been used for their lifetime are expired,
+        within C{expiryInterval} seconds.
+        """
+        self.createSession(b'a')
+        self.clock.advance(15)
+        self.createSession(b'b')
+        self.clock.pump([10] * (TRANSIENT_SESSION_LIFETIME // 10 - 1))
+        self.assertEqual(self.expired, [])
+        self.clock.advance(10)
+        self.assertEqual(self.expired, [b'a'])
+        self.clock.advance(10)
+        self.assertEqual(self.expired, [b'a', b'b'])
+        self.assertEqual(len(self.sessions), 0)
+        self.assertEqual(self.sessions.expirations, 2)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+    def test_usedSessionNotExpired(self):
+        """
+        A session which has been used since it was put into its bucket is
+        put into a later one rather than being expired.
+        """
+        session = self.createSession(b'a')
+        self.clock.advance(TRANSIENT_SESSION_LIFETIME - 10)
+        session.touch()
+        self.clock.pump([10] * (TRANSIENT_SESSION_LIFETIME // 10))
+        self.assertEqual(self.expired, [])
+        self.clock.pump([10] * 3)
+        self.assertEqual(self.expired, [b'a'])
+
+
+    def test_leastRecentlyUsedEvicted(self):
+        """
+        When there are C{maximumSize} sessions and another is added, the one
+        which was looked up the longest time ago is expired.
+        """
+        for key in [b'a', b'b', b'c']:
+            self.createSession(key)
+        self.resource.sessions[b'a']
+        self.createSession(b'd')
+        self.assertEqual(self.expired, [b'b'])
+        self.assertEqual(self.sessions.evictions, 1)
+        self.assertEqual(len(self.sessions), 3)
+        self.assertNotIn(b'b', self.sessions)
+
+        self.createSession(b'e')
+        self.assertEqual(self.expired, [b'b', b'c'])
+        self.assertEqual(self.sessions.evictions, 2)
+
+
+    def test_replaceSession(self):
+        """
+        Replacing a session does not evict another.
+        """
+        for key in [b'a', b'b', b'c']:
+            self.createSession(key)
+        session = TransientSession(self.resource, b'a')
+        self.resource.sessions[b'a'] = session
+        self.assertEqual(self.expired, [])
+        self.assertIdentical(self.resource.sessions[b'a'], session)
+
+
+    def test_sessionFromPersistentSession(self):
+        """
+        Sessions created by L{DBPassthrough} for persistent sessions are kept
+        in the L{TransientSessionStore} and expired by it.
+        """
+        self.resource.createSessionForKey(b'key', b'username@domain')
+        session = self.resource.sessions[b'key']
+        self.assertIsInstance(session, TransientSession)
+        self.assertIn(b'key', self.sessions)
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+        self.clock.pump([10] * (TRANSIENT_SESSION_LIFETIME // 10 + 2))
+        self.assertNotIn(b'key', self.sessions)
+
+
+
 class DBPassthroughTests(SynchronousTestCase):
     """
     Tests for L{DBPassthrough}.
@@ -1372,3 +1372,24 @@ class VirtualHostWrapperTests(TestCase):
         self.assertEqual(
             wrapper.subdomain("bob.example.com:8080"),
             ("bob", "example.com"))
+
+
+    def test_domainAdded(self):
+        """
+        L{VirtualHostWrapper.subdomain} recognizes subdomains of a domain added
+        to the site after an earlier lookup.
+        """
+        site = Store()
+        wrapper = VirtualHostWrapper(site, None, None)
+        self.assertIdentical(wrapper.subdomain("bob.example.com"), None)
+        userbase.LoginMethod(
+            store=site,
+            account=site,
+            protocol=u'*',
+            internal=True,
+            verified=True,
+            localpart=u'alice',
+            domain=u'example.com')
+        self.assertEqual(
+            wrapper.subdomain("bob.example.com"),
+            ("bob", "example.com"))
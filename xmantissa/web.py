@@ -25,12 +25,14 @@ from epsilon.structlike import record
 from axiom.item import Item
 from axiom.attributes import path, text
 from axiom.dependency import dependsOn
-from axiom.userbase import LoginSystem, getDomainNames
+from axiom.userbase import LoginSystem
 
 from xmantissa.ixmantissa import ISiteURLGenerator, IProtocolFactoryFactory, IOfferingTechnician, ISessionlessSiteRootPlugin
 from xmantissa.port import TCPPort, SSLPort
 from xmantissa.cachejs import theHashModuleProvider
 from xmantissa.websession import PersistentSessionWrapper
+from xmantissa._sitedispatch import siteRootPlugins
+from xmantissa._domainindex import domainIndex
 
 
 class AxiomRequest(NevowRequest):
@@ -150,9 +152,11 @@ class SiteConfiguration(Item):
         host = request.getHeader('host') or self.hostname
         if ':' in host:
             host = host.split(':', 1)[0]
-        for domain in [self.hostname] + getDomainNames(self.store):
-            if (host == domain or
-                host.startswith('www.') and host[len('www.'):] == domain):
+        if (host == self.hostname or
+            host.startswith('www.') and host[len('www.'):] == self.hostname):
+            return URL(scheme='', netloc='', pathsegs=[''])
+        for (subdomain, domain) in domainIndex(self.store).matches(host):
+            if subdomain is None or subdomain == 'www':
                 return URL(scheme='', netloc='', pathsegs=[''])
         if request.isSecure():
             return self.encryptedRoot(self.hostname)
@@ -269,7 +273,8 @@ class UnguardedWrapper(record('siteStore guardedRoot')):
                 return res, segments[1:]
 
         req = IRequest(context)
-        for plg in self.siteStore.powerupsFor(ISessionlessSiteRootPlugin):
+        for plg in siteRootPlugins(
+            self.siteStore, ISessionlessSiteRootPlugin).pluginsFor(segments):
             spr = getattr(plg, 'sessionlessProduceResource', None)
             if spr is not None:
                 childAndSegments = spr(req, segments)
@@ -29,13 +29,14 @@ from nevow import url
 from xmantissa.publicweb import CustomizedPublicPage, renderShortUsername
 
 from xmantissa.ixmantissa import (
-    INavigableElement, ISiteRootPlugin, IWebTranslator, IStaticShellContent,
+    ISiteRootPlugin, IWebTranslator, IStaticShellContent,
     ITemplateNameResolver, ISiteURLGenerator, IWebViewer)
 
 from xmantissa.website import PrefixURLMixin, JUST_SLASH, WebSite, APIKey
 from xmantissa.website import MantissaLivePage
 from xmantissa.webtheme import getInstalledThemes
-from xmantissa.webnav import getTabs, startMenu, settingsLink, applicationNavigation
+from xmantissa.webnav import (
+    navigationCache, startMenu, settingsLink, applicationNavigation)
 from xmantissa.sharing import getPrimaryRole
 
 from xmantissa._webidgen import genkey, storeIDToWebID, webIDToStoreID
@@ -220,7 +221,8 @@ class _ShellRenderingMixin(object):
         @see L{xmantissa.webnav.applicationNavigation}
         """
         return applicationNavigation(
-            ctx, self.translator, self.pageComponents.navigation)
+            ctx, self.translator, self.pageComponents.navigation,
+            self.pageComponents.selectedTabIndex)
 
 
     def render_urchin(self, ctx, data):
@@ -443,10 +445,15 @@ class _PrivateRootPage(Page, _ShellRenderingMixin):
 
 
 
-class _PageComponents(record('navigation searchAggregator staticShellContent settings themes')):
+class _PageComponents(record('navigation searchAggregator staticShellContent '
+                             'settings themes selectedTabIndex',
+                             selectedTabIndex=None)):
     """
     I encapsulate various plugin objects that have some say
     in determining the available functionality on a given page
+
+    @ivar selectedTabIndex: a L{xmantissa.webnav.SelectedTabIndex} for
+    C{navigation}, or C{None}.
     """
     pass
 
@@ -509,7 +516,8 @@ class PrivateApplication(Item, PrefixURLMixin):
     sessionless = False
 
     def getPageComponents(self):
-        navigation = getTabs(self.store.powerupsFor(INavigableElement))
+        navigation, selectedTabIndex = navigationCache(
+            self.store).getNavigation(self)
 
         staticShellContent = IStaticShellContent(self.store, None)
 
@@ -517,7 +525,8 @@ class PrivateApplication(Item, PrefixURLMixin):
                                self.searchAggregator,
                                staticShellContent,
                                self.store.findFirst(PreferenceAggregator),
-                               getInstalledThemes(self.store.parent))
+                               getInstalledThemes(self.store.parent),
+                               selectedTabIndex)
 
 
     def _getUsername(self):
@@ -571,7 +580,15 @@ class PrivateApplication(Item, PrefixURLMixin):
         return webitem
 
     def toWebID(self, item):
-        return storeIDToWebID(self.privateKey, item.storeID)
+        return self.webIDForStoreID(item.storeID)
+
+
+    def webIDForStoreID(self, storeID):
+        """
+        Get the web ID of the item with the given storeID, as L{toWebID} would,
+        without loading the item.
+        """
+        return storeIDToWebID(self.privateKey, storeID)
 
 
     def _preferredThemes(self):
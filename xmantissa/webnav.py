@@ -2,6 +2,8 @@
 
 from epsilon.structlike import record
 
+from twisted.python import log
+
 from zope.interface import implements
 
 from nevow.inevow import IQ
@@ -9,8 +11,11 @@ from nevow import url
 
 from nevow.stan import NodeNotFound
 
-from xmantissa.ixmantissa import ITab
+from axiom.iaxiom import IStatEvent
+
+from xmantissa.ixmantissa import ITab, INavigableElement
 from xmantissa.fragmentutils import dictFillSlots
+from xmantissa._storechange import powerupsToken
 
 class TabMisconfiguration(Exception):
     def __init__(self, info, tab):
@@ -171,31 +176,144 @@ def getSelectedTab(tabs, forURL):
 
     @return: L{Tab} instance
     """
+    return SelectedTabIndex(tabs).select(forURL)
 
-    flatTabs = []
 
-    def flatten(tabs):
-        for t in tabs:
-            flatTabs.append(t)
-            flatten(t.children)
 
-    flatten(tabs)
-    forURL = '/' + forURL.path
+class SelectedTabIndex(object):
+    """
+    A lookup structure for finding the selected tab of a tree of tabs, as
+    L{getSelectedTab} does, without flattening and sorting the tree every
+    time.
 
-    for t in flatTabs:
-        if forURL == t.linkURL:
-            return t
+    @ivar _exact: a C{dict} mapping C{linkURL}s to the first tab with that
+    C{linkURL}.
 
-    flatTabs.sort(key=lambda t: len(t.linkURL), reverse=True)
+    @ivar _prefixes: a C{dict} mapping C{linkURL}s, with a trailing slash
+    added if they do not have one, to the tab which should be selected when
+    the path of the current resource starts with them.
+    """
+    def __init__(self, tabs):
+        """
+        @param tabs: sequence of L{Tab} instances, which have already been
+        passed to L{setTabURLs}.
+        """
+        self._exact = {}
+        self._prefixes = {}
+        order = {}
+
+        def index(tabs):
+            for t in tabs:
+                order[t] = len(order)
+                self._exact.setdefault(t.linkURL, t)
+                if t.linkURL.endswith('/'):
+                    linkURL = t.linkURL
+                else:
+                    linkURL = t.linkURL + '/'
+                other = self._prefixes.get(linkURL)
+                if other is None or len(other.linkURL) < len(t.linkURL):
+                    self._prefixes[linkURL] = t
+                index(t.children)
+        index(tabs)
+        self._order = order
 
-    for t in flatTabs:
-        if not t.linkURL.endswith('/'):
-            linkURL = t.linkURL + '/'
-        else:
-            linkURL = t.linkURL
 
-        if forURL.startswith(linkURL):
-            return t
+    def select(self, forURL):
+        """
+        Find the tab which should be selected when the current resource lives
+        at C{forURL}: the tab whose C{linkURL} is the path of C{forURL}, or
+        else the one with the longest C{linkURL} which is a prefix of it.
+
+        @param forURL: L{nevow.url.URL}
+
+        @return: L{Tab} instance, or C{None} if no tab matches.
+        """
+        forURL = '/' + forURL.path
+        tab = self._exact.get(forURL)
+        if tab is not None:
+            return tab
+
+        best = None
+        end = forURL.find('/')
+        while end != -1:
+            t = self._prefixes.get(forURL[:end + 1])
+            if t is not None and (
+                best is None or
+                (-len(t.linkURL), self._order[t]) <
+                (-len(best.linkURL), self._order[best])):
+                best = t
+            end = forURL.find('/', end + 1)
+        return best
+
+
+
+class _NavigationCache(object):
+    """
+    The merged navigation of the L{INavigableElement} powerups of one store.
+
+    Merging the tabs means loading every navigation powerup and asking it for
+    its tabs, which every private page would otherwise do.  The tabs, their
+    URLs and a L{SelectedTabIndex} for them are kept until the powerups
+    installed on the store for L{INavigableElement} change: when one is
+    installed or uninstalled, including by suspending or resuming an
+    L{xmantissa.offering.InstalledOffering}, which replaces the powerups with
+    L{xmantissa.suspension.SuspendedNavigableElement}s.  Checking for this
+    takes a single query for the powerup connectors.
+
+    @ivar hits: the number of times the navigation was taken from this cache.
+
+    @ivar misses: the number of times the navigation had to be merged.
+    """
+    def __init__(self, store):
+        self.store = store
+        self.hits = self.misses = 0
+        self._token = None
+        self._navigation = None
+
+
+    def getNavigation(self, webTranslator):
+        """
+        Get the merged navigation of the store.
+
+        @param webTranslator: the L{xmantissa.ixmantissa.IWebTranslator} of
+        the store, used to set the C{linkURL}s of the tabs.
+
+        @return: a two-tuple of a C{list} of L{Tab}s, as L{getTabs} returns,
+        whose C{linkURL}s have been set by L{setTabURLs}, and a
+        L{SelectedTabIndex} for them.  These are shared by every caller, so
+        they must not be changed.
+        """
+        token = (powerupsToken(self.store, INavigableElement), webTranslator)
+        if self._navigation is not None and token == self._token:
+            self.hits += 1
+            log.msg(interface=IStatEvent, stat_navigation_cache_hits=1)
+            return self._navigation
+        self.misses += 1
+        log.msg(interface=IStatEvent, stat_navigation_cache_misses=1)
+        tabs = getTabs(self.store.powerupsFor(INavigableElement))
+        setTabURLs(tabs, webTranslator)
+        self._navigation = (tabs, SelectedTabIndex(tabs))
+        self._token = token
+        return self._navigation
+
+
+    def invalidate(self):
+        """
+        Discard the cached navigation, so that it is merged again the next
+        time it is asked for.
+        """
+        self._token = self._navigation = None
+
+
+
+def navigationCache(store):
+    """
+    Get the L{_NavigationCache} of a store, creating it if necessary.
+    """
+    cache = getattr(store, '_navigationCache', None)
+    if cache is None:
+        cache = store._navigationCache = _NavigationCache(store)
+    return cache
 
 
 
@@ -248,7 +366,7 @@ def settingsLink(translator, settings, tag):
 # This is somewhat redundant with startMenu.  The selected/not feature of this
 # renderer should be added to startMenu and then templates can just use that
 # and this can be deleted.
-def applicationNavigation(ctx, translator, navigation):
+def applicationNavigation(ctx, translator, navigation, selectedTabIndex=None):
     """
     Horizontal, primary-only navigation view.
 
@@ -270,11 +388,16 @@ def applicationNavigation(ctx, translator, navigation):
     @type translator: L{IWebTranslator} provider
     @type navigation: L{list} of L{Tab}
 
+    @param selectedTabIndex: a L{SelectedTabIndex} for C{navigation}, or
+    C{None} to find the selected tab with L{getSelectedTab}.
+
     @rtype: {nevow.stan.Tag}
     """
     setTabURLs(navigation, translator)
-    selectedTab = getSelectedTab(navigation,
-                                 url.URL.fromContext(ctx))
+    if selectedTabIndex is None:
+        selectedTab = getSelectedTab(navigation, url.URL.fromContext(ctx))
+    else:
+        selectedTab = selectedTabIndex.select(url.URL.fromContext(ctx))
 
     getp = IQ(ctx.tag).onePattern
     tabs = []
@@ -7,28 +7,59 @@ Sessions that persist in the database.
 
 Every L{SESSION_CLEAN_FREQUENCY} seconds, a pass is made over all persistent
 sessions, and those that are more than L{PERSISTENT_SESSION_LIFETIME} seconds
-old are deleted.  Transient sessions die after L{TRANSIENT_SESSION_LIFETIME}
-seconds.
+old are deleted, L{SESSION_CLEAN_CHUNK_SIZE} at a time, in the background.
+Transient sessions die after L{TRANSIENT_SESSION_LIFETIME} seconds.
 
-These three globals can be overridden by passing appropriate values to the
+These four globals can be overridden by passing appropriate values to the
 L{PersistentSessionWrapper} constructor: C{sessionCleanFrequency},
-C{persistentSessionLifetime}, and C{transientSessionLifetime}.
+C{persistentSessionLifetime}, C{sessionCleanChunkSize}, and
+C{transientSessionLifetime}.
+
+Persistent sessions which have been looked up are remembered for
+L{SESSION_CACHE_LIFETIME} seconds, and the time they were last used is
+written at most once every L{SESSION_RENEWAL_INTERVAL} seconds for each
+session, in batches written L{SESSION_RENEWAL_DELAY} seconds after the first
+of them was used.  These can be overridden by passing C{sessionCacheLifetime},
+C{sessionRenewalInterval} and C{sessionRenewalDelay} to the
+L{PersistentSessionWrapper} constructor.
+
+At most L{MAXIMUM_TRANSIENT_SESSIONS} transient sessions are kept; when
+another is created, the one used the longest time ago is expired.  Idle
+transient sessions are expired by a single timer which runs every
+L{TRANSIENT_SESSION_EXPIRY_INTERVAL} seconds, rather than by a timer for each
+session.  These can be overridden by passing C{maximumTransientSessions} and
+C{transientSessionExpiryInterval} to the L{PersistentSessionWrapper}
+constructor.
 """
+from collections import OrderedDict
 from datetime import timedelta
 
 from twisted.cred import credentials
 from twisted.internet import reactor
+from twisted.python import log
 
 from epsilon import extime
 
 from axiom import attributes, item, userbase
+from axiom.iaxiom import IStatEvent
 
 from nevow import guard
 
+from xmantissa._itemloader import _chunks
+from xmantissa._domainindex import DomainIndex
+from xmantissa._storechange import storeChangeToken
+
 
 SESSION_CLEAN_FREQUENCY = 60 * 60 * 25  # 1 day, almost
+SESSION_CLEAN_CHUNK_SIZE = 500
 PERSISTENT_SESSION_LIFETIME = 60 * 60 * 24 * 7 * 2 # 2 weeks
 TRANSIENT_SESSION_LIFETIME = 60 * 12 + 32 # 12 minutes, 32 seconds.
+SESSION_CACHE_LIFETIME = 60 * 5 # 5 minutes
+SESSION_CACHE_SIZE = 10000
+SESSION_RENEWAL_INTERVAL = 60 * 60 # 1 hour
+SESSION_RENEWAL_DELAY = 60
+MAXIMUM_TRANSIENT_SESSIONS = 50000
+TRANSIENT_SESSION_EXPIRY_INTERVAL = 30
 
 
 def usernameFromRequest(request):
@@ -78,6 +109,187 @@ class PersistentSession(item.Item):
 
 
 
+class TransientSession(guard.GuardSession):
+    """
+    A guard session whose expiry is left to the L{TransientSessionStore} it
+    is kept in, rather than scheduled by the session itself.
+
+    The time it was last used is measured by the clock of its guard.
+    """
+    def touch(self):
+        self.lastModified = self.guard._clock.seconds()
+
+
+    def checkExpired(self):
+        """
+        Do nothing.  L{TransientSessionStore} checks whether its sessions have
+        expired.
+        """
+
+
+
+class TransientSessionStore(object):
+    """
+    A bounded collection of transient sessions, keyed by session identifier,
+    which expires the sessions which have not been used for their lifetime.
+
+    When the collection is full, the session which was looked up the longest
+    time ago is expired to make room for a new one.  Expiry is checked by a
+    single timer, which runs every C{expiryInterval} seconds while there are
+    sessions: each session is put into the bucket of the interval in which it
+    would expire if it were not used again, and the sessions in each bucket
+    are looked at when its interval has passed.  A session which has been
+    used since it was put into a bucket is put into a later one; one which has
+    not is expired.
+
+    Sessions are expired by calling their C{expire} method, which removes
+    them from their guard's sessions, as it would if they expired by
+    themselves.
+
+    @ivar maximumSize: the number of sessions to keep.
+
+    @ivar expiryInterval: the number of seconds between expiry checks.
+
+    @ivar expirations: the number of sessions which have been expired because
+    they were not used for their lifetime.
+
+    @ivar evictions: the number of sessions which have been expired to make
+    room for others.
+    """
+    maximumSize = MAXIMUM_TRANSIENT_SESSIONS
+    expiryInterval = TRANSIENT_SESSION_EXPIRY_INTERVAL
+
+    def __init__(self, clock=None, maximumSize=None, expiryInterval=None):
+        """
+        @param clock: an L{IReactorTime} provider used to schedule expiry
+        checks.
+        """
+        self._clock = reactor if clock is None else clock
+        if maximumSize is not None:
+            self.maximumSize = maximumSize
+        if expiryInterval is not None:
+            self.expiryInterval = expiryInterval
+        self.expirations = self.evictions = 0
+        # Maps session identifiers to sessions, least recently used first.
+        self._sessions = OrderedDict()
+        # Maps bucket numbers to sets of session identifiers, and session
+        # identifiers to the number of the bucket they are in.
+        self._buckets = {}
+        self._bucketOf = {}
+        self._expiryCall = None
+
+
+    def __len__(self):
+        return len(self._sessions)
+
+
+    def __contains__(self, key):
+        return key in self._sessions
+
+    has_key = __contains__
+
+
+    def __getitem__(self, key):
+        """
+        Get a session, and make it the most recently used one.
+        """
+        session = self._sessions.pop(key)
+        self._sessions[key] = session
+        return session
+
+
+    def __setitem__(self, key, session):
+        """
+        Add a session, expiring the least recently used one if there are
+        already C{maximumSize}.
+        """
+        if key in self._sessions:
+            del self._sessions[key]
+        else:
+            while self._sessions and len(self._sessions) >= self.maximumSize:
+                oldKey, oldSession = self._sessions.iteritems().next()
+                self._expire(oldKey, oldSession)
+                self.evictions += 1
+                log.msg(interface=IStatEvent,
+                        stat_transient_sessions_evicted=1)
+        self._sessions[key] = session
+        if key not in self._bucketOf:
+            self._schedule(key, session)
+
+
+    def __delitem__(self, key):
+        del self._sessions[key]
+        bucket = self._bucketOf.pop(key, None)
+        keys = self._buckets.get(bucket)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._buckets[bucket]
+        if not self._sessions and self._expiryCall is not None:
+            self._expiryCall.cancel()
+            self._expiryCall = None
+
+
+    def __repr__(self):
+        return '<TransientSessionStore %r>' % (self._sessions.keys(),)
+
+
+    def _schedule(self, key, session):
+        """
+        Put a session into the bucket of the interval in which it will expire
+        if it is not used again, and make sure the expiry timer is running.
+        """
+        deadline = session.lastModified + session.lifetime
+        bucket = int(deadline // self.expiryInterval) + 1
+        self._buckets.setdefault(bucket, set()).add(key)
+        self._bucketOf[key] = bucket
+        if self._expiryCall is None:
+            self._expiryCall = self._clock.callLater(
+                self.expiryInterval, self._expireSessions)
+
+
+    def _expire(self, key, session):
+        """
+        Expire a session, and make sure it is gone even if its C{expire}
+        method did not remove it from this store.
+        """
+        session.expire()
+        if key in self._sessions:
+            del self[key]
+
+
+    def _expireSessions(self):
+        """
+        Expire the sessions in the buckets whose intervals have passed which
+        have not been used since they were put into them, and put the rest
+        into later buckets.
+        """
+        self._expiryCall = None
+        now = self._clock.seconds()
+        current = int(now // self.expiryInterval)
+        expired = 0
+        for bucket in sorted(b for b in self._buckets if b <= current):
+            for key in self._buckets.pop(bucket):
+                if self._bucketOf.get(key) != bucket:
+                    # Removed while an earlier session was being expired.
+                    continue
+                del self._bucketOf[key]
+                session = self._sessions[key]
+                if now - session.lastModified > session.lifetime:
+                    self._expire(key, session)
+                    expired += 1
+                else:
+                    self._schedule(key, session)
+        self.expirations += expired
+        log.msg(interface=IStatEvent,
+                stat_transient_sessions_expired=expired,
+                transientSessionsLive=len(self._sessions))
+        if self._sessions and self._expiryCall is None:
+            self._expiryCall = self._clock.callLater(
+                self.expiryInterval, self._expireSessions)
+
+
+
 class DBPassthrough(object):
     """
     A dictionaryish thing that manages sessions and interfaces with guard.
@@ -86,10 +298,15 @@ class DBPassthrough(object):
     instance, or in this case, a subclass.  Guard uses a vanilla dict by
     default; here we pretend to be a dict and introduce persistent-session
     behaviour.
+
+    Transient sessions are kept in a L{TransientSessionStore}, which expires
+    them.
     """
-    def __init__(self, wrapper):
+    def __init__(self, wrapper, transientSessions=None):
         self.wrapper = wrapper
-        self._transientSessions = {}
+        if transientSessions is None:
+            transientSessions = TransientSessionStore()
+        self._transientSessions = transientSessions
 
 
     def __contains__(self, key):
@@ -152,6 +369,8 @@ class PersistentSessionWrapper(guard.SessionWrapper):
     if a user has a persistent session cookie, but no transient session, one is
     created here.
     """
+    sessionFactory = TransientSession
+
     def __init__(
         self,
         store,
@@ -162,17 +381,37 @@ class PersistentSessionWrapper(guard.SessionWrapper):
         enableSubdomains=False,
         domains=(),
         clock=None,
+        sessionCacheLifetime=SESSION_CACHE_LIFETIME,
+        sessionRenewalInterval=SESSION_RENEWAL_INTERVAL,
+        sessionRenewalDelay=SESSION_RENEWAL_DELAY,
+        maximumTransientSessions=MAXIMUM_TRANSIENT_SESSIONS,
+        transientSessionExpiryInterval=TRANSIENT_SESSION_EXPIRY_INTERVAL,
+        sessionCleanChunkSize=SESSION_CLEAN_CHUNK_SIZE,
         **kw):
         guard.SessionWrapper.__init__(self, portal, **kw)
         self.store = store
-        self.sessions = DBPassthrough(self)
         self.cookieKey = 'divmod-user-cookie'
         self.sessionLifetime = transientSessionLifetime
         self.persistentSessionLifetime = persistentSessionLifetime
         self.sessionCleanFrequency = sessionCleanFrequency
         self._enableSubdomains = enableSubdomains
-        self._domains = domains
+        self._domains = DomainIndex(domains)
         self._clock = reactor if clock is None else clock
+        self.sessions = DBPassthrough(self, TransientSessionStore(
+                self._clock, maximumTransientSessions,
+                transientSessionExpiryInterval))
+        self.sessionCacheLifetime = sessionCacheLifetime
+        self.sessionRenewalInterval = sessionRenewalInterval
+        self.sessionRenewalDelay = sessionRenewalDelay
+        # Maps session keys to (authenticatedAs, cachedUntil, renewedAt,
+        # storeToken), soonest to expire first.
+        self._sessionCache = OrderedDict()
+        # Maps session keys to the extime.Time they were last used at, for
+        # sessions whose lastUsed has not been written yet.
+        self._pendingRenewals = {}
+        self._renewalCall = None
+        self.sessionCleanChunkSize = sessionCleanChunkSize
+        self._cleanCall = None
         if self.store is not None:
             self._cleanSessions()
 
@@ -191,12 +430,19 @@ class PersistentSessionWrapper(guard.SessionWrapper):
             store=self.store,
             sessionKey=key,
             authenticatedAs=user)
+        self._cacheSession(key, user, self._clock.seconds(),
+                           storeChangeToken(self.store))
 
 
     def authenticatedUserForKey(self, key):
         """
         Find a persistent session for a user.
 
+        Sessions which were found recently are remembered, rather than looked
+        up in the database again while nothing in the store has changed, and
+        the time they were last used is written to the database later, at most
+        once every C{sessionRenewalInterval} seconds.
+
         @type key: L{bytes}
         @param key: The persistent session identifier.
 
@@ -204,13 +450,118 @@ class PersistentSessionWrapper(guard.SessionWrapper):
         @return: The avatar ID the session belongs to, or C{None} if no such
             session exists.
         """
+        now = self._clock.seconds()
+        self._expireCachedSessions(now)
+        storeToken = storeChangeToken(self.store)
+        entry = self._sessionCache.get(key)
+        if entry is not None:
+            authenticatedAs, cachedUntil, renewedAt, cachedToken = entry
+            if cachedToken != storeToken:
+                # The session may have been deleted since it was cached.
+                if self.store.findFirst(
+                    PersistentSession,
+                    PersistentSession.sessionKey == key) is None:
+                    self._forgetSession(key)
+                    return None
+            log.msg(interface=IStatEvent, stat_persistent_session_cache_hits=1)
+            if now - renewedAt >= self.sessionRenewalInterval:
+                self._scheduleRenewal(key)
+                renewedAt = now
+            self._sessionCache[key] = (
+                authenticatedAs, cachedUntil, renewedAt, storeToken)
+            return authenticatedAs
+
+        log.msg(interface=IStatEvent, stat_persistent_session_cache_misses=1)
         session = self.store.findFirst(
             PersistentSession, PersistentSession.sessionKey == key)
         if session is None:
             return None
+        unrenewed = extime.Time() - session.lastUsed
+        if unrenewed >= timedelta(seconds=self.sessionRenewalInterval):
+            self._scheduleRenewal(key)
+            renewedAt = now
         else:
-            session.renew()
-            return session.authenticatedAs
+            renewedAt = now - (unrenewed.days * 24 * 60 * 60 +
+                               unrenewed.seconds)
+        self._cacheSession(
+            key, session.authenticatedAs, renewedAt, storeToken)
+        return session.authenticatedAs
+
+
+    def _cacheSession(self, key, authenticatedAs, renewedAt, storeToken):
+        """
+        Remember that the persistent session C{key} belongs to
+        C{authenticatedAs} for C{sessionCacheLifetime} seconds.
+
+        @param renewedAt: the time, according to C{_clock}, at which the
+        session's C{lastUsed} was last set.
+
+        @param storeToken: the L{storeChangeToken} of the store when the
+        session was known to exist.
+        """
+        now = self._clock.seconds()
+        self._sessionCache.pop(key, None)
+        while len(self._sessionCache) >= SESSION_CACHE_SIZE:
+            self._sessionCache.popitem(last=False)
+        self._sessionCache[key] = (
+            authenticatedAs, now + self.sessionCacheLifetime, renewedAt,
+            storeToken)
+
+
+    def _forgetSession(self, key):
+        """
+        Forget the cached persistent session C{key}, and do not renew it.
+        """
+        self._sessionCache.pop(key, None)
+        self._pendingRenewals.pop(key, None)
+
+
+    def _expireCachedSessions(self, now):
+        """
+        Forget the persistent sessions which were cached more than
+        C{sessionCacheLifetime} seconds ago.
+        """
+        while self._sessionCache:
+            key, (authenticatedAs, cachedUntil, renewedAt, storeToken) = (
+                self._sessionCache.iteritems().next())
+            if cachedUntil > now:
+                break
+            del self._sessionCache[key]
+
+
+    def _scheduleRenewal(self, key):
+        """
+        Arrange for the C{lastUsed} time of the persistent session C{key} to
+        be set to now, along with those of any other sessions used in the
+        next C{sessionRenewalDelay} seconds.
+        """
+        self._pendingRenewals[key] = extime.Time()
+        if self._renewalCall is None:
+            self._renewalCall = self._clock.callLater(
+                self.sessionRenewalDelay, self._renewSessions)
+
+
+    def _renewSessions(self):
+        """
+        Write the C{lastUsed} times of the persistent sessions which have been
+        used since they were last written, in one transaction.
+        """
+        if self._renewalCall is not None:
+            if self._renewalCall.active():
+                self._renewalCall.cancel()
+            self._renewalCall = None
+        pending, self._pendingRenewals = self._pendingRenewals, {}
+        if not pending:
+            return
+        def renew():
+            for chunk in _chunks(pending.keys()):
+                for session in self.store.query(
+                    PersistentSession,
+                    PersistentSession.sessionKey.oneOf(chunk)):
+                    session.lastUsed = pending[session.sessionKey]
+        self.store.transact(renew)
+        log.msg(interface=IStatEvent,
+                stat_persistent_sessions_renewed=len(pending))
 
 
     def removeSessionWithKey(self, key):
@@ -220,6 +571,7 @@ class PersistentSessionWrapper(guard.SessionWrapper):
         @type key: L{bytes}
         @param key: The persistent session identifier.
         """
+        self._forgetSession(key)
         self.store.query(
             PersistentSession,
             PersistentSession.sessionKey == key).deleteFromStore()
@@ -227,13 +579,62 @@ class PersistentSessionWrapper(guard.SessionWrapper):
 
     def _cleanSessions(self):
         """
-        Clean expired sesisons.
+        Start removing expired sessions from the database, unless that is
+        already being done.
+
+        The sessions are removed C{sessionCleanChunkSize} at a time, each
+        chunk in its own transaction, with the reactor given a chance to run
+        between chunks.  If there are no expired sessions, nothing is
+        scheduled.
         """
-        tooOld = extime.Time() - timedelta(seconds=PERSISTENT_SESSION_LIFETIME)
-        self.store.query(
-            PersistentSession,
-            PersistentSession.lastUsed < tooOld).deleteFromStore()
         self._lastClean = self._clock.seconds()
+        if self._cleanCall is not None:
+            return
+        self._renewSessions()
+        self._sessionCache.clear()
+        tooOld = extime.Time() - timedelta(
+            seconds=self.persistentSessionLifetime)
+        expired = self.store.findFirst(
+            PersistentSession, PersistentSession.lastUsed < tooOld)
+        if expired is not None:
+            self._cleanCall = self._clock.callLater(
+                0, self._cleanSessionChunk, tooOld, 0)
+
+
+    def _cleanSessionChunk(self, tooOld, purged):
+        """
+        Remove up to C{sessionCleanChunkSize} sessions last used before
+        C{tooOld}, and arrange to remove more later if there may be more.
+
+        @type tooOld: L{extime.Time}
+
+        @param purged: the number of sessions removed so far in this run.
+        """
+        self._cleanCall = None
+        # Sessions which have been used recently must not be removed, even if
+        # their lastUsed time has not been written yet.
+        self._renewSessions()
+        def clean():
+            keys = list(self.store.query(
+                PersistentSession,
+                PersistentSession.lastUsed < tooOld,
+                limit=self.sessionCleanChunkSize).getColumn('sessionKey'))
+            self.store.query(
+                PersistentSession,
+                attributes.AND(PersistentSession.sessionKey.oneOf(keys),
+                               PersistentSession.lastUsed < tooOld)
+                ).deleteFromStore()
+            return keys
+        keys = self.store.transact(clean)
+        for key in keys:
+            self._sessionCache.pop(key, None)
+        purged += len(keys)
+        if len(keys) == self.sessionCleanChunkSize:
+            self._cleanCall = self._clock.callLater(
+                0, self._cleanSessionChunk, tooOld, purged)
+        else:
+            log.msg(interface=IStatEvent,
+                    stat_persistent_sessions_purged=purged)
 
 
     def _maybeCleanSessions(self):
@@ -263,9 +664,9 @@ class PersistentSessionWrapper(guard.SessionWrapper):
             return None
 
         host = host.split(':')[0]
-        for domain in self._domains:
+        for (subdomain, domain) in self._domains.matches(host):
             suffix = "." + domain
-            if host == domain:
+            if subdomain is None:
                 # The request is for a domain which is directly recognized.
                 if self._enableSubdomains:
                     # Subdomains are enabled, so the suffix is returned to
@@ -277,7 +678,7 @@ class PersistentSessionWrapper(guard.SessionWrapper):
                 # the domain in the request, to apply.
                 return None
 
-            if self._enableSubdomains and host.endswith(suffix):
+            if self._enableSubdomains:
                 # The request is for a subdomain of a directly recognized
                 # domain and subdomains are enabled.  Drop the unrecognized
                 # subdomain portion and return the suffix to enable the cookie
@@ -31,7 +31,7 @@ http://your-server/foo/, make it the default::
 
 from zope.interface import implements
 
-from axiom import userbase, attributes
+from axiom import userbase
 from axiom.item import Item
 from axiom.attributes import text, integer
 
@@ -40,6 +40,7 @@ from nevow import inevow, url, rend
 from xmantissa.offering import isAppStore
 
 from xmantissa import sharing
+from xmantissa._userstores import userStoreCache
 
 class _DefaultShareID(Item):
     """
@@ -211,7 +212,9 @@ def linkTo(sharedProxyOrItem):
 
 def _storeFromUsername(store, username):
     """
-    Find the user store of the user with username C{store}
+    Find the user store of the user with username C{store}, through the
+    only internal L{userbase.LoginMethod} with that localpart.  Recently used
+    user stores are kept open by L{xmantissa._userstores.UserStoreCache}.
 
     @param store: site-store
     @type store: L{axiom.store.Store}
@@ -221,14 +224,7 @@ def _storeFromUsername(store, username):
 
     @rtype: L{axiom.store.Store} or C{None}
     """
-    lm = store.findUnique(
-            userbase.LoginMethod,
-            attributes.AND(
-                userbase.LoginMethod.localpart == username,
-                userbase.LoginMethod.internal == True),
-            default=None)
-    if lm is not None:
-        return lm.account.avatars.open()
+    return userStoreCache(store).open(username)
 
 
 
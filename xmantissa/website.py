@@ -191,6 +191,33 @@ class PrefixURLMixin(object):
         return self._produceIt(segments, self.createResource)
 
 
+    def prefixSegmentsFor(self, interface):
+        """
+        Declare the URLs this plugin responds to, so that requests for other
+        URLs need not be offered to it.
+
+        @param interface: L{ISiteRootPlugin} or L{ISessionlessSiteRootPlugin}.
+
+        @return: a C{tuple} of the segments of C{prefixURL}, if this plugin
+        only produces resources for the URLs beneath it when used as a
+        powerup for C{interface}, or C{None} if a subclass has replaced the
+        method which produces resources for C{interface}, and so may respond
+        to other URLs.
+        """
+        if interface is ISiteRootPlugin:
+            name = 'produceResource'
+        elif interface is ISessionlessSiteRootPlugin:
+            name = 'sessionlessProduceResource'
+        else:
+            return None
+        if getattr(type(self), name).im_func is not getattr(
+            PrefixURLMixin, name).im_func:
+            return None
+        if not self.prefixURL:
+            return ()
+        return tuple(self.prefixURL.split('/'))
+
+
     def _produceIt(self, segments, thunk):
         """
         Underlying implmeentation of L{PrefixURLMixin.produceResource} and